@@ -0,0 +1,252 @@
+#!/usr/bin/env vpython3
+"""Microbenchmarks of the STUN/TURN codec and handler hot paths
+Each benchmark is calibrated to run for about 0.1s per repeat, the result
+of a run can be saved as JSON and compared with an earlier run.
+Usage:
+    {0} [-o OUTPUT.json] [-c BASELINE.json] [-k FILTER] [-r REPEAT]
+"""
+import sys
+import json
+import time
+import timeit
+import platform
+import argparse
+import statistics
+from sturn import stun, turn
+from sturn.stun.agent import Message, MessageWriter, Address
+from sturn.stun import attributes
+from sturn.stun.authentication import LongTermCredentialMechanism
+from sturn.turn import attributes as turn_attributes
+from sturn.turn.server import TurnUdpServer
+from sturn.manual import ManualDriver
+from sturn.utils import ha1
+
+
+TRANSACTION_ID = bytes(range(12))
+KEY = ha1('username', b'realm', 'password')
+CLIENT_ADDR = ('192.168.2.1', 54321)
+PEER_ADDR = ('192.168.2.2', 40000)
+
+# Arguments to encode each attribute class with
+ATTRIBUTES = (
+    (attributes.MappedAddress, (Address.FAMILY_IPv4, 3478, '192.168.2.1')),
+    (attributes.XorMappedAddress, (Address.FAMILY_IPv4, 3478, '192.168.2.1')),
+    (attributes.XorMappedAddress, (Address.FAMILY_IPv6, 3478, '2001:db8::1')),
+    (attributes.AlternateServer, (Address.FAMILY_IPv4, 3478, '192.168.2.1')),
+    (attributes.ResponseOrigin, (Address.FAMILY_IPv4, 3478, '192.168.2.1')),
+    (attributes.OtherAddress, (Address.FAMILY_IPv4, 3478, '192.168.2.1')),
+    (attributes.Username, ('username',)),
+    (attributes.Realm, (b'realm',)),
+    (attributes.Nonce, (b'0123456789abcdef0123456789abcdef',)),
+    (attributes.Software, ('sturn',)),
+    (attributes.ErrorCode, stun.ERR_UNAUTHORIZED),
+    (attributes.UnknownAttributes, ([0x0020, 0x0021],)),
+    (turn_attributes.ChannelNumber, (0x4000,)),
+    (turn_attributes.Lifetime, (600,)),
+    (turn_attributes.XorPeerAddress, (Address.FAMILY_IPv4, 40000, '192.168.2.2')),
+    (turn_attributes.Data, (bytes(160),)),
+    (turn_attributes.XorRelayedAddress, (Address.FAMILY_IPv4, 50000, '192.168.2.3')),
+    (turn_attributes.EvenPort, (True,)),
+    (turn_attributes.RequestedTransport, (turn.TRANSPORT_UDP,)),
+    (turn_attributes.DontFragment, (b'',)),
+    (turn_attributes.ReservationToken, (bytes(8),)),
+    )
+
+
+def build_request(writer, msg_method, *attrs):
+    msg = writer.begin(msg_method, stun.CLASS_REQUEST, transaction_id=TRANSACTION_ID)
+    for attr in attrs:
+        msg.add_attr(*attr)
+    return msg
+
+
+def sign(msg, nonce):
+    msg.add_attr(attributes.Username, 'username')
+    msg.add_attr(attributes.Realm, b'realm')
+    msg.add_attr(attributes.Nonce, nonce)
+    msg.add_attr(attributes.MessageIntegrity, KEY)
+    msg.add_attr(attributes.Fingerprint)
+    return msg.finalize()
+
+
+def message_benchmarks():
+    msg = Message.encode(turn.METHOD_CREATE_PERMISSION, stun.CLASS_REQUEST,
+                         transaction_id=TRANSACTION_ID)
+    for i in range(4):
+        msg.add_attr(turn_attributes.XorPeerAddress, Address.FAMILY_IPv4,
+                     40000 + i, '192.168.2.{}'.format(i + 2))
+    msg.add_attr(attributes.Username, 'username')
+    msg.add_attr(attributes.Realm, b'realm')
+    msg.add_attr(attributes.Nonce, bytes(40))
+    msg.add_attr(attributes.MessageIntegrity, KEY)
+    msg.add_attr(attributes.Fingerprint)
+    data = bytes(msg)
+    writer = MessageWriter()
+
+    def encode():
+        msg = Message.encode(stun.METHOD_BINDING, stun.CLASS_RESPONSE_SUCCESS,
+                             transaction_id=TRANSACTION_ID)
+        msg.add_attr(attributes.XorMappedAddress, Address.FAMILY_IPv4, 54321, '192.168.2.1')
+        msg.add_attr(attributes.Software, 'sturn')
+        msg.add_attr(attributes.Fingerprint)
+        return msg
+
+    def write():
+        msg = writer.begin(stun.METHOD_BINDING, stun.CLASS_RESPONSE_SUCCESS,
+                           transaction_id=TRANSACTION_ID)
+        msg.add_attr(attributes.XorMappedAddress, Address.FAMILY_IPv4, 54321, '192.168.2.1')
+        msg.add_attr(attributes.Software, 'sturn')
+        msg.add_attr(attributes.Fingerprint)
+        return msg.finalize()
+
+    yield 'message.encode', encode
+    yield 'message.writer', write
+    yield 'message.decode', lambda: Message.decode(data)
+    yield 'message.decode_lazy', lambda: Message.decode(data, lazy=True)
+    view = Message.decode(data, lazy=True)
+    yield 'message.get_attr', lambda: view.get_attr(stun.ATTR_USERNAME)
+    yield 'message.decode_many[64]', lambda: Message.decode_many([data] * 64)
+
+
+def attribute_benchmarks():
+    msg = Message.encode(stun.METHOD_BINDING, stun.CLASS_REQUEST, transaction_id=TRANSACTION_ID)
+    for attr_cls, args in ATTRIBUTES:
+        name = attr_cls.__name__
+        if attr_cls is attributes.XorMappedAddress and args[0] == Address.FAMILY_IPv6:
+            name += '6'
+        value = bytes(attr_cls.encode(msg, *args))
+        # XOR-ed addresses are decoded against the header of their message
+        data = bytes(msg[:20]) + bytes(4) + value
+        yield 'attr.{}.encode'.format(name), lambda attr_cls=attr_cls, args=args: \
+            attr_cls.encode(msg, *args)
+        yield 'attr.{}.decode'.format(name), lambda attr_cls=attr_cls, data=data: \
+            attr_cls.decode(data, 24, len(data) - 24)
+
+
+def integrity_benchmarks():
+    writer = MessageWriter()
+    msg = build_request(writer, turn.METHOD_REFRESH, (turn_attributes.Lifetime, 600))
+    data = sign(msg, bytes(40))
+    view = Message.decode(data, lazy=True)
+    crc_data = data[:-8]
+    mi_data = data[:-32]
+    yield 'integrity.compute', lambda: attributes.MessageIntegrity.compute(KEY, mi_data)
+    yield 'integrity.verify', lambda: attributes.MessageIntegrity.verify(view, KEY)
+    yield 'fingerprint.compute', lambda: attributes.Fingerprint.compute(crc_data)
+
+
+def handler_benchmarks():
+    driver = ManualDriver()
+    credential_mechanism = LongTermCredentialMechanism(
+        b'realm', {'username': {'password': 'password'}})
+    server = TurnUdpServer('127.0.0.1', 3478, 'sturn', credential_mechanism, {},
+                           (50000, 50099))
+    # Every iteration replays the same transaction, don't answer it from the cache
+    server.response_cache.max_bytes = 0
+    driver.connect(server)
+    nonce = credential_mechanism.nonces.generate(CLIENT_ADDR)
+    writer = MessageWriter()
+    peer = (turn_attributes.XorPeerAddress, Address.FAMILY_IPv4,
+            PEER_ADDR[1], PEER_ADDR[0])
+
+    binding = build_request(writer, stun.METHOD_BINDING).finalize()
+    unauthenticated = build_request(writer, turn.METHOD_ALLOCATE,
+                                    (turn_attributes.RequestedTransport, turn.TRANSPORT_UDP))
+    unauthenticated.add_attr(attributes.Fingerprint)
+    unauthenticated = unauthenticated.finalize()
+    allocate = sign(build_request(writer, turn.METHOD_ALLOCATE,
+                                  (turn_attributes.RequestedTransport, turn.TRANSPORT_UDP)),
+                    nonce)
+    deallocate = sign(build_request(writer, turn.METHOD_REFRESH,
+                                    (turn_attributes.Lifetime, 0)), nonce)
+    refresh = sign(build_request(writer, turn.METHOD_REFRESH,
+                                 (turn_attributes.Lifetime, 600)), nonce)
+    create_permission = sign(build_request(writer, turn.METHOD_CREATE_PERMISSION, peer), nonce)
+    channel_bind = sign(build_request(writer, turn.METHOD_CHANNEL_BIND,
+                                      (turn_attributes.ChannelNumber, 0x4000), peer), nonce)
+    send = writer.begin(turn.METHOD_SEND, stun.CLASS_INDICATION)
+    send.add_attr(*peer)
+    send.write_attr(turn.ATTR_DATA, bytes(160))
+    send = send.finalize()
+    channel_data = b'\x40\x00\x00\xa0' + bytes(160)
+
+    def round_trip(*requests):
+        def run():
+            for request in requests:
+                server.datagram_received(request, CLIENT_ADDR, driver.now)
+            driver.drain()
+        return run
+
+    yield 'handler.binding', round_trip(binding)
+    yield 'handler.challenge', round_trip(unauthenticated)
+    yield 'handler.allocate+deallocate', round_trip(allocate, deallocate)
+    round_trip(allocate, create_permission, channel_bind)()
+    relay = server._relays[CLIENT_ADDR]
+    yield 'handler.refresh', round_trip(refresh)
+    yield 'handler.create_permission', round_trip(create_permission)
+    yield 'handler.channel_bind', round_trip(channel_bind)
+    yield 'relay.send_indication', round_trip(send)
+    yield 'relay.channel_data', round_trip(channel_data)
+
+    def peer_data():
+        relay.datagram_received(bytes(160), PEER_ADDR, driver.now)
+        driver.drain()
+    yield 'relay.peer_to_channel', peer_data
+
+
+BENCHMARKS = (message_benchmarks, attribute_benchmarks, integrity_benchmarks,
+              handler_benchmarks)
+
+
+def measure(func, repeat, min_time=.1):
+    timer = timeit.Timer(func)
+    number, _elapsed = timer.autorange()
+    number = max(1, int(number * min_time / .2))
+    timings = [elapsed / number for elapsed in timer.repeat(repeat, number)]
+    return {
+        'number': number,
+        'min': min(timings),
+        'mean': statistics.mean(timings),
+        'stdev': statistics.stdev(timings) if repeat > 1 else 0.,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-o', '--output', help="Save the results as JSON")
+    parser.add_argument('-c', '--compare', help="Compare with the results of an earlier run")
+    parser.add_argument('-k', '--filter', default='', help="Run benchmarks whose name contains FILTER")
+    parser.add_argument('-r', '--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as fp:
+            baseline = json.load(fp)['benchmarks']
+
+    results = {}
+    for benchmarks in BENCHMARKS:
+        for name, func in benchmarks():
+            if args.filter not in name:
+                continue
+            result = results[name] = measure(func, args.repeat)
+            line = "{:32s} {:10.3f}us +- {:.3f}".format(
+                name, result['mean'] * 1e6, result['stdev'] * 1e6)
+            if name in baseline:
+                line += "  {:.2f}x".format(baseline[name]['mean'] / result['mean'])
+            print(line)
+            sys.stdout.flush()
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump({
+                'python': platform.python_version(),
+                'implementation': platform.python_implementation(),
+                'machine': platform.machine(),
+                'timestamp': time.time(),
+                'benchmarks': results,
+                }, fp, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env vpython3
+"""Microbenchmark of Message.get_attr on messages with 8-12 attributes
+Compares the type index against the previous linear scan of _attributes.
+Usage:
+    {0} [NUMBER]
+"""
+import os
+import sys
+import timeit
+from sturn import stun, turn
+from sturn.stun.agent import Message, Address
+from sturn.stun import attributes
+from sturn.turn import attributes as turn_attributes
+
+
+def linear_get_attr(msg, *attr_types):
+    for attr in msg._attributes:
+        if attr.type in attr_types:
+            return attr
+
+
+def build_message(num_peers):
+    msg = Message.encode(turn.METHOD_CREATE_PERMISSION, stun.CLASS_REQUEST)
+    for i in range(num_peers):
+        msg.add_attr(turn_attributes.XorPeerAddress, Address.FAMILY_IPv4,
+                     10000 + i, '192.168.2.{}'.format(i + 1))
+    msg.add_attr(attributes.Username, 'username')
+    msg.add_attr(attributes.Realm, b'realm')
+    msg.add_attr(attributes.Nonce, b'0123456789abcdef')
+    msg.add_attr(attributes.Software, 'sturn')
+    msg.add_attr(attributes.MessageIntegrity, b'0123456789abcdef')
+    msg.add_attr(attributes.Fingerprint)
+    return Message.decode(bytes(msg))
+
+
+LOOKUPS = (
+    (stun.ATTR_USERNAME,),
+    (stun.ATTR_NONCE,),
+    (stun.ATTR_REALM,),
+    (stun.ATTR_MESSAGE_INTEGRITY,),
+    (stun.ATTR_XOR_MAPPED_ADDRESS, stun.ATTR_MAPPED_ADDRESS),
+    )
+
+
+def main(number=100000):
+    for num_peers in (2, 4, 6):
+        msg = build_message(num_peers)
+        count = len(msg._attributes)
+        linear = timeit.timeit(
+            lambda: [linear_get_attr(msg, *types) for types in LOOKUPS],
+            number=number)
+        indexed = timeit.timeit(
+            lambda: [msg.get_attr(*types) for types in LOOKUPS],
+            number=number)
+        print("{:2d} attributes: linear {:.3f}us indexed {:.3f}us ({:.1f}x)".format(
+            count, linear / number * 1e6, indexed / number * 1e6, linear / indexed))
+
+
+if __name__ == '__main__':
+    try:
+        number, = [int(arg) for arg in sys.argv[1:]] or [100000]
+    except ValueError:
+        exit(__doc__.format(os.path.basename(__file__)))
+    main(number)
@@ -0,0 +1,157 @@
+#!/usr/bin/env vpython3
+"""Probe many STUN servers concurrently
+Binding requests go out from a single socket, --count per server with at
+most --concurrency in flight, and the responses are matched by transaction
+id as they arrive. Reports the RTT distribution and the mapped addresses of
+every server, fastest first.
+Usage:
+    {0} [-f SERVERS] [-n COUNT] [-c CONCURRENCY] [--json] [HOST[:PORT] ...]
+"""
+import sys
+import json
+import socket
+import argparse
+from collections import defaultdict
+from sturn.stun.client import StunUdpClient
+
+
+DEFAULT_PORT = 3478
+
+
+def resolve(servers):
+    """
+    :returns: [(name, (address, port))] of the IPv4 servers which resolve
+    """
+    resolved = []
+    for server in servers:
+        host, _, port = server.rpartition(':') if ':' in server else (server, '', '')
+        try:
+            infos = socket.getaddrinfo(host, int(port or DEFAULT_PORT),
+                                       socket.AF_INET, socket.SOCK_DGRAM)
+        except (socket.gaierror, ValueError) as e:
+            sys.stderr.write("{}: {}\n".format(server, e))
+            continue
+        resolved.append((server, infos[0][4][:2]))
+    return resolved
+
+
+class Probes(object):
+    """Results of the probes per server
+    """
+    def __init__(self, names, verbose=False):
+        self.names = names # addr -> server name
+        self.verbose = verbose
+        self.sent = defaultdict(int)
+        self.rtts = defaultdict(list)
+        self.retransmitted = defaultdict(int)
+        self.mapped = defaultdict(set)
+        self.errors = defaultdict(set)
+
+    def completed(self, transaction, result):
+        addr = transaction.addr
+        self.sent[addr] += 1
+        if isinstance(result, Exception):
+            self.errors[addr].add(str(result))
+        else:
+            self.mapped[addr].add('{}:{}'.format(*result))
+            if transaction.rtt is None:
+                self.retransmitted[addr] += 1
+            else:
+                self.rtts[addr].append(transaction.rtt)
+        if self.verbose:
+            rtt = transaction.rtt
+            sys.stderr.write("{} {} {}\n".format(
+                self.names[addr], 'retransmitted' if rtt is None else '{:.3f}ms'.format(rtt * 1e3),
+                result))
+
+    def summary(self):
+        servers = []
+        for addr, name in self.names.items():
+            rtts = sorted(self.rtts[addr])
+            answered = len(rtts) + self.retransmitted[addr]
+            servers.append({
+                'server': name,
+                'address': '{}:{}'.format(*addr),
+                'sent': self.sent[addr],
+                'answered': answered,
+                'loss': 1 - answered / self.sent[addr] if self.sent[addr] else 1.,
+                'retransmitted': self.retransmitted[addr],
+                'rtt_ms': {
+                    'min': rtts[0] * 1e3,
+                    'p50': rtts[len(rtts) // 2] * 1e3,
+                    'p90': rtts[min(len(rtts) - 1, len(rtts) * 9 // 10)] * 1e3,
+                    'max': rtts[-1] * 1e3,
+                    } if rtts else None,
+                'mapped': sorted(self.mapped[addr]),
+                'errors': sorted(self.errors[addr]),
+                })
+        servers.sort(key=lambda server: (server['rtt_ms'] is None,
+                                         server['rtt_ms'] and server['rtt_ms']['p50']))
+        return servers
+
+
+def report(servers, out=sys.stdout):
+    out.write("{:32s} {:>5s} {:>6s} {:>8s} {:>8s} {:>8s} {:>8s}  {}\n".format(
+        'server', 'sent', 'loss', 'min ms', 'p50 ms', 'p90 ms', 'max ms', 'mapped'))
+    for server in servers:
+        rtt = server['rtt_ms']
+        rtts = ("{min:8.2f} {p50:8.2f} {p90:8.2f} {max:8.2f}".format(**rtt) if rtt else
+                "{:>8s} {:>8s} {:>8s} {:>8s}".format(*'----'))
+        out.write("{:32s} {:5d} {:6.1%} {}  {}\n".format(
+            server['server'], server['sent'], server['loss'], rtts,
+            ' '.join(server['mapped']) or ', '.join(server['errors'])))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('servers', nargs='*', metavar='HOST[:PORT]')
+    parser.add_argument('-f', '--file', help="File of servers, one per line")
+    parser.add_argument('-n', '--count', type=int, default=5, help="Probes per server")
+    parser.add_argument('-c', '--concurrency', type=int, default=256,
+                        help="Maximum transactions in flight")
+    parser.add_argument('--interface', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=0, help="Local port")
+    parser.add_argument('--rc', type=int, default=3,
+                        help="Requests sent per probe before it times out")
+    parser.add_argument('--rm', type=int, default=4,
+                        help="Timeout after the last request, in initial RTOs")
+    parser.add_argument('--json', action='store_true', help="Print the results as JSON")
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help="Print every probe result as it arrives")
+    args = parser.parse_args()
+
+    servers = list(args.servers)
+    if args.file:
+        with open(args.file) as fp:
+            servers.extend(line.strip() for line in fp
+                           if line.strip() and not line.startswith('#'))
+    resolved = resolve(servers)
+    if not resolved:
+        parser.error("no servers to probe")
+    names = {} # addr -> the first name resolving to it
+    for name, addr in resolved:
+        names.setdefault(addr, name)
+
+    from twisted.internet import reactor
+    from sturn import udp
+    client = StunUdpClient(args.interface, args.port, Rc=args.rc, Rm=args.rm)
+    udp.listen(reactor, client)
+    probes = Probes(names, args.verbose)
+
+    def done(result):
+        reactor.stop()
+        return result
+    reactor.callWhenRunning(lambda: udp.deferred(client.bind_many(
+        list(names), args.count, args.concurrency, probes.completed)).addBoth(done))
+    reactor.run()
+
+    servers = probes.summary()
+    if args.json:
+        json.dump(servers, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    else:
+        report(servers)
+
+
+if __name__ == '__main__':
+    main()
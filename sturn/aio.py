@@ -0,0 +1,278 @@
+"""asyncio driver of the sans-IO protocols over UDP
+The STUN/TURN protocols run on an asyncio (or uvloop) event loop without
+twisted: the sockets are read by the loop in batches, handed to the protocol
+with loop.time(), and the protocol's timer is a loop.call_later.
+"""
+import signal
+import socket
+import asyncio
+import logging
+from . import driver, mmsg
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+
+logger = logging.getLogger(__name__)
+
+
+def new_event_loop(use_uvloop=False):
+    """
+    :param use_uvloop: Use an uvloop event loop, if installed
+    """
+    if use_uvloop:
+        if uvloop is None:
+            raise RuntimeError("uvloop is not installed")
+        return uvloop.new_event_loop()
+    return asyncio.new_event_loop()
+
+
+def bind_udp(interface, port, reuse_port=False):
+    """
+    :param reuse_port: Share the port with other processes through SO_REUSEPORT
+    :returns: the bound non-blocking socket
+    :raises OSError: the port is unavailable
+    """
+    family = socket.AF_INET6 if ':' in interface else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_DGRAM)
+    try:
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((interface, port))
+    except OSError:
+        sock.close()
+        raise
+    sock.setblocking(False)
+    return sock
+
+
+class UdpEndpoint(object):
+    """UDP socket read by the event loop
+    With a batch_size, a readable socket is read in batches (one recvmmsg
+    call each where available) handed to receiver.datagrams_received, and
+    the datagrams written meanwhile are sent together once the batch is
+    handled (with sendmmsg where available). Without, each datagram goes to
+    receiver.datagram_received and writes are sent right away.
+    """
+    max_reads = 256 # Datagrams read per readable event
+
+    def __init__(self, loop, sock, receiver, batch_size=0, max_size=8192):
+        self.loop = loop
+        self.socket = sock
+        self.receiver = receiver
+        self.port = sock.getsockname()[1]
+        self.batch_size = batch_size
+        self.max_size = max_size
+        self.mmsg = None
+        if batch_size and mmsg.available:
+            self.mmsg = mmsg.MMsgSocket(sock, batch_size, max_size)
+        self._queue = []
+        self._reading = False
+        self._flush_handle = None
+        self.connected = True
+        loop.add_reader(sock.fileno(), self._read)
+
+    def _read(self):
+        if not self.batch_size:
+            self._read_datagrams()
+            return
+        self._reading = True
+        try:
+            reads = 0
+            while reads < self.max_reads:
+                batch, full = self._receive()
+                reads += self.batch_size
+                if batch:
+                    try:
+                        self.receiver.datagrams_received(batch)
+                    except Exception:
+                        logger.exception("Unhandled error in %s.datagrams_received",
+                                         type(self.receiver).__name__)
+                    finally:
+                        self.flush()
+                if not full:
+                    break
+        finally:
+            self._reading = False
+
+    def _receive(self):
+        if self.mmsg is not None:
+            return self.mmsg.receive()
+        recvfrom = self.socket.recvfrom
+        batch = []
+        while len(batch) < self.batch_size:
+            try:
+                datagram, addr = recvfrom(self.max_size)
+            except (BlockingIOError, InterruptedError):
+                return batch, False
+            except ConnectionRefusedError:
+                continue
+            batch.append((datagram, addr[:2]))
+        return batch, True
+
+    def _read_datagrams(self):
+        recvfrom = self.socket.recvfrom
+        for _ in range(self.max_reads):
+            try:
+                datagram, addr = recvfrom(self.max_size)
+            except (BlockingIOError, InterruptedError):
+                return
+            except ConnectionRefusedError:
+                continue
+            try:
+                self.receiver.datagram_received(datagram, addr[:2])
+            except Exception:
+                logger.exception("Unhandled error in %s.datagram_received",
+                                 type(self.receiver).__name__)
+
+    def write(self, datagram, addr):
+        if not self.batch_size:
+            self._send(datagram, addr)
+            return
+        self._queue.append((bytes(datagram), addr))
+        if len(self._queue) >= self.batch_size:
+            self.flush()
+        elif not self._reading and self._flush_handle is None:
+            self._flush_handle = self.loop.call_soon(self.flush)
+
+    def _send(self, datagram, addr):
+        try:
+            self.socket.sendto(datagram, addr)
+        except (BlockingIOError, InterruptedError, ConnectionRefusedError) as e:
+            logger.debug("Dropping datagram to %s:%d: %s", addr[0], addr[1], e)
+
+    def flush(self):
+        """Send the queued datagrams
+        """
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        queue = self._queue
+        if not queue:
+            return
+        self._queue = []
+        if self.mmsg is not None:
+            for start in range(0, len(queue), self.batch_size):
+                self.mmsg.send(queue[start:start+self.batch_size])
+            return
+        for datagram, addr in queue:
+            try:
+                self._send(datagram, addr)
+            except OSError as e:
+                logger.debug("Dropping datagram to %s:%d: %s", addr[0], addr[1], e)
+
+    def close(self):
+        if not self.connected:
+            return
+        self.flush()
+        self.loop.remove_reader(self.socket.fileno())
+        self.connected = False
+        self.socket.close()
+
+
+class DatagramDriver(driver.Driver):
+    """Runs a STUN protocol on a UDP port of the event loop
+    """
+
+    def __init__(self, loop, protocol):
+        driver.Driver.__init__(self, protocol)
+        self.loop = loop
+        self.endpoint = None
+
+    def seconds(self):
+        return self.loop.time()
+
+    def call_later(self, delay, f):
+        return self.loop.call_later(delay, f)
+
+    def write(self, datagram, addr):
+        try:
+            self.endpoint.write(datagram, addr)
+        except OSError as e:
+            self.send_errors += 1
+            logger.debug("Dropping datagram to %s:%d: %s", addr[0], addr[1], e)
+
+    def close(self):
+        self.endpoint.close()
+        self.stop_protocol()
+
+
+class _RelayPort(object):
+    def __init__(self, sockets, port):
+        self.sockets = sockets
+        self.port = port
+
+    def datagram_received(self, datagram, addr):
+        self.sockets.datagram_received(self.port, datagram, addr)
+
+    def datagrams_received(self, datagrams):
+        self.sockets.datagrams_received(self.port, datagrams)
+
+
+class RelaySockets(driver.RelaySockets):
+    """UDP sockets of the event loop bound for a RelayPortPool
+    """
+
+    def __init__(self, loop, pool, interface='', batch_size=0):
+        driver.RelaySockets.__init__(self, pool)
+        self.loop = loop
+        self.interface = interface
+        self.batch_size = batch_size
+        self.endpoints = {} # port -> UdpEndpoint
+
+    def seconds(self):
+        return self.loop.time()
+
+    def bind(self, port):
+        try:
+            sock = bind_udp(self.interface, port)
+        except OSError:
+            return False
+        self.endpoints[port] = UdpEndpoint(self.loop, sock, _RelayPort(self, port),
+                                           self.batch_size)
+        return True
+
+    def close(self, port):
+        endpoint = self.endpoints.pop(port, None)
+        if endpoint is not None:
+            endpoint.close()
+
+    def write(self, port, datagram, addr):
+        endpoint = self.endpoints.get(port)
+        if endpoint is None:
+            return
+        try:
+            endpoint.write(datagram, addr)
+        except OSError as e:
+            self.send_errors += 1
+            logger.debug("Dropping datagram to %s:%d: %s", addr[0], addr[1], e)
+
+
+def listen(loop, protocol, reuse_port=False, batch_size=0):
+    """Run a STUN protocol on its UDP port
+    :param batch_size: Read and write batches of up to batch_size datagrams
+    :returns: the DatagramDriver, driver.endpoint.port is the bound port
+    :raises OSError: the port is unavailable
+    """
+    pool = getattr(protocol, 'ports', None)
+    if pool is not None and pool.sockets is None:
+        RelaySockets(loop, pool, protocol.interface, batch_size)
+    sock = bind_udp(protocol.interface, protocol.port, reuse_port)
+    datagram_driver = DatagramDriver(loop, protocol)
+    datagram_driver.endpoint = UdpEndpoint(loop, sock, datagram_driver, batch_size)
+    datagram_driver.start_protocol()
+    return datagram_driver
+
+
+def run(loop):
+    """Run the loop until interrupted by SIGINT or SIGTERM
+    """
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, loop.stop)
+    try:
+        loop.run_forever()
+    finally:
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.remove_signal_handler(signum)
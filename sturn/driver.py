@@ -0,0 +1,151 @@
+"""Drivers of the sans-IO protocols
+The STUN/TURN protocols and the relay port pool do no I/O. A driver feeds
+them the datagrams read from its sockets with the time, sends the datagrams
+they queue and calls their timer when it is due. The event loop (twisted
+or asyncio) and its sockets are left to the subclasses.
+"""
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+class Driver(object):
+    """Runs a protocol over a socket of an event loop
+    Datagrams the protocol queues while handling an input of the driver are
+    sent once it returns, the ones it queues otherwise (relayed data, client
+    requests) are sent right away.
+    """
+
+    def __init__(self, protocol):
+        self.protocol = protocol
+        self.send_errors = 0
+        self._receiving = False
+        self._deadline = None
+        self._timer_call = None
+
+    def seconds(self):
+        raise NotImplementedError
+
+    def call_later(self, delay, f):
+        """
+        :returns: the scheduled call, with a cancel method
+        """
+        raise NotImplementedError
+
+    def write(self, datagram, addr):
+        raise NotImplementedError
+
+    def start_protocol(self):
+        """Start the protocol once its socket is bound
+        """
+        protocol = self.protocol
+        protocol.clock = self.seconds
+        protocol.wakeup = self.transmit
+        protocol.start(self.seconds())
+        self.transmit()
+
+    def stop_protocol(self):
+        if self._timer_call is not None:
+            self._timer_call.cancel()
+            self._timer_call = None
+        self._deadline = None
+        self.protocol.wakeup = None
+        self.protocol.stop()
+
+    def datagram_received(self, datagram, addr):
+        self._receiving = True
+        try:
+            self.protocol.datagram_received(datagram, addr, self.seconds())
+        finally:
+            self._receiving = False
+            self.transmit()
+
+    def datagrams_received(self, datagrams):
+        self._receiving = True
+        try:
+            self.protocol.datagrams_received(datagrams, self.seconds())
+        finally:
+            self._receiving = False
+            self.transmit()
+
+    def transmit(self):
+        """Send the datagrams of the protocol and arm its timer
+        """
+        if self._receiving:
+            return
+        for datagram, addr in self.protocol.datagrams_to_send():
+            self.write(datagram, addr)
+        deadline = self.protocol.get_timer()
+        if deadline != self._deadline:
+            if self._timer_call is not None:
+                self._timer_call.cancel()
+                self._timer_call = None
+            self._deadline = deadline
+            if deadline is not None:
+                self._timer_call = self.call_later(max(0., deadline - self.seconds()),
+                                                   self._handle_timer)
+
+    def _handle_timer(self):
+        self._timer_call = None
+        self._deadline = None
+        self._receiving = True
+        try:
+            self.protocol.handle_timer(self.seconds())
+        finally:
+            self._receiving = False
+            self.transmit()
+
+
+class RelaySockets(object):
+    """Sockets of the ports of a RelayPortPool
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.send_errors = 0
+        self._receiving = False
+        pool.sockets = self
+        pool.wakeup = self.transmit
+
+    def seconds(self):
+        raise NotImplementedError
+
+    def bind(self, port):
+        """
+        :returns: False if the port is unavailable
+        """
+        raise NotImplementedError
+
+    def close(self, port):
+        raise NotImplementedError
+
+    def write(self, port, datagram, addr):
+        raise NotImplementedError
+
+    def datagram_received(self, port, datagram, addr):
+        self._receiving = True
+        try:
+            self.pool.datagram_received(port, datagram, addr, self.seconds())
+        finally:
+            self._receiving = False
+            self.transmit()
+
+    def datagrams_received(self, port, datagrams):
+        self._receiving = True
+        try:
+            now = self.seconds()
+            for datagram, addr in datagrams:
+                try:
+                    self.pool.datagram_received(port, datagram, addr, now)
+                except Exception:
+                    logger.exception("Failed to relay a datagram from %s:%d", addr[0], addr[1])
+        finally:
+            self._receiving = False
+            self.transmit()
+
+    def transmit(self):
+        if self._receiving:
+            return
+        for port, datagram, addr in self.pool.datagrams_to_send():
+            self.write(port, datagram, addr)
@@ -0,0 +1,106 @@
+"""Driver without I/O nor event loop
+Time and datagrams are fed in by the caller, the datagrams the protocols
+send are collected in an Outbox per port: for tests and benchmarks.
+"""
+
+
+class Outbox(object):
+    """Port collecting the datagrams sent from it
+    """
+    def __init__(self, driver, port):
+        self.driver = driver
+        self.port = port
+        self.listening = True
+        self._written = []
+
+    @property
+    def written(self):
+        """
+        :returns: the list of (datagram, addr) sent from the port
+        """
+        self.driver.collect()
+        return self._written
+
+
+class ManualDriver(object):
+    """Drives protocols at a time advanced by the caller
+    Feed datagrams to protocol.datagram_received (or datagrams_received)
+    with driver.now and move the time with advance. The datagrams queued by
+    the protocols are collected into the Outbox of their port when one is
+    read, or by drain. Relay ports of TURN protocols are bound here too.
+    """
+
+    def __init__(self, now=0.):
+        self.now = now
+        self.ports = {} # port number -> Outbox
+        self._protocols = [] # (protocol, Outbox)
+        self._pools = []
+
+    def clock(self):
+        return self.now
+
+    def connect(self, protocol, port=None):
+        """Start protocol on a port
+        :param port: Port number, protocol.port if None
+        :returns: the Outbox of the port
+        """
+        if port is None:
+            port = protocol.port
+        outbox = self.ports[port] = Outbox(self, port)
+        pool = getattr(protocol, 'ports', None)
+        if pool is not None and pool.sockets is None:
+            pool.sockets = self
+            self._pools.append(pool)
+        protocol.clock = self.clock
+        self._protocols.append((protocol, outbox))
+        protocol.start(self.now)
+        return outbox
+
+    def bind(self, port):
+        """Bind a relay port
+        :returns: False if the port is in use
+        """
+        if port in self.ports and self.ports[port].listening:
+            return False
+        self.ports[port] = Outbox(self, port)
+        return True
+
+    def close(self, port):
+        self.ports[port].listening = False
+
+    def advance(self, seconds):
+        """Move the time, calling the protocol timers due meanwhile in order
+        """
+        end = self.now + seconds
+        while True:
+            due = [(deadline, i) for i, (protocol, _outbox) in enumerate(self._protocols)
+                   for deadline in (protocol.get_timer(),)
+                   if deadline is not None and deadline <= end]
+            if not due:
+                break
+            deadline, i = min(due)
+            self.now = max(self.now, deadline)
+            self._protocols[i][0].handle_timer(self.now)
+        self.now = end
+
+    def collect(self):
+        """Move the datagrams queued by the protocols to their Outbox
+        """
+        for protocol, outbox in self._protocols:
+            for datagram, addr in protocol.datagrams_to_send():
+                outbox._written.append((bytes(datagram), addr))
+        for pool in self._pools:
+            for port, datagram, addr in pool.datagrams_to_send():
+                self.ports[port]._written.append((bytes(datagram), addr))
+
+    def drain(self):
+        """
+        :returns: list of (local port, datagram, addr) sent since the last drain
+        """
+        self.collect()
+        datagrams = []
+        for port, outbox in self.ports.items():
+            if outbox._written:
+                datagrams.extend((port, datagram, addr) for datagram, addr in outbox._written)
+                del outbox._written[:]
+        return datagrams
@@ -0,0 +1,183 @@
+import json
+import logging
+import threading
+from bisect import bisect_left
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from . import stun, turn
+
+
+logger = logging.getLogger(__name__)
+
+
+METHOD_NAMES = {value: name[7:].lower() for module in (stun, turn)
+                for name, value in vars(module).items() if name.startswith('METHOD_')}
+CLASS_NAMES = {value: name[6:].lower() for name, value in vars(stun).items()
+               if name.startswith('CLASS_')}
+
+# Seconds, from 10us to 1s
+LATENCY_BUCKETS = (.00001, .000025, .00005, .0001, .00025, .0005, .001, .0025,
+                   .005, .01, .025, .05, .1, .25, .5, 1.)
+
+
+class Counter(object):
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Histogram(object):
+    """Counts of observations per bucket, with their sum
+    """
+    __slots__ = ('bounds', 'counts', 'sum')
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1) # last bucket is +Inf
+        self.sum = 0.
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+
+class HandlerMetrics(object):
+    """Metrics of the messages of a (method, class)
+    """
+    __slots__ = ('packets', 'bytes', 'errors', 'drops', 'latency')
+
+    def __init__(self, registry, msg_method, msg_class):
+        labels = {'method': METHOD_NAMES.get(msg_method, '{:#05x}'.format(msg_method)),
+                  'class': CLASS_NAMES.get(msg_class, '{:#04x}'.format(msg_class))}
+        self.packets = registry.counter('sturn_messages_total',
+                                        "STUN messages handled", **labels)
+        self.bytes = registry.counter('sturn_message_bytes_total',
+                                      "Bytes of the STUN messages handled", **labels)
+        self.errors = registry.counter('sturn_error_responses_total',
+                                       "Error responses to the requests", **labels)
+        self.drops = registry.counter('sturn_dropped_messages_total',
+                                      "Messages discarded, invalid or failing the handler",
+                                      **labels)
+        self.latency = registry.histogram('sturn_handler_seconds',
+                                          "Processing time of the messages", **labels)
+
+    def observe(self, size, seconds):
+        self.packets.value += 1
+        self.bytes.value += size
+        self.latency.observe(seconds)
+
+
+class Registry(object):
+    """Metrics exposed in the Prometheus text format or as JSON
+    Counters and histograms are updated in place on the hot path, gauges
+    (and function backed counters) are only evaluated when collected.
+    :see: https://prometheus.io/docs/instrumenting/exposition_formats/
+    """
+
+    def __init__(self):
+        self._metrics = {} # name -> (type, help, [(labels, metric)])
+
+    def _register(self, name, metric_type, help, labels, metric):
+        _type, _help, metrics = self._metrics.setdefault(name, (metric_type, help, []))
+        metrics.append((labels, metric))
+        return metric
+
+    def counter(self, name, help, function=None, **labels):
+        """
+        :param function: Callable returning the value, instead of a Counter
+        """
+        return self._register(name, 'counter', help, labels, function or Counter())
+
+    def gauge(self, name, help, function, **labels):
+        return self._register(name, 'gauge', help, labels, function)
+
+    def histogram(self, name, help, bounds=LATENCY_BUCKETS, **labels):
+        return self._register(name, 'histogram', help, labels, Histogram(bounds))
+
+    @staticmethod
+    def _value(metric):
+        return metric.value if isinstance(metric, Counter) else metric()
+
+    @staticmethod
+    def _labels(labels, **extra):
+        labels = dict(labels, **extra)
+        if not labels:
+            return ''
+        return '{' + ','.join('{}="{}"'.format(name, value)
+                              for name, value in sorted(labels.items())) + '}'
+
+    def render(self):
+        """
+        :returns: the metrics in the Prometheus text format
+        """
+        lines = []
+        for name, (metric_type, help, metrics) in sorted(self._metrics.items()):
+            lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} {}'.format(name, metric_type))
+            for labels, metric in list(metrics):
+                if metric_type != 'histogram':
+                    lines.append('{}{} {}'.format(name, self._labels(labels), self._value(metric)))
+                    continue
+                cumulative = 0
+                for bound, count in zip(metric.bounds + ('+Inf',), metric.counts):
+                    cumulative += count
+                    lines.append('{}_bucket{} {}'.format(
+                        name, self._labels(labels, le=bound), cumulative))
+                lines.append('{}_sum{} {}'.format(name, self._labels(labels), metric.sum))
+                lines.append('{}_count{} {}'.format(name, self._labels(labels), cumulative))
+        return '\n'.join(lines) + '\n'
+
+    def as_dict(self):
+        """
+        :returns: {name{labels}: value}, histograms as their sum and count
+        """
+        values = {}
+        for name, (metric_type, _help, metrics) in self._metrics.items():
+            for labels, metric in list(metrics):
+                key = name + self._labels(labels)
+                if metric_type == 'histogram':
+                    values[key + '_sum'] = metric.sum
+                    values[key + '_count'] = metric.count
+                else:
+                    values[key] = self._value(metric)
+        return values
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        registry = self.server.registry
+        if self.path == '/metrics':
+            body = registry.render().encode('utf-8')
+            content_type = 'text/plain; version=0.0.4'
+        elif self.path == '/metrics.json':
+            body = json.dumps(registry.as_dict()).encode('utf-8')
+            content_type = 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+def serve(registry, port, interface='127.0.0.1'):
+    """Serve /metrics (Prometheus text) and /metrics.json from a daemon thread
+    :returns: the HTTPServer
+    """
+    httpd = HTTPServer((interface, port), _MetricsRequestHandler)
+    httpd.registry = registry
+    thread = threading.Thread(target=httpd.serve_forever, name='metrics', daemon=True)
+    thread.start()
+    return httpd
@@ -0,0 +1,179 @@
+import errno
+import ctypes
+import socket
+import struct
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+class iovec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p),
+                ('iov_len', ctypes.c_size_t)]
+
+
+class msghdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p),
+                ('msg_namelen', ctypes.c_uint32),
+                ('msg_iov', ctypes.POINTER(iovec)),
+                ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p),
+                ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags', ctypes.c_int)]
+
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', msghdr),
+                ('msg_len', ctypes.c_uint)]
+
+
+_libc = ctypes.CDLL(None, use_errno=True)
+available = hasattr(_libc, 'recvmmsg') and hasattr(_libc, 'sendmmsg')
+if available:
+    _recvmmsg = _libc.recvmmsg
+    _recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint,
+                          ctypes.c_int, ctypes.c_void_p]
+    _sendmmsg = _libc.sendmmsg
+    _sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint,
+                          ctypes.c_int]
+
+MSG_TRUNC = 0x20
+MSG_DONTWAIT = 0x40
+SOCKADDR_SIZE = 128 # sizeof(struct sockaddr_storage)
+
+_sockaddr_family = struct.Struct('=H')
+_sockaddr_in = struct.Struct('=H2s4s')      # family, port, address
+_sockaddr_in6 = struct.Struct('=H2s4x16sL') # family, port, flowinfo, address, scope id
+
+
+def _decode_sockaddr(buf, offset):
+    family, = _sockaddr_family.unpack_from(buf, offset)
+    if family == socket.AF_INET:
+        _family, port, address = _sockaddr_in.unpack_from(buf, offset)
+        return socket.inet_ntop(socket.AF_INET, address), port[0] << 8 | port[1]
+    _family, port, address, _scope_id = _sockaddr_in6.unpack_from(buf, offset)
+    return socket.inet_ntop(socket.AF_INET6, address), port[0] << 8 | port[1]
+
+
+def _encode_sockaddr(buf, offset, family, addr):
+    host, port = addr[:2]
+    if family == socket.AF_INET:
+        _sockaddr_in.pack_into(buf, offset, family, port.to_bytes(2, 'big'),
+                               socket.inet_pton(family, host))
+        return 16
+    _sockaddr_in6.pack_into(buf, offset, family, port.to_bytes(2, 'big'),
+                            socket.inet_pton(family, host), 0)
+    return 28
+
+
+class _MessageVector(object):
+    """Preallocated mmsghdr array with a buffer and a sockaddr per message
+    """
+    def __init__(self, count, size):
+        self.count = count
+        self.size = size
+        self.buffer = bytearray(count * size)
+        self.names = bytearray(count * SOCKADDR_SIZE)
+        self.headers = (mmsghdr * count)()
+        self._iovecs = (iovec * count)()
+        buffer_base = ctypes.addressof((ctypes.c_char * len(self.buffer)).from_buffer(self.buffer))
+        names_base = ctypes.addressof((ctypes.c_char * len(self.names)).from_buffer(self.names))
+        for i in range(count):
+            self._iovecs[i].iov_base = buffer_base + i * size
+            self._iovecs[i].iov_len = size
+            hdr = self.headers[i].msg_hdr
+            hdr.msg_name = names_base + i * SOCKADDR_SIZE
+            hdr.msg_namelen = SOCKADDR_SIZE
+            hdr.msg_iov = ctypes.pointer(self._iovecs[i])
+            hdr.msg_iovlen = 1
+
+
+_receive_vectors = {} # (count, size) -> _MessageVector
+
+
+def _receive_vector(count, size):
+    """Receive vector shared by the sockets of the process
+    Batches are copied out before they are handed to a protocol, so the
+    sockets, all read by the event loop thread, can use the same buffers.
+    """
+    vector = _receive_vectors.get((count, size))
+    if vector is None:
+        vector = _receive_vectors[count, size] = _MessageVector(count, size)
+    return vector
+
+
+class MMsgSocket(object):
+    """Non-blocking UDP socket read and written in batches of datagrams
+    The I/O of the batching transports of the event loops: a batch is read
+    with one recvmmsg call into reusable buffers, and datagrams are sent with
+    as few sendmmsg calls as possible.
+    :see: http://man7.org/linux/man-pages/man2/recvmmsg.2.html
+    """
+
+    def __init__(self, sock, batch_size=64, max_size=8192):
+        self.socket = sock
+        self.batch_size = batch_size
+        self._recv = _receive_vector(batch_size, max_size)
+        self._send = _MessageVector(batch_size, 0)
+
+        # Syscall counters
+        self.recv_calls = 0
+        self.send_calls = 0
+        self.truncated = 0 # datagrams over max_size, dropped
+
+    def receive(self):
+        """Read a batch
+        :returns: ([(datagram, addr)], whether the batch was full)
+        """
+        vector = self._recv
+        headers = vector.headers
+        buf = vector.buffer
+        count = _recvmmsg(self.socket.fileno(), headers, vector.count, MSG_DONTWAIT, None)
+        self.recv_calls += 1
+        if count <= 0:
+            err = ctypes.get_errno()
+            if count < 0 and err not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                logger.warning("recvmmsg failed: %s", errno.errorcode.get(err, err))
+            return [], False
+        batch = []
+        size = vector.size
+        for i in range(count):
+            hdr = headers[i].msg_hdr
+            hdr.msg_namelen = SOCKADDR_SIZE
+            if hdr.msg_flags & MSG_TRUNC:
+                self.truncated += 1
+                continue
+            offset = i * size
+            datagram = bytes(buf[offset:offset + headers[i].msg_len])
+            batch.append((datagram, _decode_sockaddr(vector.names, i * SOCKADDR_SIZE)))
+        return batch, count == vector.count
+
+    def send(self, queue):
+        """Send the (datagram, addr) of queue, at most batch_size of them
+        :param queue: datagrams as bytes
+        """
+        vector = self._send
+        headers = vector.headers
+        family = self.socket.family
+        fd = self.socket.fileno()
+        count = len(queue)
+        for i, (datagram, addr) in enumerate(queue):
+            iov = headers[i].msg_hdr.msg_iov[0]
+            iov.iov_base = ctypes.cast(ctypes.c_char_p(datagram), ctypes.c_void_p).value
+            iov.iov_len = len(datagram)
+            headers[i].msg_hdr.msg_namelen = _encode_sockaddr(
+                vector.names, i * SOCKADDR_SIZE, family, addr)
+        sent = 0
+        while sent < count:
+            result = _sendmmsg(fd, ctypes.byref(headers[sent]), count - sent, MSG_DONTWAIT)
+            self.send_calls += 1
+            if result < 0:
+                err = ctypes.get_errno()
+                if err == errno.EINTR:
+                    continue
+                # Like a full socket buffer on sendto, the datagrams are lost
+                logger.debug("sendmmsg failed: %s, dropping %d datagrams",
+                             errno.errorcode.get(err, err), count - sent)
+                break
+            sent += result
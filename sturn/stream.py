@@ -0,0 +1,320 @@
+"""STUN and TURN over TCP
+:see: http://tools.ietf.org/html/rfc5389#section-7.2.2
+:see: http://tools.ietf.org/html/rfc5766#section-2.1
+"""
+import socket
+import logging
+from twisted.internet.protocol import Protocol, ServerFactory
+from .stun import stun
+from . import turn
+from .driver import Driver
+from .udp import relay_sockets
+
+
+logger = logging.getLogger(__name__)
+
+
+# STUN header and the longest message body
+MAX_FRAME_SIZE = 20 + 0xffff
+
+
+class FramingError(Exception):
+    pass
+
+
+class StreamFramer(object):
+    """Splits STUN messages and ChannelData messages out of a byte stream
+    Received bytes are copied once into a ring buffer and the frames are
+    handed out as memoryviews of the ring, valid until the next frame is
+    taken. Only a frame wrapping around the end of the ring is copied to be
+    contiguous. The ring grows when a single frame does not fit, up to
+    max_size, and shrinks back once it is drained.
+    :see: http://tools.ietf.org/html/rfc5766#section-11.5
+    """
+
+    def __init__(self, size=4096, max_size=MAX_FRAME_SIZE):
+        self.size = size
+        self.max_size = max(max_size, size)
+        self._ring = bytearray(size)
+        self._view = memoryview(self._ring)
+        self._start = 0 # offset of the first buffered byte
+        self._length = 0 # buffered bytes
+        self._needed = 4 # bytes of the next frame, including its padding
+
+    def __len__(self):
+        return self._length
+
+    @property
+    def capacity(self):
+        return len(self._ring)
+
+    def feed(self, data):
+        """Buffer received bytes
+        :returns: generator of the memoryviews of the complete frames
+        :raises FramingError: the stream is neither STUN nor ChannelData
+        """
+        data = memoryview(data)
+        offset = 0
+        while True:
+            offset += self._write(data[offset:])
+            frame = self._next_frame()
+            while frame is not None:
+                yield frame
+                frame = self._next_frame()
+            if offset >= len(data):
+                if not self._length and len(self._ring) > self.size:
+                    self._resize(self.size)
+                return
+            if self._length == len(self._ring):
+                if self._needed > self.max_size:
+                    raise FramingError("Frame of {} bytes".format(self._needed))
+                self._resize(min(self.max_size, max(self._needed, 2 * len(self._ring))))
+
+    def _write(self, data):
+        capacity = len(self._ring)
+        count = min(capacity - self._length, len(data))
+        end = (self._start + self._length) % capacity
+        first = min(count, capacity - end)
+        self._view[end:end+first] = data[:first]
+        self._view[:count-first] = data[first:count]
+        self._length += count
+        return count
+
+    def _resize(self, capacity):
+        ring = bytearray(capacity)
+        first = min(self._length, len(self._ring) - self._start)
+        ring[:first] = self._view[self._start:self._start+first]
+        ring[first:self._length] = self._view[:self._length-first]
+        self._ring = ring
+        self._view = memoryview(ring)
+        self._start = 0
+
+    def _next_frame(self):
+        if self._length < 4:
+            return None
+        ring, start = self._ring, self._start
+        capacity = len(ring)
+        first_byte = ring[start]
+        length = ring[(start + 2) % capacity] << 8 | ring[(start + 3) % capacity]
+        msg_type = first_byte >> 6
+        if msg_type == stun.MSG_STUN:
+            if length & 3:
+                raise FramingError("STUN message length {} not a multiple of 4".format(length))
+            size = padded = 20 + length
+        elif msg_type == turn.MSG_CHANNEL:
+            size = 4 + length
+            padded = (size + 3) & ~3
+        else:
+            raise FramingError("Neither STUN nor ChannelData: {:#04x}".format(first_byte))
+        self._needed = padded
+        if self._length < padded:
+            return None
+
+        if start + size <= capacity:
+            frame = self._view[start:start+size]
+        else:
+            first = capacity - start
+            frame = bytearray(size)
+            frame[:first] = self._view[start:]
+            frame[first:] = self._view[:size-first]
+            frame = memoryview(frame)
+        self._length -= padded
+        self._start = (start + padded) % capacity if self._length else 0
+        self._needed = 4
+        return frame
+
+
+class StreamConnection(Protocol):
+    """TCP connection of a client
+    Writes are coalesced, those made while handling the received data go out
+    with a single writeSequence at its end. While the transport buffers more
+    than its bufferSize, relayed data for the client is dropped.
+    A connection is closed when its first frame, or a started frame, does
+    not complete in time, or when no frame arrives for port.idle_timeout and
+    the protocol lets the connection go.
+    """
+
+    def __init__(self, port, addr):
+        self.port = port
+        self.addr = addr
+        self.framer = StreamFramer()
+        self.paused = False
+        self.frames = 0 # frames received
+        self._pending = []
+        self._receiving = False
+        self._flush_call = None
+        self._timer = None
+        self._checked_frames = 0 # frames at the last timeout check
+
+    def connectionMade(self):
+        self.transport.setTcpNoDelay(True)
+        self.transport.registerProducer(self, True)
+        self._timer = self.port.protocol.timers.schedule(self.port.frame_timeout,
+                                                         self._check_timeout)
+
+    def _check_timeout(self):
+        port = self.port
+        waiting = not self.frames or len(self.framer) # for the first or a partial frame
+        if self.frames != self._checked_frames:
+            self._checked_frames = self.frames
+        elif waiting or port.protocol.connection_idle(self.addr):
+            port.timed_out += 1
+            logger.info("Closing the connection of %s:%d, %s", self.addr[0], self.addr[1],
+                        'timed out waiting for a frame' if waiting else 'idle')
+            self._timer = None
+            self.transport.loseConnection()
+            return
+        self._timer = port.protocol.timers.schedule(
+            port.frame_timeout if waiting else port.idle_timeout, self._check_timeout)
+
+    def dataReceived(self, data):
+        port = self.port
+        datagram_received = port.protocol.datagram_received
+        self._receiving = port._receiving = True
+        try:
+            now = port.seconds()
+            for frame in self.framer.feed(data):
+                self.frames += 1
+                datagram_received(frame, self.addr, now)
+        except FramingError as e:
+            logger.warning("Closing the connection of %s:%d: %s", self.addr[0], self.addr[1], e)
+            self.transport.loseConnection()
+        finally:
+            port._receiving = False
+            port.transmit()
+            self._receiving = False
+        self.flush()
+
+    def write(self, data):
+        if data[0] >> 6 == turn.MSG_CHANNEL:
+            if self.paused:
+                self.port.dropped += 1
+                return
+            if len(data) & 3:
+                # ChannelData is padded to a multiple of 4 bytes over TCP
+                data = bytes(data) + bytes(4 - (len(data) & 3))
+        elif self.paused and data[:2] == b'\x00\x17': # Data indication
+            self.port.dropped += 1
+            return
+        # Responses may be rendered into a bytearray, twisted only writes bytes
+        self._pending.append(data if type(data) is bytes else bytes(data))
+        if not self._receiving and self._flush_call is None:
+            self._flush_call = self.port.reactor.callLater(0, self.flush)
+
+    def flush(self):
+        if self._flush_call is not None:
+            if self._flush_call.active():
+                self._flush_call.cancel()
+            self._flush_call = None
+        if self._pending:
+            pending, self._pending = self._pending, []
+            self.transport.writeSequence(pending)
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+
+    def stopProducing(self):
+        pass
+
+    def connectionLost(self, reason):
+        if self._flush_call is not None and self._flush_call.active():
+            self._flush_call.cancel()
+        self._flush_call = None
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._pending = []
+        self.port.connection_lost(self)
+
+
+class StreamPort(Driver, ServerFactory):
+    """TCP listener driving a STUN protocol in place of its UDP port
+    Frames received from a client are handed to protocol.datagram_received
+    with the client address, the datagrams the protocol sends to the address
+    of a client go to its connection.
+    """
+    connection_class = StreamConnection
+    frame_timeout = 10. # seconds to receive a frame once started, and the first one
+    idle_timeout = 300. # seconds without frames before asking the protocol to close
+
+    def __init__(self, reactor, protocol, family=socket.AF_INET, max_connections=10000):
+        Driver.__init__(self, protocol)
+        self.reactor = reactor
+        self.addressFamily = family
+        self.max_connections = max_connections
+        self.connections = {} # client (host, port) -> StreamConnection
+        self.listening_port = None
+        self.refused = 0 # connections over max_connections
+        self.dropped = 0 # writes to closed or congested connections
+        self.timed_out = 0 # connections closed by the frame or idle timeouts
+
+    def buildProtocol(self, addr):
+        if len(self.connections) >= self.max_connections:
+            self.refused += 1
+            return None
+        connection = self.connection_class(self, (addr.host, addr.port))
+        self.connections[connection.addr] = connection
+        return connection
+
+    def connection_lost(self, connection):
+        if self.connections.get(connection.addr) is connection:
+            del self.connections[connection.addr]
+            self.protocol.connection_closed(connection.addr)
+
+    def getHost(self):
+        return self.listening_port.getHost()
+
+    def seconds(self):
+        return self.reactor.seconds()
+
+    def call_later(self, delay, f):
+        return self.reactor.callLater(delay, f)
+
+    def write(self, datagram, addr):
+        connection = self.connections.get(addr)
+        if connection is None:
+            self.dropped += 1
+            return
+        connection.write(datagram)
+
+    def stopListening(self):
+        for connection in list(self.connections.values()):
+            connection.transport.loseConnection()
+        self.stop_protocol()
+        return self.listening_port.stopListening()
+
+
+def listen(reactor, port, stream_port, interface='', backlog=1024, reuse_port=False):
+    """Listen for the connections of a StreamPort and start its protocol
+    :param reuse_port: Share the port with other processes through SO_REUSEPORT
+    :returns: stream_port
+    """
+    if reuse_port:
+        family = stream_port.addressFamily
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((interface, port))
+        sock.listen(backlog)
+        sock.setblocking(False)
+        # The reactor adopts a duplicate of the descriptor
+        stream_port.listening_port = reactor.adoptStreamPort(sock.fileno(), family, stream_port)
+        sock.close()
+    else:
+        stream_port.listening_port = reactor.listenTCP(port, stream_port, backlog, interface)
+    relay_sockets(reactor, stream_port.protocol)
+    stream_port.start_protocol()
+    return stream_port
+
+
+def listenTCP(reactor, port, protocol, interface='', max_connections=10000, backlog=1024,
+              reuse_port=False):
+    """Serve a STUN protocol over TCP
+    :returns: the StreamPort, the driver of protocol
+    """
+    family = socket.AF_INET6 if ':' in interface else socket.AF_INET
+    stream_port = StreamPort(reactor, protocol, family, max_connections)
+    return listen(reactor, port, stream_port, interface, backlog, reuse_port)
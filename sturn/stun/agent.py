@@ -3,6 +3,28 @@ import socket
 import struct
 from . import stun
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class EntropyPool(object):
+    """Random bytes served from a pool refilled by a single os.urandom call
+    """
+    def __init__(self, size=4096):
+        self._size = size
+        self._pool = b''
+        self._offset = 0
+
+    def __call__(self, length):
+        offset = self._offset
+        if offset + length > len(self._pool):
+            self._pool = os.urandom(max(self._size, length))
+            offset = 0
+        self._offset = offset + length
+        return self._pool[offset:offset+length]
+
 
 class Message(bytearray):
     """STUN message structure
@@ -12,7 +34,7 @@ class Message(bytearray):
     _struct = struct.Struct('>2HL12s')
     _ATTR_TYPE_CLS = {}
 
-    _padding = os.urandom
+    _padding = EntropyPool()
 
     def __init__(self, data, msg_method, msg_class, magic_cookie, transaction_id):
         bytearray.__init__(self, data)
@@ -21,6 +43,7 @@ class Message(bytearray):
         self.magic_cookie = magic_cookie
         self.transaction_id = transaction_id
         self._attributes = []
+        self._index = {} # attr_type -> [attr, ...]
 
     @classmethod
     def encode(cls, msg_method, msg_class, magic_cookie=stun.MAGIC_COOKIE, transaction_id=None, data=''):
@@ -37,20 +60,32 @@ class Message(bytearray):
         self.extend(attr)
         self.extend(self._padding(attr.padding))
         self._attributes.append(attr)
+        self._index.setdefault(attr.type, []).append(attr)
         #update length
         self.length = len(self) - self._struct.size
         return attr
 
     def get_attr(self, *attr_types):
-        for attr in self._attributes:
-            if attr.type in attr_types:
-                return attr
+        """Get the first attribute of the first type in attr_types present
+        """
+        for attr_type in attr_types:
+            attrs = self._index.get(attr_type)
+            if attrs:
+                return attrs[0]
+
+    def get_attrs(self, attr_type):
+        """Get all attributes of attr_type in message order
+        """
+        return list(self._index.get(attr_type, ()))
 
     @classmethod
-    def decode(cls, data):
+    def decode(cls, data, lazy=False):
         """
+        :param lazy: Return a MessageView decoding attributes on demand
         :see: http://tools.ietf.org/html/rfc5389#section-7.3.1
         """
+        if lazy:
+            return MessageView.decode(data)
         assert data[0] >> 6 == stun.MSG_STUN, \
             "Stun message MUST start with 0b00"
         msg_type, msg_length, magic_cookie, transaction_id = cls._struct.unpack_from(data)
@@ -69,6 +104,7 @@ class Message(bytearray):
             clst = cls.get_attr_cls(attr_type)
             attr = clst.decode(data, offset, attr_length)
             msg._attributes.append(attr)
+            msg._index.setdefault(attr_type, []).append(attr)
             #print(clst, type(attr), 'type: %04X/%d'%(attr_type, attr_type), 'offset:', offset, attr)
             try:
                 offset += len(attr)
@@ -80,6 +116,54 @@ class Message(bytearray):
                 pass
         return msg
 
+    @classmethod
+    def decode_many(cls, datagrams, lengths=None):
+        """Decode a batch of datagrams validating all the headers in one pass
+        Datagrams failing validation (not STUN, wrong magic cookie, unaligned
+        or truncated length) are returned as None, the others as MessageView.
+        :param datagrams: Sequence of datagrams, or a single buffer of
+            datagrams packed at a fixed stride if lengths is given
+        :param lengths: Length of each datagram in the packed buffer
+        """
+        if not len(datagrams):
+            return []
+        if lengths is None:
+            buffer = stride = None
+            views = [memoryview(datagram) for datagram in datagrams]
+            lengths = [len(view) for view in views]
+        else:
+            buffer = memoryview(datagrams)
+            stride = len(buffer) // len(lengths) if lengths else 0
+            views = [buffer[i*stride:i*stride+length] for i, length in enumerate(lengths)]
+        if numpy:
+            headers = _decode_headers_numpy(views, lengths, buffer, stride)
+        else:
+            headers = _decode_headers(views, lengths)
+        messages = [None] * len(views)
+        for index, msg_type, msg_length in headers:
+            data = views[index]
+            msg_type &= 0x3fff
+            msg = MessageView(data[:cls._struct.size + msg_length],
+                              msg_type & 0xfeef, msg_type >> 4 & 0x11,
+                              stun.MAGIC_COOKIE, bytes(data[8:20]))
+            try:
+                msg._scan()
+            except AssertionError:
+                continue
+            messages[index] = msg
+        return messages
+
+    @classmethod
+    def encode_many(cls, msg_method, msg_class, transaction_ids, addrs, family=None):
+        """Encode a response carrying only a XOR-MAPPED-ADDRESS for each transaction
+        :param addrs: (host, port) to map for each transaction
+        :param family: Address family of all addresses, defaults to IPv4
+        :returns: list of encoded responses
+        """
+        family = family or Address.FAMILY_IPv4
+        encode = _encode_xor_mapped_numpy if numpy else _encode_xor_mapped
+        return encode(msg_method | msg_class << 4, transaction_ids, addrs, family)
+
     @classmethod
     def get_attr_cls(cls, attr_type):
         attr_cls = cls._ATTR_TYPE_CLS.get(attr_type)
@@ -146,6 +230,214 @@ class Message(bytearray):
         return string
 
 
+class MessageView(object):
+    """Read-only STUN message over a memoryview of the received datagram
+    The attribute headers are scanned once, attribute values are only
+    decoded when requested by get_attr.
+    :see: http://tools.ietf.org/html/rfc5389#section-6
+    """
+
+    _struct = Message._struct
+
+    def __init__(self, data, msg_method, msg_class, magic_cookie, transaction_id):
+        self.data = data
+        self.msg_method = msg_method
+        self.msg_class = msg_class
+        self.magic_cookie = magic_cookie
+        self.transaction_id = transaction_id
+        self._offsets = [] # (attr_type, offset, length)
+        self._index = {} # attr_type -> [index in _offsets, ...]
+        self._decoded = {}
+
+    @classmethod
+    def decode(cls, data):
+        """
+        :see: http://tools.ietf.org/html/rfc5389#section-7.3.1
+        """
+        data = memoryview(data)
+        assert data[0] >> 6 == stun.MSG_STUN, \
+            "Stun message MUST start with 0b00"
+        msg_type, msg_length, magic_cookie, transaction_id = cls._struct.unpack_from(data)
+        assert msg_length % 4 == 0, \
+            "Message not aliged to 4 byte boundary"
+        end = cls._struct.size + msg_length
+        assert end <= len(data), \
+            "Message length exceeds datagram size"
+        msg_type &= 0x3fff
+        msg_method = msg_type & 0xfeef
+        msg_class = msg_type >> 4 & 0x11
+        msg = cls(data[:end], msg_method, msg_class, magic_cookie, transaction_id)
+        msg._scan()
+        return msg
+
+    def _scan(self):
+        data = self.data
+        offset = self._struct.size
+        end = len(data)
+        unpack_from = Attribute.struct.unpack_from
+        offsets = self._offsets
+        index = self._index
+        while offset < end:
+            attr_type, attr_length = unpack_from(data, offset)
+            offset += Attribute.struct.size
+            assert offset + attr_length <= end, \
+                "Attribute {:#06x} exceeds message length".format(attr_type)
+            indices = index.get(attr_type)
+            if indices is None:
+                index[attr_type] = [len(offsets)]
+            else:
+                indices.append(len(offsets))
+            offsets.append((attr_type, offset, attr_length))
+            offset += attr_length + (-attr_length & 3)
+
+    def _decode_attr(self, index):
+        attr = self._decoded.get(index)
+        if attr is None:
+            attr_type, offset, length = self._offsets[index]
+            attr_cls = Message.get_attr_cls(attr_type)
+            attr = self._decoded[index] = attr_cls.decode(self.data, offset, length)
+        return attr
+
+    def get_attr(self, *attr_types):
+        """Get the first attribute of the first type in attr_types present
+        """
+        for attr_type in attr_types:
+            indices = self._index.get(attr_type)
+            if indices:
+                return self._decode_attr(indices[0])
+
+    def get_attrs(self, attr_type):
+        """Get all attributes of attr_type in message order
+        """
+        return [self._decode_attr(index) for index in self._index.get(attr_type, ())]
+
+    def get_attr_offset(self, attr_type):
+        """Get the offset of the value of the first attribute of attr_type
+        """
+        indices = self._index.get(attr_type)
+        if indices:
+            return self._offsets[indices[0]][1]
+
+    @property
+    def _attributes(self):
+        return [self._decode_attr(index) for index in range(len(self._offsets))]
+
+    def unknown_comp_required_attrs(self, ignored=()):
+        """Returns a list of unknown comprehension-required attributes
+        """
+        return tuple(attr_type for attr_type, _offset, _length in self._offsets
+                     if attr_type < 0x8000
+                     and attr_type not in ignored
+                     and issubclass(Message.get_attr_cls(attr_type), Unknown))
+
+    @property
+    def length(self):
+        return len(self.data) - self._struct.size
+
+    def create_response(self, msg_class):
+        return Message.encode(self.msg_method, msg_class, self.magic_cookie,
+                              self.transaction_id)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __bytes__(self):
+        return bytes(self.data)
+
+    __repr__ = Message.__repr__
+    format = Message.format
+
+
+class MessageWriter(object):
+    """Encode STUN messages into a single preallocated, reusable buffer
+    Attributes are packed in place, the message length, MESSAGE-INTEGRITY
+    and FINGERPRINT are written by finalize.
+    :see: http://tools.ietf.org/html/rfc5389#section-6
+    """
+
+    _struct = Message._struct
+    max_size = Message._struct.size + 0xfffc
+
+    def __init__(self, size=max_size, padding=None):
+        """
+        :param padding: Callable returning padding bytes, pads with zero
+            bytes if None (e.g. EntropyPool() for random padding)
+        """
+        self.buffer = bytearray(size)
+        self._view = memoryview(self.buffer)
+        self._padding = padding or bytes
+        self.offset = 0
+
+    def begin(self, msg_method, msg_class, magic_cookie=stun.MAGIC_COOKIE, transaction_id=None):
+        self.msg_method = msg_method
+        self.msg_class = msg_class
+        self.magic_cookie = magic_cookie
+        self.transaction_id = transaction_id or os.urandom(12)
+        self._struct.pack_into(self.buffer, 0, msg_method | msg_class << 4, 0,
+                               magic_cookie, self.transaction_id)
+        self.offset = self._struct.size
+        self._integrity = None
+        self._fingerprint = None
+        return self
+
+    def add_attr(self, attr_cls, *args, **kwargs):
+        """Encode and append an attribute
+        MESSAGE-INTEGRITY and FINGERPRINT are deferred until finalize.
+        """
+        if attr_cls.type == stun.ATTR_MESSAGE_INTEGRITY:
+            key, = args
+            self._integrity = attr_cls, key
+        elif attr_cls.type == stun.ATTR_FINGERPRINT:
+            self._fingerprint = attr_cls
+        else:
+            attr = attr_cls.encode(self._view, *args, **kwargs)
+            self.write_attr(attr.type, attr)
+            return attr
+
+    def write_attr(self, attr_type, value):
+        """Append an already encoded attribute value
+        """
+        offset = self.offset
+        length = len(value)
+        start = offset + Attribute.struct.size
+        end = start + length
+        padding = -length & 3
+        if end + padding > len(self.buffer):
+            raise ValueError("STUN message exceeds {} bytes".format(len(self.buffer)))
+        Attribute.struct.pack_into(self.buffer, offset, attr_type, length)
+        self._view[start:end] = value
+        if padding:
+            self._view[end:end+padding] = self._padding(padding)
+        self.offset = end + padding
+
+    def _write_length(self, length):
+        struct.pack_into('>H', self.buffer, 2, length)
+
+    def finalize(self):
+        """Write the message length, MESSAGE-INTEGRITY and FINGERPRINT
+        :returns: the encoded message
+        """
+        header_size = self._struct.size
+        attr_header_size = Attribute.struct.size
+        if self._integrity:
+            attr_cls, key = self._integrity
+            # HMAC covers the 'length' value including MESSAGE-INTEGRITY
+            self._write_length(self.offset - header_size + attr_header_size +
+                               attr_cls._struct.size)
+            self.write_attr(attr_cls.type,
+                            attr_cls.compute(key, self._view[:self.offset]))
+        if self._fingerprint:
+            attr_cls = self._fingerprint
+            # Checksum covers the 'length' value including FINGERPRINT
+            self._write_length(self.offset - header_size + attr_header_size +
+                               attr_cls._struct.size)
+            self.write_attr(attr_cls.type,
+                            attr_cls.compute(self._view[:self.offset]))
+        else:
+            self._write_length(self.offset - header_size)
+        return bytes(self._view[:self.offset])
+
+
 class Attribute(bytes):
     """STUN message attribute structure
     :see: http://tools.ietf.org/html/rfc5389#section-15
@@ -242,5 +534,97 @@ class Address(Attribute):
             type(self).__name__, self.family, self.port, self.address)
 
 
+def _decode_headers(views, lengths):
+    """Yield (index, msg_type, msg_length) of the datagrams with a valid header
+    """
+    unpack_from = Message._struct.unpack_from
+    for index, length in enumerate(lengths):
+        if length < Message._struct.size:
+            continue
+        msg_type, msg_length, magic_cookie, _ = unpack_from(views[index])
+        if (msg_type >> 14 == stun.MSG_STUN and magic_cookie == stun.MAGIC_COOKIE
+                and not msg_length & 3 and msg_length + Message._struct.size <= length):
+            yield index, msg_type, msg_length
+
+
+_header_dtype = numpy and numpy.dtype(
+    [('type', '>u2'), ('length', '>u2'), ('cookie', '>u4'), ('id', 'V12')])
+
+
+def _decode_headers_numpy(views, lengths, buffer=None, stride=None):
+    """Vectorized _decode_headers
+    :param buffer: Packed buffer holding the datagrams at a fixed stride
+    """
+    size = Message._struct.size
+    count = len(views)
+    if buffer is not None and stride >= size:
+        headers = numpy.frombuffer(buffer, numpy.uint8, count * stride)
+        headers = headers.reshape(count, stride)[:, :size].copy()
+    else:
+        headers = numpy.frombuffer(
+            b''.join([view[:size].tobytes().ljust(size, b'\0') for view in views]),
+            numpy.uint8)
+    headers = headers.view(_header_dtype).reshape(count)
+    lengths = numpy.asarray(lengths)
+    msg_types = headers['type']
+    msg_lengths = headers['length']
+    valid = ((lengths >= size) &
+             (msg_types >> 14 == stun.MSG_STUN) &
+             (headers['cookie'] == stun.MAGIC_COOKIE) &
+             (msg_lengths & 3 == 0) &
+             (msg_lengths.astype(numpy.int64) + size <= lengths))
+    indices = numpy.flatnonzero(valid)
+    return zip(indices.tolist(), msg_types[indices].tolist(), msg_lengths[indices].tolist())
+
+
+def _xor_mapped_prefix(msg_type, family):
+    ip_length = 4 if family == Address.FAMILY_IPv4 else 16
+    value_length = Address.struct.size + ip_length
+    header = struct.pack('>2HL', msg_type, Attribute.struct.size + value_length,
+                         stun.MAGIC_COOKIE)
+    attr_header = struct.pack('>2HxB', stun.ATTR_XOR_MAPPED_ADDRESS, value_length, family)
+    return header, attr_header
+
+
+def _encode_xor_mapped(msg_type, transaction_ids, addrs, family):
+    header, attr_header = _xor_mapped_prefix(msg_type, family)
+    af = Address.ftoaf(family)
+    responses = []
+    for transaction_id, (host, port) in zip(transaction_ids, addrs):
+        packed_ip = socket.inet_pton(af, host)
+        magic = header[4:8] + transaction_id
+        xaddress = (int.from_bytes(packed_ip, 'big') ^
+                    int.from_bytes(magic[:len(packed_ip)], 'big'))
+        responses.append(b''.join((
+            header, transaction_id, attr_header,
+            struct.pack('>H', port ^ stun.MAGIC_COOKIE >> 16),
+            xaddress.to_bytes(len(packed_ip), 'big'))))
+    return responses
+
+
+def _encode_xor_mapped_numpy(msg_type, transaction_ids, addrs, family):
+    """Vectorized _encode_xor_mapped
+    """
+    header, attr_header = _xor_mapped_prefix(msg_type, family)
+    af = Address.ftoaf(family)
+    count = len(transaction_ids)
+    ip_length = 4 if family == Address.FAMILY_IPv4 else 16
+    size = Message._struct.size + Attribute.struct.size + Address.struct.size + ip_length
+    buf = numpy.empty((count, size), numpy.uint8)
+    buf[:, :8] = numpy.frombuffer(header, numpy.uint8)
+    buf[:, 8:20] = numpy.frombuffer(b''.join(transaction_ids), numpy.uint8).reshape(count, 12)
+    buf[:, 20:26] = numpy.frombuffer(attr_header, numpy.uint8)
+    xports = numpy.fromiter((port for _, port in addrs), numpy.uint16, count)
+    xports ^= stun.MAGIC_COOKIE >> 16
+    buf[:, 26:28] = xports.astype('>u2').view(numpy.uint8).reshape(count, 2)
+    packed_ips = numpy.frombuffer(
+        b''.join([socket.inet_pton(af, host) for host, _ in addrs]),
+        numpy.uint8).reshape(count, ip_length)
+    # xaddress is xored with the concatenation of magic cookie and transaction id
+    buf[:, 28:] = packed_ips ^ buf[:, 4:4+ip_length]
+    data = buf.tobytes()
+    return [data[offset:offset+size] for offset in range(0, count * size, size)]
+
+
 # Decorator shortcut for adding known attribute classes
 attribute = Message.add_attr_cls
@@ -46,8 +46,27 @@ class MessageIntegrity(Attribute):
         # HMAC covers the 'length' value of msg, so it needs to be updated first
         msg.length += cls._struct.size + Attribute.struct.size
 
-        value = hmac.new(key, msg, hashlib.sha1).digest()
-        return cls(value)
+        return cls(cls.compute(key, msg))
+
+    @staticmethod
+    def compute(key, data):
+        return hmac.new(key, data, hashlib.sha1).digest()
+
+    @classmethod
+    def verify(cls, msg, key):
+        """Verify the MESSAGE-INTEGRITY of a received MessageView
+        The HMAC is computed over a view of the datagram, only the header is
+        copied to adjust its 'length' to end with MESSAGE-INTEGRITY.
+        """
+        offset = msg.get_attr_offset(cls.type)
+        if offset is None:
+            return False
+        header_size = msg._struct.size
+        header = bytearray(msg.data[:header_size])
+        struct.pack_into('>H', header, 2, offset + cls._struct.size - header_size)
+        mac = hmac.new(key, header, hashlib.sha1)
+        mac.update(msg.data[header_size:offset - Attribute.struct.size])
+        return hmac.compare_digest(mac.digest(), msg.data[offset:offset + cls._struct.size])
 
     def __repr__(self):
         return "MESSAGE-INTEGRITY({})".format(self.hex())
@@ -180,8 +199,12 @@ class Fingerprint(Attribute):
         # Checksum covers the 'length' value, so it needs to be updated first
         msg.length += cls._struct.size + Attribute.struct.size
 
-        fingerprint = (binascii.crc32(msg) & 0xffffffff) ^ cls._MAGIC
-        return cls(cls._struct.pack(fingerprint))
+        return cls(cls.compute(msg))
+
+    @classmethod
+    def compute(cls, data):
+        fingerprint = (binascii.crc32(data) & 0xffffffff) ^ cls._MAGIC
+        return cls._struct.pack(fingerprint)
 
     @classmethod
     def decode(cls, data, offset, length):
@@ -1,7 +1,11 @@
 import os
+import time
+import hmac
+import hashlib
 import logging
 from ..utils import saslprep, ha1
 from . import attributes
+from . import stun
 
 
 logger = logging.getLogger(__name__)
@@ -25,37 +29,139 @@ class ShortTermCredentialMechanism(CredentialMechanism):
         msg.add_attr(attributes.MessageIntegrity, self.hmac_key)
 
 
+class LongTermCredentials(CredentialMechanism):
+    """Client side of the long-term credential mechanism
+    Requests are signed once the server has challenged with a realm and nonce.
+    :see: http://tools.ietf.org/html/rfc5389#section-10.2.1
+    """
+    def __init__(self, username, password):
+        self.username = username
+        self.password = password
+        self.realm = None
+        self.nonce = None
+        self.hmac_key = None
+
+    def challenge(self, realm, nonce):
+        """Take the realm and nonce of a 401 or 438 error response
+        :returns: True if the request should be retried with the new values
+        """
+        realm, nonce = bytes(realm), bytes(nonce)
+        if realm == self.realm and nonce == self.nonce:
+            return False
+        if realm != self.realm:
+            self.hmac_key = ha1(self.username, realm, self.password)
+        self.realm = realm
+        self.nonce = nonce
+        return True
+
+    def update(self, msg):
+        if self.nonce is not None:
+            msg.add_attr(attributes.Username, self.username)
+            msg.add_attr(attributes.Realm, self.realm)
+            msg.add_attr(attributes.Nonce, self.nonce)
+            msg.add_attr(attributes.MessageIntegrity, self.hmac_key)
+
+
+class StatelessNonces(object):
+    """Nonces validated by computation only, without per-client state
+    A nonce is the hex expiry timestamp followed by a HMAC of the timestamp
+    and the client address under a server secret. The secret is rotated
+    every lifetime, nonces are checked against the current and previous one.
+    :see: http://tools.ietf.org/html/rfc5389#section-10.2
+    """
+    _timestamp_length = 8
+    _mac_length = 32
+    length = _timestamp_length + _mac_length
+
+    def __init__(self, lifetime=3600, clock=time.time):
+        self.lifetime = lifetime
+        self.clock = clock
+        self._secrets = [os.urandom(20)] * 2 # current, previous
+        self._rotated = clock()
+
+    def _rotate(self, now):
+        if now - self._rotated >= self.lifetime:
+            self._secrets = [os.urandom(20), self._secrets[0]]
+            self._rotated = now
+
+    def _mac(self, secret, timestamp, addr):
+        host, port = addr
+        data = b':'.join((timestamp, host.encode('ascii'), b'%d' % port))
+        return hmac.new(secret, data, hashlib.sha1).hexdigest()[:self._mac_length].encode('ascii')
+
+    def generate(self, addr):
+        now = self.clock()
+        self._rotate(now)
+        timestamp = b'%08x' % int(now + self.lifetime)
+        return timestamp + self._mac(self._secrets[0], timestamp, addr)
+
+    def validate(self, nonce, addr):
+        """Check that nonce was issued to addr and has not expired
+        """
+        if len(nonce) != self.length:
+            return False
+        timestamp = bytes(nonce[:self._timestamp_length])
+        try:
+            expiry = int(timestamp, 16)
+        except ValueError:
+            return False
+        now = self.clock()
+        if expiry < now:
+            return False
+        self._rotate(now)
+        mac = bytes(nonce[self._timestamp_length:])
+        return any([hmac.compare_digest(mac, self._mac(secret, timestamp, addr))
+                    for secret in self._secrets])
+
+
 class LongTermCredentialMechanism(CredentialMechanism):
     """
     :see: http://tools.ietf.org/html/rfc5389#section-10.2
     """
-    def __init__(self, realm, users):
-        self.nonce = self.generate_nonce()
+    def __init__(self, realm, users, nonce_lifetime=3600):
+        self.nonces = StatelessNonces(nonce_lifetime)
         self.realm = realm
-        self.hmac_keys = {}
+        self.hmac_keys = {} # USERNAME (utf-8) -> H(A1)
         for username, credentials in users.items():
             key = credentials.get('key')
             if key:
-                self.hmac_keys[username] = key
+                self.hmac_keys[username.encode('utf-8')] = bytes.fromhex(key)
             else:
                 password = credentials.get('password')
                 if not password:
                     logger.warning("Invalid credentials for %s", username)
                     continue
-                self.hmac_keys[username] = ha1(username, self.realm, password)
+                self.add_user(username, password)
 
     def add_user(self, username, password):
-        self.hmac_keys[username] = ha1(username, self.realm, password)
+        self.hmac_keys[username.encode('utf-8')] = ha1(username, self.realm, password)
 
-    def generate_nonce(self, length=16):
-        b = os.urandom(length//2)
-        b = bytes(b.hex().encode('utf-8'))
-        return b
+    def authenticate(self, msg, addr):
+        """Verify the long-term credentials of a received request
+        :returns: (hmac_key, error), error is None or the ERR_* to respond with
+        :see: http://tools.ietf.org/html/rfc5389#section-10.2.2
+        """
+        if msg.get_attr_offset(stun.ATTR_MESSAGE_INTEGRITY) is None:
+            return None, stun.ERR_UNAUTHORIZED
+        username = msg.get_attr(stun.ATTR_USERNAME)
+        realm = msg.get_attr(stun.ATTR_REALM)
+        nonce = msg.get_attr(stun.ATTR_NONCE)
+        if username is None or realm is None or nonce is None:
+            return None, stun.ERR_BAD_REQUEST
+        hmac_key = self.hmac_keys.get(username)
+        if hmac_key is None or realm != self.realm:
+            return None, stun.ERR_UNAUTHORIZED
+        if not self.nonces.validate(nonce, addr):
+            return None, stun.ERR_STALE_NONCE
+        if not attributes.MessageIntegrity.verify(msg, hmac_key):
+            return None, stun.ERR_UNAUTHORIZED
+        return hmac_key, None
 
-    def update(self, msg):
-        msg.add_attr(attributes.Nonce, self.nonce)
+    def challenge(self, msg, addr):
+        """Add a fresh NONCE for addr and the REALM
+        """
+        msg.add_attr(attributes.Nonce, self.nonces.generate(addr))
         msg.add_attr(attributes.Realm, self.realm)
-        msg.add_attr(attributes.MessageIntegrity, list(self.hmac_keys.values())[0])
 
     def __str__(self):
         return "realm={}".format(self.realm)
@@ -0,0 +1,49 @@
+from collections import OrderedDict
+
+
+class ResponseCache(object):
+    """LRU cache of encoded responses with a time-to-live and a size bound
+    Keyed by (client address, transaction id), a retransmitted request is
+    answered with the cached response without running its handler again.
+    :see: http://tools.ietf.org/html/rfc5389#section-7.3.1
+    """
+
+    def __init__(self, max_bytes=4 << 20, ttl=40.):
+        """
+        :param max_bytes: Bound of the total size of the cached responses
+        :param ttl: Seconds a response is kept, RFC 5389 suggests 40 (Ti)
+        """
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self.hits = 0
+        self._entries = OrderedDict() # key -> (expires, response)
+
+    def get(self, key, now):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires, response = entry
+        if expires <= now:
+            del self._entries[key]
+            self.size -= len(response)
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return response
+
+    def put(self, key, response, now):
+        entries = self._entries
+        old = entries.pop(key, None)
+        if old:
+            self.size -= len(old[1])
+        entries[key] = (now + self.ttl, response)
+        self.size += len(response)
+        # Evict least recently used entries while over the bound or expired,
+        # expired entries behind a recently used one are dropped by get
+        while self.size > self.max_bytes or entries and next(iter(entries.values()))[0] <= now:
+            _key, (_expires, evicted) = entries.popitem(last=False)
+            self.size -= len(evicted)
+
+    def __len__(self):
+        return len(self._entries)
@@ -1,7 +1,6 @@
 import logging
-from twisted.internet import defer
+from concurrent.futures import Future
 from .protocol import StunUdpProtocol
-from .agent import Message
 from .authentication import CredentialMechanism
 from . import stun
 from . import attributes
@@ -10,29 +9,141 @@ from . import attributes
 logger = logging.getLogger(__name__)
 
 
+class RtoEstimator(object):
+    """Retransmission timeout of a server, from round trip time samples
+    :see: http://tools.ietf.org/html/rfc6298#section-2
+    """
+    __slots__ = ('rto', 'srtt', 'rttvar', 'updated')
+    alpha = 1/8.
+    beta = 1/4.
+    K = 4
+
+    def __init__(self, rto, now):
+        self.rto = rto
+        self.srtt = None
+        self.rttvar = None
+        self.updated = now
+
+    def sample(self, rtt, now, granularity, min_rto, max_rto):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar += self.beta * (abs(self.srtt - rtt) - self.rttvar)
+            self.srtt += self.alpha * (rtt - self.srtt)
+        self.rto = min(max_rto, max(min_rto, self.srtt + max(granularity, self.K * self.rttvar)))
+        self.updated = now
+
+    def backoff(self, rto, now, max_rto):
+        """Keep the backed off RTO of a retransmission until the next sample
+        :see: http://tools.ietf.org/html/rfc6298#section-5
+        """
+        self.rto = min(max_rto, max(self.rto, rto))
+        self.updated = now
+
+    def __repr__(self):
+        return "RtoEstimator(rto={:.3f}, srtt={}, rttvar={})".format(
+            self.rto, self.srtt, self.rttvar)
+
+
 class StunUdpClient(StunUdpProtocol):
-    def __init__(self, reactor, interface, port=0, software='jostedal', RTO=3., Rc=7, Rm=16):
-        StunUdpProtocol.__init__(self, reactor, interface, port, software, RTO, Rc, Rm)
+    # Retransmissions of all the transactions are scheduled on the timer
+    # wheel, which only turns while transactions are pending
+    timer_resolution = .01
+    min_RTO = .1
+    max_RTO = 60.
+    rto_lifetime = 600. # :see: http://tools.ietf.org/html/rfc5389#section-7.2.1
+
+    def __init__(self, interface, port=0, software='jostedal', RTO=.5, Rc=7, Rm=16):
+        StunUdpProtocol.__init__(self, interface, port, software, RTO, Rc, Rm)
         self._transactions = {}
+        self._rto = {} # server host -> RtoEstimator
         self.credential_mechanism = CredentialMechanism()
 
     def bind(self, addr):
         """
+        :returns: StunTransaction, the Future of the mapped (host, port)
         :see: http://tools.ietf.org/html/rfc5389#section-7.1
         """
-        request = Message.encode(stun.METHOD_BINDING, stun.CLASS_REQUEST)
+        request = self.writer.begin(stun.METHOD_BINDING, stun.CLASS_REQUEST)
         request.add_attr(attributes.Software, self.software)
         return self.request(request, addr)
 
+    def bind_many(self, addrs, count=1, concurrency=64, callback=None):
+        """Send Binding requests to many servers over this socket
+        Probes go out round-robin over the servers, at most concurrency
+        transactions are in flight at a time.
+        :param count: Requests per server
+        :param callback: Called with (transaction, result) as each transaction
+            completes, result is the mapped (host, port) or the exception
+        :returns: Future of the [(addr, result)] of the probes once all the
+            transactions completed, in the order they were sent: count
+            rounds over addrs, duplicate addrs included
+        """
+        probes = [addr for _ in range(count) for addr in addrs]
+        results = [None] * len(probes)
+        pending = iter(enumerate(probes))
+        remaining = len(probes)
+        done = Future()
+        def probe():
+            for index, addr in pending:
+                self.bind(addr).add_done_callback(
+                    lambda transaction, index=index: completed(index, transaction))
+                return
+        def completed(index, transaction):
+            nonlocal remaining
+            result = transaction.exception() or transaction.result()
+            results[index] = (transaction.addr, result)
+            if callback:
+                callback(transaction, result)
+            remaining -= 1
+            if remaining:
+                probe()
+            else:
+                done.set_result(results)
+        for _ in range(min(concurrency, len(probes))):
+            probe()
+        if not probes:
+            done.set_result(results)
+        return done
+
+    def rto(self, host):
+        """
+        :returns: the initial RTO of a transaction to a server, cached from
+            the earlier transactions for rto_lifetime
+        """
+        estimator = self._rto.get(host)
+        if estimator is not None:
+            if self.clock() - estimator.updated < self.rto_lifetime:
+                return estimator.rto
+            del self._rto[host]
+        return self.RTO
+
+    def _estimator(self, host, now):
+        estimator = self._rto.get(host)
+        if estimator is None:
+            estimator = self._rto[host] = RtoEstimator(self.RTO, now)
+        return estimator
+
     def request(self, request, addr):
         """Send a STUN request
+        :param request: MessageWriter holding the request
+        :returns: StunTransaction, the Future of the result
         """
         self.credential_mechanism.update(request)
         request.add_attr(attributes.Fingerprint)
-        transaction = StunTransaction(request, addr)
+        transaction = StunTransaction(request.finalize(), addr)
         self._transactions[transaction.transaction_id] = transaction
-        transaction.addBoth(self._transaction_completed, transaction)
-        self.send(transaction, self.RTO, self.Rc)
+        transaction.add_done_callback(self._transaction_completed)
+        transaction.started = self.now = self.clock()
+        transaction.rto = self.rto(addr[0])
+        if self._deadline is None:
+            if len(self._transactions) == 1:
+                # Idle since the last transaction, the wheel is empty
+                self.timers.jump(self.now)
+            self._deadline = self.now + self.timer_resolution
+        # Sending wakes the driver up, to arm the timer too
+        self.send(transaction, transaction.rto, self.Rc)
         return transaction
 
     def send(self, transaction, rto, rc):
@@ -41,18 +152,40 @@ class StunUdpClient(StunUdpProtocol):
         :param rc: Retransmission count, maximum number of requests to send
         :see: http://tools.ietf.org/html/rfc5389#section-7.2.1
         """
-        if not transaction.called:
-            if rc:
-                logger.info("%s Sending Request RTO=%d, Rc=%d", transaction, rto, rc)
-                self.transport.write(transaction.request, transaction.addr)
-                self.reactor.callLater(rto, self.send, transaction, rto*2, rc-1)
-            else:
-                logger.warning("%s Time Out in %ds", transaction, self.timeout)
-                self.reactor.callLater(self.timeout, transaction.time_out)
+        if transaction.done():
+            return
+        logger.info("%s Sending Request RTO=%.3f, Rc=%d", transaction, rto, rc)
+        self.write(transaction.request, transaction.addr)
+        transaction.transmissions += 1
+        if rc > 1:
+            transaction.timer = self.timers.schedule(rto, self._retransmit, transaction, rto, rc)
+        else:
+            transaction.timer = self.timers.schedule(self.Rm * transaction.rto,
+                                                     transaction.time_out)
+
+    def _retransmit(self, transaction, rto, rc):
+        rto *= 2
+        self._estimator(transaction.addr[0], self.now).backoff(rto, self.now, self.max_RTO)
+        self.send(transaction, rto, rc - 1)
+
+    def _timers_needed(self):
+        return bool(self._transactions)
 
-    def _transaction_completed(self, result, transaction):
+    def _transaction_completed(self, transaction):
         del self._transactions[transaction.transaction_id]
-        return result
+        if transaction.timer is not None:
+            transaction.timer.cancel()
+        if not self._transactions:
+            self._deadline = None
+        if transaction.cancelled():
+            return
+        # Karn's rule: the response to a retransmitted request is ambiguous
+        if (transaction.transmissions == 1 and
+                not isinstance(transaction.exception(), TransactionTimeout)):
+            now = self.now
+            transaction.rtt = now - transaction.started
+            self._estimator(transaction.addr[0], now).sample(
+                transaction.rtt, now, self.timer_resolution, self.min_RTO, self.max_RTO)
 
     def get_transaction(self, msg):
         return self._transactions.get(msg.transaction_id)
@@ -65,7 +198,7 @@ class StunUdpClient(StunUdpProtocol):
         if transaction:
             address = msg.get_attr(stun.ATTR_XOR_MAPPED_ADDRESS, stun.ATTR_MAPPED_ADDRESS)
             if address:
-                transaction.succeed(str(address))
+                transaction.succeed((address.address, address.port))
             else:
                 transaction.fail(TransactionError("No Mapped Address in response", msg))
 
@@ -79,23 +212,75 @@ class StunUdpClient(StunUdpProtocol):
         # error code 300 -> 399; SHOULD fail unless ALTERNATE-SERVER (sec 11)
         # error code 400 -> 499; transaction failed (420, UNKNOWN ATTRIBUTES contain info)
         # error code 500 -> 599; MAY resend, but MUST limit number of retries
-            transaction.fail(TransactionError(msg))
+            transaction.fail(ErrorResponse(msg))
 
 
 class TransactionError(Exception):
     pass
 
 
-class StunTransaction(defer.Deferred):
-    fail = defer.Deferred.errback
-    succeed = defer.Deferred.callback
+class ErrorResponse(TransactionError):
+    """Error response to a request
+    """
+    def __init__(self, msg):
+        error_code = msg.get_attr(stun.ATTR_ERROR_CODE)
+        self.code = error_code.code if error_code else None
+        self.response = msg
+        TransactionError.__init__(self, self.code, error_code and error_code.reason)
+
+
+class TransactionTimeout(TransactionError):
+    pass
+
+
+def chain(future, callback):
+    """
+    :param callback: Called with future once done, returns the result, or a
+        Future of it, or raises
+    :returns: Future of the result of callback
+    """
+    chained = Future()
+    def copy(result):
+        error = result.exception()
+        if error is None:
+            chained.set_result(result.result())
+        else:
+            chained.set_exception(error)
+    def done(future):
+        try:
+            result = callback(future)
+        except Exception as e:
+            chained.set_exception(e)
+            return
+        if isinstance(result, Future):
+            result.add_done_callback(copy)
+        else:
+            chained.set_result(result)
+    future.add_done_callback(done)
+    return chained
 
+
+class StunTransaction(Future):
     def __init__(self, request, addr):
-        defer.Deferred.__init__(self)
-        self.transaction_id = request.transaction_id
+        """
+        :param request: Encoded request
+        """
+        Future.__init__(self)
+        self.transaction_id = bytes(request[8:20])
         self.request = request
         self.addr = addr
+        self.started = None
+        self.rto = None # initial RTO
+        self.transmissions = 0
+        self.rtt = None # round trip time, unless the request was retransmitted
+        self.timer = None
+
+    def succeed(self, result):
+        self.set_result(result)
+
+    def fail(self, error):
+        self.set_exception(error)
 
     def time_out(self):
-        if not self.called:
-            self.fail(TransactionError("Timed out"))
+        if not self.done():
+            self.fail(TransactionTimeout("Timed out"))
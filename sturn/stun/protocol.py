@@ -1,29 +1,71 @@
+import time
 import socket
 import logging
-from twisted.internet.protocol import DatagramProtocol
+from time import perf_counter
 from . import stun
-from .agent import Message
+from .. import turn
+from ..wheel import TimerWheel
+from ..metrics import Registry, HandlerMetrics
+from .agent import Message, MessageWriter
 from .authentication import CredentialMechanism
 from . import attributes
 
 logger = logging.getLogger(__name__)
 
 
-class StunUdpProtocol(DatagramProtocol):
-    def __init__(self, reactor, interface, port, software, RTO=3., Rc=7, Rm=16):
+class StunUdpProtocol(object):
+    """Sans-IO STUN protocol
+    Datagrams and time go in, datagrams to send and a timer deadline come
+    out; a driver does the I/O:
+    - datagram_received(datagram, addr, now) or datagrams_received(batch, now)
+      with the datagrams read from the socket,
+    - datagrams_to_send() returns the [(datagram, addr)] to write to it,
+    - handle_timer(now) once the time passes get_timer().
+    wakeup, set by the driver, is called when there is something to send, or
+    a new deadline, outside of the driver's calls.
+    """
+    timer_resolution = 1.
+
+    def __init__(self, interface, port, software, RTO=.5, Rc=7, Rm=16):
         """
         :param port: UDP port to bind to
         :param RTO: Retransmission TimeOut (initial value)
         :param Rc: Retransmission Count (maximum number of request to send)
         :param Rm: Retransmission Multiplier (timeout = Rm * RTO)
         """
-        self.reactor = reactor
         self.interface = interface
         self.port = port
+        self.family = socket.AF_INET6 if ':' in interface else socket.AF_INET
         self.software = software
-        self.RTO = .5
-        self.Rc = 7
+        self.RTO = RTO
+        self.Rc = Rc
+        self.Rm = Rm
         self.timeout = Rm * RTO
+        self.writer = MessageWriter()
+        self.timers = None # TimerWheel, while the protocol is running
+        self.now = None # time of the input being handled
+        self.clock = time.monotonic # time of the calls made outside of the inputs
+        self.wakeup = None
+        self._outgoing = [] # (datagram, addr)
+        self._deadline = None
+
+        # Datagram counters
+        self.received_stun = 0
+        self.received_channel_data = 0
+        self.dropped = 0
+
+        self.metrics = Registry()
+        self._handler_metrics = {} # (method, class) -> HandlerMetrics
+        self.metrics.counter('sturn_received_stun_total', "STUN datagrams received",
+                             lambda: self.received_stun)
+        self.metrics.counter('sturn_received_channel_data_total', "ChannelData datagrams received",
+                             lambda: self.received_channel_data)
+        self.metrics.counter('sturn_dropped_total', "Datagrams neither STUN nor ChannelData",
+                             lambda: self.dropped)
+        self._unhandled = self.metrics.counter('sturn_unhandled_messages_total',
+                                               "STUN messages without a handler")
+        self._loop_lag = self.metrics.histogram('sturn_event_loop_lag_seconds',
+                                                "Delay of the timer wheel tick")
 
         self._handlers = {
             # Binding handlers
@@ -37,35 +79,157 @@ class StunUdpProtocol(DatagramProtocol):
                 self._stun_binding_error,
             }
 
-    def start(self):
-        port = self.reactor.listenUDP(self.port, self, self.interface)
-        return port.port
+    def stats(self):
+        """Datagram counters
+        """
+        return {
+            'received_stun': self.received_stun,
+            'received_channel_data': self.received_channel_data,
+            'dropped': self.dropped,
+            }
+
+    def start(self, now):
+        """Called by the driver once the port is bound
+        """
+        self.now = now
+        self.timers = TimerWheel(self.timer_resolution, now)
+        if self._timers_needed():
+            self._deadline = now + self.timer_resolution
 
-    def datagramReceived(self, datagram, addr):
-        msg_type = datagram[0] >> 6
-        if msg_type == stun.MSG_STUN:
+    def stop(self):
+        """Called by the driver once the port is closed
+        """
+        self._deadline = None
+
+    def _timers_needed(self):
+        """Whether the timer wheel keeps turning, it also measures the loop lag
+        """
+        return True
+
+    def get_timer(self):
+        """
+        :returns: the time handle_timer is due, None without timers
+        """
+        return self._deadline
+
+    def handle_timer(self, now):
+        """Turn the timer wheel, called by the driver at the time of get_timer
+        """
+        if self._deadline is None:
+            return
+        self._loop_lag.observe(max(0., now - self._deadline))
+        self._deadline = None
+        self.now = now
+        try:
+            self.timers.advance(now)
+        finally:
+            # Timer callbacks may have set it already
+            if self._deadline is None and self._timers_needed():
+                self._deadline = now + self.timer_resolution
+
+    def write(self, datagram, addr):
+        """Queue a datagram for the driver to send from the port
+        """
+        self._outgoing.append((datagram, addr))
+        if len(self._outgoing) == 1 and self.wakeup is not None:
+            self.wakeup()
+
+    def datagrams_to_send(self):
+        """
+        :returns: the [(datagram, addr)] queued since the last call
+        """
+        outgoing = self._outgoing
+        if outgoing:
+            self._outgoing = []
+        return outgoing
+
+    def datagram_received(self, datagram, addr, now):
+        """Demultiplex a datagram on its first byte and length field
+        :see: http://tools.ietf.org/html/rfc5766#section-11.6
+        """
+        self.now = now
+        size = len(datagram)
+        if size >= 4:
+            msg_type = datagram[0] >> 6
+            length = datagram[2] << 8 | datagram[3]
+            if msg_type == stun.MSG_STUN:
+                if size >= 20 and 20 + length <= size:
+                    self.received_stun += 1
+                    try:
+                        msg = Message.decode(datagram, lazy=True)
+                    except Exception as e:
+                        logger.debug("Failed to decode STUN from %s:%d: %s", addr[0], addr[1], e)
+                    else:
+                        self._stun_received(msg, addr)
+                        return
+            elif msg_type == turn.MSG_CHANNEL:
+                if 4 + length <= size:
+                    self.received_channel_data += 1
+                    channel_number = datagram[0] << 8 | datagram[1]
+                    self._channel_data_received(
+                        channel_number, memoryview(datagram)[4:4+length], addr)
+                    return
+        self.dropped += 1
+
+    def datagrams_received(self, datagrams, now):
+        """Handle a batch of (datagram, addr) read at once
+        A datagram failing to be handled does not take the rest of the batch
+        down with it.
+        """
+        datagram_received = self.datagram_received
+        for datagram, addr in datagrams:
             try:
-                msg = Message.decode(datagram)
+                datagram_received(datagram, addr, now)
             except Exception:
-                logger.exception("Failed to decode STUN from %s:%d:", *addr)
-                logger.debug(datagram.hex())
-            else:
-                if isinstance(msg, Message):
-                    self._stun_received(msg, addr)
-        else:
-            logger.warning("Unknown message in datagram from %s:%d:", *addr)
-            logger.debug(datagram.hex())
+                logger.exception("Failed to handle a datagram from %s:%d", addr[0], addr[1])
 
     def _stun_received(self, msg, addr):
-        handler = self._handlers.get((msg.msg_method, msg.msg_class))
+        key = msg.msg_method, msg.msg_class
+        handler = self._handlers.get(key)
         if handler:
             logger.info("%s Received STUN", self)
             #logger.debug(msg.format())
-            handler(msg, addr)
+            metrics = self._handler_metrics.get(key) or self.handler_metrics(*key)
+            start = perf_counter()
+            try:
+                handler(msg, addr)
+            except Exception:
+                metrics.drops.value += 1
+                raise
+            finally:
+                metrics.observe(len(msg), perf_counter() - start)
         else:
+            self._unhandled.value += 1
             logger.info("%s Received unrecognized STUN", self)
             logger.debug(msg.format())
 
+    def handler_metrics(self, msg_method, msg_class):
+        """
+        :returns: the HandlerMetrics of a (method, class), created on first use
+        """
+        key = msg_method, msg_class
+        metrics = self._handler_metrics.get(key)
+        if metrics is None:
+            metrics = self._handler_metrics[key] = HandlerMetrics(self.metrics, *key)
+        return metrics
+
+    def _channel_data_received(self, channel_number, data, addr):
+        """
+        :param data: memoryview of the application data
+        :see: http://tools.ietf.org/html/rfc5766#section-11.4
+        """
+        self.dropped += 1
+
+    def connection_closed(self, addr):
+        """Called when the stream connection of a client is closed
+        """
+        pass
+
+    def connection_idle(self, addr):
+        """Whether the stream connection of a client, idle for a while, may be closed
+        """
+        return True
+
     def _stun_unhandeled(self, msg, addr):
         logger.warning("%s Unhandeled message from %s:%d", self, *addr)
         logger.debug(msg.format())
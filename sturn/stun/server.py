@@ -2,43 +2,94 @@ import logging
 from .protocol import StunUdpProtocol
 from . import attributes
 from . import stun
-from .agent import Message, Address
+from .agent import Address
+from .template import ResponseTemplate
+from .cache import ResponseCache
 
 
 logger = logging.getLogger(__name__)
 
 
 class StunUdpServer(StunUdpProtocol):
-    def __init__(self, reactor, interface, port, software, overrides=None):
-        StunUdpProtocol.__init__(self, reactor, interface, port, software)
+    def __init__(self, interface, port, software, overrides=None):
+        StunUdpProtocol.__init__(self, interface, port, software)
         self.overrides = {} if overrides is None else overrides
+        self._binding_templates = {} # family -> ResponseTemplate
+        self.response_cache = ResponseCache()
+        self.metrics.counter('sturn_retransmissions_total',
+                             "Requests answered from the response cache",
+                             lambda: self.response_cache.hits)
+        self.metrics.gauge('sturn_response_cache_bytes', "Size of the cached responses",
+                           lambda: self.response_cache.size)
 
-    def respond(self, response, addr):
+    def create_response(self, msg, msg_class):
+        """Start encoding a response to msg in the shared MessageWriter
+        """
+        return self.writer.begin(msg.msg_method, msg_class, msg.magic_cookie,
+                                 msg.transaction_id)
+
+    def respond(self, response, addr, hmac_key=None):
+        """Finalize and send a response
+        :param hmac_key: Key of the authenticated requester to sign with
+        """
         response.add_attr(attributes.Software, self.software)
-        self.credential_mechanism.update(response)
+        if hmac_key:
+            response.add_attr(attributes.MessageIntegrity, hmac_key)
         response.add_attr(attributes.Fingerprint)
-        self.transport.write(response, addr)
+        data = response.finalize()
+        if response.msg_class == stun.CLASS_RESPONSE_ERROR:
+            self.handler_metrics(response.msg_method, stun.CLASS_REQUEST).errors.value += 1
+        self.response_cache.put((addr, response.transaction_id), data, self.now)
+        self.write(data, addr)
         logger.info("%s Sending response", self)
         #logger.debug(response.format())
 
+    def _stun_received(self, msg, addr):
+        if msg.msg_class == stun.CLASS_REQUEST:
+            response = self.response_cache.get((addr, msg.transaction_id),
+                                               self.now)
+            if response:
+                logger.info("%s Resending response to a retransmission", self)
+                self.write(response, addr)
+                return
+        StunUdpProtocol._stun_received(self, msg, addr)
+
+    def stats(self):
+        stats = StunUdpProtocol.stats(self)
+        stats['retransmissions'] = self.response_cache.hits
+        return stats
+
+    def _binding_template(self, family):
+        template = self._binding_templates.get(family)
+        if template is None:
+            template = ResponseTemplate(stun.METHOD_BINDING,
+                                        stun.CLASS_RESPONSE_SUCCESS, family)
+            template.add_attr(attributes.Software, self.software)
+            self._binding_templates[family] = template
+        return template
+
     def _stun_binding_request(self, msg, addr):
         if msg.msg_class == stun.CLASS_REQUEST:
             unknown_attributes = msg.unknown_comp_required_attrs()
             if unknown_attributes:
-                response = Message.encode(stun.METHOD_BINDING,
-                                               stun.CLASS_RESPONSE_ERROR,
-                                               transaction_id=msg.transaction_id)
+                response = self.create_response(msg, stun.CLASS_RESPONSE_ERROR)
                 response.add_attr(attributes.ErrorCode, *stun.ERR_UNKNOWN_ATTRIBUTE)
                 response.add_attr(attributes.UnknownAttributes, unknown_attributes)
+                response = response.finalize()
+                self.handler_metrics(msg.msg_method, msg.msg_class).errors.value += 1
+            elif msg.magic_cookie == stun.MAGIC_COOKIE:
+                family = Address.aftof(self.family)
+                mapped_address = self.overrides.get('mapped_address', addr)
+                response = self._binding_template(family).render(
+                    msg.transaction_id, mapped_address)
             else:
-                response = Message.encode(stun.METHOD_BINDING,
-                                               stun.CLASS_RESPONSE_SUCCESS,
-                                               transaction_id=msg.transaction_id)
-                family = Address.aftof(self.transport.addressFamily)
+                response = self.create_response(msg, stun.CLASS_RESPONSE_SUCCESS)
+                family = Address.aftof(self.family)
                 host, port = self.overrides.get('mapped_address', addr)
                 response.add_attr(attributes.XorMappedAddress, family, port, host)
                 response.add_attr(attributes.Software, self.software)
-        self.transport.write(response, addr)
+                response = response.finalize()
+        self.write(response, addr)
         logger.info("%s Sending response", self)
         #logger.debug(response.format())
 
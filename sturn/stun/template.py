@@ -0,0 +1,88 @@
+import socket
+import struct
+import binascii
+from . import stun
+from .agent import Message, Attribute, Address
+from . import attributes
+
+
+class ResponseTemplate(object):
+    """Prebuilt STUN response with only the per-request fields patched
+    The header and the constant attributes (SOFTWARE, REALM, ...) are
+    encoded once, render patches the transaction id, the XOR-MAPPED-ADDRESS,
+    the fixed length variable attributes and recomputes the FINGERPRINT trailer.
+    :see: http://tools.ietf.org/html/rfc5389#section-15.5
+    """
+
+    _trailer = struct.Struct('>2HL')
+    _xor_ipv4 = struct.Struct('>HL')
+
+    def __init__(self, msg_method, msg_class, family=None):
+        """
+        :param family: Address family of the XOR-MAPPED-ADDRESS to patch,
+            None if the response doesn't carry one
+        """
+        self.msg_method = msg_method
+        self.msg_class = msg_class
+        self.family = family
+        self._message = Message.encode(msg_method, msg_class,
+                                       transaction_id=bytes(12))
+        # The template is sent many times, so don't leak random padding
+        self._message._padding = b'\x00'.__mul__
+        self._address_offset = None
+        self._variables = [] # (offset, length) of variable attribute values
+        self._buffer = None
+        if family:
+            placeholder = '0.0.0.0' if family == Address.FAMILY_IPv4 else '::'
+            self._message.add_attr(attributes.XorMappedAddress, family, 0, placeholder)
+            # X-Port follows the reserved and family bytes of the value
+            self._address_offset = Message._struct.size + Attribute.struct.size + 2
+
+    def add_attr(self, attr_cls, *args, **kwargs):
+        assert self._buffer is None, "Template already rendered"
+        return self._message.add_attr(attr_cls, *args, **kwargs)
+
+    def add_variable_attr(self, attr_cls, length):
+        """Reserve a fixed length attribute with its value given to render
+        """
+        assert self._buffer is None, "Template already rendered"
+        self._variables.append((len(self._message) + Attribute.struct.size, length))
+        return self._message.add_attr(attr_cls, bytes(length))
+
+    def _build(self):
+        # Checksum covers the 'length' value, so it needs to be updated first
+        self._message.length += self._trailer.size
+        self._buffer = bytes(self._message) + bytes(self._trailer.size)
+        self._crc_length = len(self._buffer) - self._trailer.size
+
+    def render(self, transaction_id, addr=None, values=()):
+        """Render the response for a request
+        :param addr: (host, port) to encode as XOR-MAPPED-ADDRESS
+        :param values: Values of the variable attributes, in order
+        """
+        if self._buffer is None:
+            self._build()
+        buf = bytearray(self._buffer)
+        buf[8:20] = transaction_id
+        for (offset, length), value in zip(self._variables, values):
+            assert len(value) == length, "Variable attribute length mismatch"
+            buf[offset:offset+length] = value
+        if self._address_offset is not None:
+            host, port = addr
+            xport = port ^ stun.MAGIC_COOKIE >> 16
+            offset = self._address_offset
+            if self.family == Address.FAMILY_IPv4:
+                xaddress = int.from_bytes(socket.inet_pton(socket.AF_INET, host), 'big')
+                self._xor_ipv4.pack_into(buf, offset, xport, xaddress ^ stun.MAGIC_COOKIE)
+            else:
+                struct.pack_into('>H', buf, offset, xport)
+                packed_ip = socket.inet_pton(socket.AF_INET6, host)
+                xaddress = (int.from_bytes(packed_ip, 'big') ^
+                            int.from_bytes(buf[4:20], 'big'))
+                buf[offset+2:offset+18] = xaddress.to_bytes(16, 'big')
+        crc_length = self._crc_length
+        fingerprint = ((binascii.crc32(memoryview(buf)[:crc_length]) & 0xffffffff) ^
+                       attributes.Fingerprint._MAGIC)
+        self._trailer.pack_into(buf, crc_length, stun.ATTR_FINGERPRINT,
+                                attributes.Fingerprint._struct.size, fingerprint)
+        return buf
@@ -0,0 +1,235 @@
+"""STUN and TURN over TLS (turns:)
+TLS runs over memory BIOs on top of the TCP stream transport. Handshakes,
+the expensive part of serving turns:, run in a thread pool: OpenSSL drops
+the GIL and the reactor keeps relaying meanwhile. Resumed handshakes, from
+session tickets or the server session cache, skip the key exchange.
+:see: http://tools.ietf.org/html/rfc5766#section-2.1
+:see: https://docs.python.org/3/library/ssl.html#memory-bio-support
+"""
+import ssl
+import time
+import socket
+import logging
+from twisted.internet import defer, threads
+from .stream import StreamConnection, StreamPort, listen
+
+
+logger = logging.getLogger(__name__)
+
+
+TURNS_PORT = 5349
+
+# Seconds, from 100us to 1s
+HANDSHAKE_BUCKETS = (.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1.)
+
+
+def server_context(certificate, private_key=None, num_tickets=2):
+    """
+    :param certificate: PEM file of the certificate chain (and the key)
+    :param num_tickets: TLS 1.3 session tickets sent after a full handshake
+    """
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.load_cert_chain(certificate, private_key)
+    context.num_tickets = num_tickets
+    # Session tickets are on unless OP_NO_TICKET, stateful resumption
+    # uses the server session cache
+    context.options &= ~ssl.OP_NO_TICKET
+    return context
+
+
+class TlsConnection(StreamConnection):
+    """TLS connection of a client
+    Records decrypt into the stream framer, the coalesced writes of the
+    connection are encrypted together.
+    """
+
+    def __init__(self, port, addr):
+        StreamConnection.__init__(self, port, addr)
+        self._incoming = ssl.MemoryBIO()
+        self._outgoing = ssl.MemoryBIO()
+        self._tls = port.context.wrap_bio(self._incoming, self._outgoing, server_side=True)
+        self._received = [] # records received while a handshake step runs
+        self._stepping = False
+        self._closed = False
+        self.handshaking = True
+        # Handshake cost
+        self.connected = None
+        self.handshake_steps = 0
+        self.handshake_cpu = 0. # seconds of OpenSSL in the handshake steps
+        self.handshake_seconds = None # from connection to completion
+        self.resumed = None
+
+    def connectionMade(self):
+        StreamConnection.connectionMade(self)
+        self.connected = time.perf_counter()
+
+    def dataReceived(self, data):
+        if self._stepping:
+            self._received.append(data)
+            return
+        self._incoming.write(data)
+        if self.handshaking:
+            self._handshake()
+        else:
+            self._decrypt()
+
+    def _handshake_step(self):
+        """Run in the handshake thread pool
+        :returns: (done, CPU seconds)
+        """
+        start = time.thread_time()
+        try:
+            self._tls.do_handshake()
+            done = True
+        except ssl.SSLWantReadError:
+            done = False
+        return done, time.thread_time() - start
+
+    def _handshake(self):
+        self._stepping = True
+        self.port.run_handshake(self._handshake_step).addCallbacks(
+            self._handshake_stepped, self._handshake_failed)
+
+    def _handshake_stepped(self, result):
+        done, cpu = result
+        self._stepping = False
+        self.handshake_steps += 1
+        self.handshake_cpu += cpu
+        if self._closed:
+            return
+        self._send_records()
+        received, self._received = self._received, []
+        for data in received:
+            self._incoming.write(data)
+        if done:
+            self.handshaking = False
+            self.handshake_seconds = time.perf_counter() - self.connected
+            self.resumed = self._tls.session_reused
+            self.port.handshake_completed(self)
+            self._decrypt()
+        elif received:
+            self._handshake()
+
+    def _handshake_failed(self, failure):
+        self._stepping = False
+        self.port.handshake_failures.inc()
+        if self._closed:
+            return
+        logger.info("TLS handshake with %s:%d failed: %s", self.addr[0], self.addr[1],
+                    failure.getErrorMessage())
+        self._send_records()
+        self.transport.loseConnection()
+
+    def _decrypt(self):
+        chunks = []
+        while True:
+            try:
+                chunk = self._tls.read(65536)
+            except ssl.SSLWantReadError:
+                break
+            except ssl.SSLZeroReturnError:
+                # close_notify from the client
+                self.transport.loseConnection()
+                break
+            except ssl.SSLError as e:
+                logger.info("TLS error from %s:%d: %s", self.addr[0], self.addr[1], e)
+                self.transport.loseConnection()
+                return
+            if not chunk:
+                break
+            chunks.append(chunk)
+        # Post-handshake messages, like TLS 1.3 key updates, may need an answer
+        self._send_records()
+        if chunks:
+            StreamConnection.dataReceived(self, b''.join(chunks))
+
+    def flush(self):
+        if self._flush_call is not None:
+            if self._flush_call.active():
+                self._flush_call.cancel()
+            self._flush_call = None
+        if self._pending and not self.handshaking:
+            pending, self._pending = self._pending, []
+            self._tls.write(b''.join(pending))
+            self._send_records()
+
+    def _send_records(self):
+        if self._outgoing.pending:
+            self.transport.write(self._outgoing.read())
+
+    def connectionLost(self, reason):
+        self._closed = True
+        StreamConnection.connectionLost(self, reason)
+
+
+class TlsPort(StreamPort):
+    """TLS listener driving a STUN protocol in place of its UDP port
+    Handshake costs are counted in the metrics of the protocol.
+    """
+    connection_class = TlsConnection
+
+    def __init__(self, reactor, protocol, context, family=socket.AF_INET,
+                 max_connections=10000, threadpool=None):
+        """
+        :param threadpool: Pool to run the handshakes in, None to run them inline
+        """
+        StreamPort.__init__(self, reactor, protocol, family, max_connections)
+        self.context = context
+        self.threadpool = threadpool
+        metrics = protocol.metrics
+        self.full_handshakes = metrics.counter('sturn_tls_handshakes_total',
+                                               "Completed TLS handshakes", resumed='false')
+        self.resumed_handshakes = metrics.counter('sturn_tls_handshakes_total',
+                                                  "Completed TLS handshakes", resumed='true')
+        self.handshake_failures = metrics.counter('sturn_tls_handshake_failures_total',
+                                                  "Failed TLS handshakes")
+        self.handshake_cpu = {
+            resumed: metrics.histogram('sturn_tls_handshake_cpu_seconds',
+                                       "CPU time of the TLS handshakes", HANDSHAKE_BUCKETS,
+                                       resumed=resumed)
+            for resumed in ('false', 'true')}
+        metrics.gauge('sturn_tls_connections', "Open TLS connections",
+                      lambda: len(self.connections))
+        for name in ('hits', 'misses', 'timeouts', 'cache_full'):
+            metrics.counter('sturn_tls_session_cache_' + name,
+                            "Server session cache " + name.replace('_', ' '),
+                            lambda name=name: context.session_stats()[name])
+
+    def run_handshake(self, step):
+        """
+        :returns: Deferred firing with the result of the handshake step
+        """
+        if self.threadpool is None:
+            return defer.execute(step)
+        return threads.deferToThreadPool(self.reactor, self.threadpool, step)
+
+    def handshake_completed(self, connection):
+        resumed = 'true' if connection.resumed else 'false'
+        (self.resumed_handshakes if connection.resumed else self.full_handshakes).inc()
+        self.handshake_cpu[resumed].observe(connection.handshake_cpu)
+        logger.info("TLS handshake with %s:%d %s in %.1fms (%.1fms CPU), %s",
+                    connection.addr[0], connection.addr[1],
+                    'resumed' if connection.resumed else 'completed',
+                    connection.handshake_seconds * 1e3, connection.handshake_cpu * 1e3,
+                    connection._tls.version())
+
+
+def listenTLS(reactor, port, protocol, context, interface='', max_connections=10000,
+              backlog=1024, reuse_port=False, handshake_threads=4):
+    """Serve a STUN protocol over TLS
+    :param context: Server SSLContext, created before forking workers they
+        share the session ticket keys
+    :param handshake_threads: Size of the handshake thread pool, 0 to run
+        the handshakes in the reactor thread
+    :returns: the TlsPort, the driver of protocol
+    """
+    threadpool = None
+    if handshake_threads:
+        from twisted.python.threadpool import ThreadPool
+        threadpool = ThreadPool(1, handshake_threads, 'tls-handshake')
+        threadpool.start()
+        reactor.addSystemEventTrigger('during', 'shutdown', threadpool.stop)
+    family = socket.AF_INET6 if ':' in interface else socket.AF_INET
+    tls_port = TlsPort(reactor, protocol, context, family, max_connections, threadpool)
+    return listen(reactor, port, tls_port, interface, backlog, reuse_port)
@@ -9,15 +9,23 @@ class ChannelNumber(Attribute):
     :see: http://tools.ietf.org/html/rfc5766#section-14.1
     """
     type = turn.ATTR_CHANNEL_NUMBER
+    _struct = struct.Struct('>H2x')
 
     def __init__(self, data, channel_number):
         self.channel_number = channel_number
 
     @classmethod
     def decode(cls, data, offset, length):
-        channel_number = struct.unpack_from('>H2x', data, offset)
+        channel_number, = cls._struct.unpack_from(data, offset)
         return cls(bytes(data[offset:offset+length]), channel_number)
 
+    @classmethod
+    def encode(cls, msg, channel_number):
+        return cls(cls._struct.pack(channel_number), channel_number)
+
+    def __repr__(self):
+        return "CHANNEL-NUMBER({:#06x})".format(self.channel_number)
+
 
 @attribute
 class Lifetime(Attribute):
@@ -79,16 +87,22 @@ class EvenPort(Attribute):
     """
     type = turn.ATTR_EVEN_PORT
     RESERVE = 0b10000000
+    _struct = struct.Struct('>B')
 
-    def __init__(self, evenport):
-        self.evenport = evenport
+    def __init__(self, data, reserve):
+        self.reserve = reserve
 
     @classmethod
     def decode(cls, data, offset, length):
-        return struct.unpack_from('>B', data, offset)[0] & 0b10000000
+        flags, = cls._struct.unpack_from(data, offset)
+        return cls(bytes(data[offset:offset+length]), bool(flags & cls.RESERVE))
+
+    @classmethod
+    def encode(cls, msg, reserve=False):
+        return cls(cls._struct.pack(cls.RESERVE if reserve else 0), reserve)
 
     def __repr__(self):
-        return "EVEN-PORT({})".format(self.evenport)
+        return "EVEN-PORT(reserve={})".format(self.reserve)
 
 @attribute
 class RequestedTransport(Attribute):
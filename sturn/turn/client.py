@@ -1,9 +1,10 @@
 import logging
-from ..stun.client import StunUdpClient, TransactionError
+from ..stun.client import StunUdpClient, TransactionError, ErrorResponse, chain
 from .. import stun, turn
-from ..stun.agent import Message
-from ..stun.authentication import LongTermCredentialMechanism
+from ..stun.agent import Address
+from ..stun.authentication import LongTermCredentials
 from . import attributes
+from .relay import encode_channel_data
 
 
 logger = logging.getLogger(__name__)
@@ -32,59 +33,155 @@ class TurnUdpClient(StunUdpClient):
 
     class Expired(): pass
 
-    def __init__(self, reactor):
-        StunUdpClient.__init__(self, reactor)
+    def __init__(self, interface='', port=0, username=None, password=None):
+        StunUdpClient.__init__(self, interface, port)
         self.turn_server_domain_name = None
         self.allocation = None
+        self.relayed_addr = None # (host, port) of the allocation
+        self._channels = {} # channel number -> peer address
+        self._peers = {} # peer address -> channel number
+        if username is not None:
+            self.credential_mechanism = LongTermCredentials(username, password)
 
         self._handlers.update({
             # Allocate handlers
             (turn.METHOD_ALLOCATE, stun.CLASS_RESPONSE_SUCCESS):
                 self._stun_allocate_success,
             (turn.METHOD_ALLOCATE, stun.CLASS_RESPONSE_ERROR):
-                self._stun_allocate_error,
+                self._stun_error_response,
             # Refresh handlers
             (turn.METHOD_REFRESH, stun.CLASS_RESPONSE_SUCCESS):
                 self._stun_refresh_success,
             (turn.METHOD_REFRESH, stun.CLASS_RESPONSE_ERROR):
-                self._stun_refresh_error,
+                self._stun_error_response,
+            # CreatePermission handlers
+            (turn.METHOD_CREATE_PERMISSION, stun.CLASS_RESPONSE_SUCCESS):
+                self._stun_success_response,
+            (turn.METHOD_CREATE_PERMISSION, stun.CLASS_RESPONSE_ERROR):
+                self._stun_error_response,
+            # ChannelBind handlers
+            (turn.METHOD_CHANNEL_BIND, stun.CLASS_RESPONSE_SUCCESS):
+                self._stun_success_response,
+            (turn.METHOD_CHANNEL_BIND, stun.CLASS_RESPONSE_ERROR):
+                self._stun_error_response,
             # Data handlers
             (turn.METHOD_DATA, stun.CLASS_INDICATION):
                 self._stun_data_indication,
             })
 
+    def authenticated_request(self, build, addr):
+        """Send a request, and send it again if challenged for (new) credentials
+        :param build: Callable returning the MessageWriter holding the request
+        :see: http://tools.ietf.org/html/rfc5389#section-10.2.3
+        """
+        def retry(transaction):
+            error = transaction.exception()
+            if isinstance(error, ErrorResponse):
+                nonce = error.response.get_attr(stun.ATTR_NONCE)
+                realm = error.response.get_attr(stun.ATTR_REALM)
+                # 401 Unauthorized, 438 Stale Nonce
+                if (error.code in (401, 438) and nonce is not None and realm is not None and
+                        isinstance(self.credential_mechanism, LongTermCredentials) and
+                        self.credential_mechanism.challenge(realm, nonce)):
+                    logger.debug("%s Retrying with the nonce of %s", self, error)
+                    return self.request(build(), addr)
+            return transaction.result()
+        return chain(self.request(build(), addr), retry)
+
     def allocate(self, addr, transport=turn.TRANSPORT_UDP, time_to_expiry=None,
         dont_fragment=False, even_port=None, reservation_token=None):
         """
         :param even_port: None | 0 | 1 (1==reserve next highest port number)
+        :returns: Future of the (host, port) of the relayed address
         :see: http://tools.ietf.org/html/rfc5766#section-6.1
         """
-        request = Message.encode(turn.METHOD_ALLOCATE, stun.CLASS_REQUEST)
-        request.add_attr(attributes.RequestedTransport, transport)
-        if time_to_expiry:
-            request.add_attr(turn.ATTR_LIFETIME, time_to_expiry)
-        if dont_fragment:
-            request.add_attr(turn.ATTR_DONT_FRAGMENT)
-        if even_port is not None and not reservation_token:
-            request.add_attr(turn.ATTR_EVEN_PORT, even_port)
-        if reservation_token:
-            request.add_attr(turn.ATTR_RESERVATION_TOKEN, even_port)
-        transaction = self.request(request, addr)
-        transaction.addErrback
-        def retry(failure):
-            nonce = failure.value.get_attr(stun.ATTR_NONCE)
-            realm = str(failure.value.get_attr(stun.ATTR_REALM))
-            self.credential_mechanism = LongTermCredentialMechanism(nonce, realm, 'username', 'password')
-            logger.debug("Retrying allocation with %s", self.credential_mechanism)
-            transaction.addCallback(lambda result: self.allocate(addr))
-
-    def refresh(self, time_to_expiry):
+        def build():
+            request = self.writer.begin(turn.METHOD_ALLOCATE, stun.CLASS_REQUEST)
+            request.add_attr(attributes.RequestedTransport, transport)
+            if time_to_expiry:
+                request.add_attr(attributes.Lifetime, time_to_expiry)
+            if dont_fragment:
+                request.add_attr(attributes.DontFragment, b'')
+            if reservation_token:
+                request.add_attr(attributes.ReservationToken, reservation_token)
+            elif even_port is not None:
+                request.add_attr(attributes.EvenPort, even_port)
+            return request
+        return self.authenticated_request(build, addr)
+
+    def refresh(self, addr, time_to_expiry=None):
+        """Refresh the allocation, or delete it with a time_to_expiry of 0
+        :returns: Future of the granted lifetime
+        :see: http://tools.ietf.org/html/rfc5766#section-7
+        """
+        def build():
+            request = self.writer.begin(turn.METHOD_REFRESH, stun.CLASS_REQUEST)
+            if time_to_expiry is not None:
+                request.add_attr(attributes.Lifetime, time_to_expiry)
+            return request
+        transaction = self.authenticated_request(build, addr)
+        if time_to_expiry == 0:
+            def mismatch(transaction):
+                # 437 Allocation Mismatch, the allocation is already gone
+                error = transaction.exception()
+                if isinstance(error, ErrorResponse) and error.code == 437:
+                    return 0
+                return transaction.result()
+            transaction = chain(transaction, mismatch)
+        return transaction
+
+    def create_permission(self, addr, *peer_hosts):
+        """Install or refresh the permissions for peer hosts
+        :see: http://tools.ietf.org/html/rfc5766#section-9.1
+        """
+        def build():
+            request = self.writer.begin(turn.METHOD_CREATE_PERMISSION, stun.CLASS_REQUEST)
+            for host in peer_hosts:
+                family = Address.FAMILY_IPv6 if ':' in host else Address.FAMILY_IPv4
+                request.add_attr(attributes.XorPeerAddress, family, 0, host)
+            return request
+        return self.authenticated_request(build, addr)
+
+    def channel_bind(self, addr, channel_number, peer_addr):
+        """Bind a channel to a peer, or refresh the binding
+        :param peer_addr: (host, port) of the peer
+        :see: http://tools.ietf.org/html/rfc5766#section-11.1
+        """
+        host, port = peer_addr
+        family = Address.FAMILY_IPv6 if ':' in host else Address.FAMILY_IPv4
+        def build():
+            request = self.writer.begin(turn.METHOD_CHANNEL_BIND, stun.CLASS_REQUEST)
+            request.add_attr(attributes.ChannelNumber, channel_number)
+            request.add_attr(attributes.XorPeerAddress, family, port, host)
+            return request
+        def bound(transaction):
+            result = transaction.result()
+            self._channels[channel_number] = peer_addr
+            self._peers[peer_addr] = channel_number
+            return result
+        return chain(self.authenticated_request(build, addr), bound)
+
+    def send_indication(self, addr, peer_addr, data):
+        """Send data to a peer through the relay
+        :see: http://tools.ietf.org/html/rfc5766#section-10.1
+        """
+        host, port = peer_addr
+        family = Address.FAMILY_IPv6 if ':' in host else Address.FAMILY_IPv4
+        indication = self.writer.begin(turn.METHOD_SEND, stun.CLASS_INDICATION)
+        indication.add_attr(attributes.XorPeerAddress, family, port, host)
+        indication.write_attr(turn.ATTR_DATA, data)
+        self.write(indication.finalize(), addr)
+
+    def send_channel_data(self, addr, channel_number, data):
         """
-        :see: http://tools.ietf.org/html/rfc5766#section-6
+        :see: http://tools.ietf.org/html/rfc5766#section-11.5
         """
-        request = Message.encode(turn.METHOD_REFRESH, stun.CLASS_REQUEST)
-        if time_to_expiry:
-            request.add_attr(turn.ATTR_LIFETIME, time_to_expiry)
+        self.write(encode_channel_data(channel_number, data), addr)
+
+    def data_received(self, data, peer_addr):
+        """Called with data relayed from a peer, to be overridden
+        """
+        logger.info("%s Received %d bytes from %s:%d", self, len(data), *peer_addr)
 
     def get_host_transport_address(self):
         pass
@@ -92,36 +189,47 @@ class TurnUdpClient(StunUdpClient):
     def get_server_transport_address(self):
         pass #dns srv record of "turn" or "turns"
 
+    def _stun_success_response(self, msg, addr):
+        transaction = self._transactions.get(msg.transaction_id)
+        if transaction:
+            transaction.succeed(msg)
+
+    def _stun_error_response(self, msg, addr):
+        transaction = self._transactions.get(msg.transaction_id)
+        if transaction:
+            transaction.fail(ErrorResponse(msg))
+
     def _stun_allocate_success(self, msg, addr):
         transaction = self._transactions.get(msg.transaction_id)
         if transaction:
             relayed_addr = msg.get_attr(turn.ATTR_XOR_RELAYED_ADDRESS)
             if relayed_addr:
-                transaction.succeed(str(relayed_addr))
+                self.relayed_addr = relayed_addr.address, relayed_addr.port
+                transaction.succeed(self.relayed_addr)
             else:
                 transaction.fail(TransactionError("No allocation in response"))
 
-    def _stun_allocate_error(self, msg, addr):
+    def _stun_refresh_success(self, msg, addr):
         transaction = self._transactions.get(msg.transaction_id)
         if transaction:
-            error_code = msg.get_attr(stun.ATTR_ERROR_CODE)
-            if not isinstance(self.credential_mechanism, LongTermCredentialMechanism):
-                nonce = msg.get_attr(stun.ATTR_NONCE)
-                realm = str(msg.get_attr(stun.ATTR_REALM))
-                self.credential_mechanism = LongTermCredentialMechanism(nonce, realm, 'username', 'password')
-                logger.debug("Allocation failed: %s", error_code)
-                transaction.addCallback(lambda result: self.allocate(addr))
-            else:
-                logger.error("Allocation failed: %s", error_code)
-                transaction.fail(TransactionError(error_code))
-
-    def _stun_refresh_success(self, msg, addr):
-        self._stun_unhandeled(msg, addr)
-
-    def _stun_refresh_error(self, msg, addr):
-        # If time_to_expiry == 0 and error 437 (Allocation Mismatch)
-        # consider transaction a success
-        self.errback(msg.format())
+            lifetime = msg.get_attr(turn.ATTR_LIFETIME)
+            transaction.succeed(lifetime.time_to_expiry if lifetime else None)
 
     def _stun_data_indication(self, msg, addr):
-        self._stun_unhandeled(msg, addr)
+        """
+        :see: http://tools.ietf.org/html/rfc5766#section-10.4
+        """
+        peer_addr = msg.get_attr(turn.ATTR_XOR_PEER_ADDRESS)
+        data = msg.get_attr(turn.ATTR_DATA)
+        if peer_addr and data is not None:
+            self.data_received(data, (peer_addr.address, peer_addr.port))
+
+    def _channel_data_received(self, channel_number, data, addr):
+        """
+        :see: http://tools.ietf.org/html/rfc5766#section-11.6
+        """
+        peer_addr = self._channels.get(channel_number)
+        if peer_addr:
+            self.data_received(data, peer_addr)
+        else:
+            self.dropped += 1
@@ -0,0 +1,202 @@
+import os
+import re
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+def split_port_range(min_port, max_port, count):
+    """Split a port range into count disjoint ranges of an even size
+    :returns: list of (min, max) port ranges
+    """
+    size = (max_port - min_port + 1) // count & ~1
+    if size < 2:
+        raise ValueError("Port range {}-{} too small for {} ranges"
+                         .format(min_port, max_port, count))
+    ranges = [(min_port + i * size, min_port + (i + 1) * size - 1) for i in range(count)]
+    ranges[-1] = (ranges[-1][0], max_port)
+    return ranges
+
+
+class RelayPortPool(object):
+    """Relay ports of a configured range, tracked in a bitmap
+    Each port has a state byte, free ports are searched with a precompiled
+    pattern. Sockets of released ports are kept bound (idle) for reuse, so
+    allocating a relay rarely has to bind a socket.
+    Like the protocols, the pool does no I/O. The sockets of its driver bind
+    and close the ports (sockets.bind(port) returns False if the port is
+    unavailable), the datagrams they read go to datagram_received and the
+    datagrams the relays send come out of datagrams_to_send, with wakeup
+    called when there is something to send.
+    :see: http://tools.ietf.org/html/rfc5766#section-6.2
+    """
+    FREE = 0        # no socket
+    IDLE = 1        # socket bound, no allocation
+    USED = 2        # socket bound, allocated
+    RESERVED = 3    # socket bound, held by a reservation token
+    UNAVAILABLE = 4 # failed to bind
+
+    _free_pattern = re.compile(b'\x00')
+    _idle_pattern = re.compile(b'\x01')
+    _available = re.compile(b'[\x00\x01]')
+    _available_pair = re.compile(b'[\x00\x01]{2}')
+
+    reservation_lifetime = 30
+
+    def __init__(self, server, min_port=49152, max_port=65535, max_idle=1024):
+        """
+        :param server: TurnUdpServer providing the timers
+        :param max_idle: Maximum number of idle sockets kept bound
+        """
+        self.server = server
+        self.min_port = min_port
+        self.max_port = max_port
+        self.max_idle = max_idle
+        self.sockets = None # of the driver
+        self.wakeup = None
+        self._states = bytearray(max_port - min_port + 1)
+        self._relays = {} # allocated port -> Relay
+        self._reservations = {} # token -> (port, Timer)
+        self._idle_count = 0
+        self._cursor = 0
+        self._outgoing = [] # (port, datagram, addr)
+
+    def prebind(self, count):
+        """Bind up to count idle sockets ahead of the allocations
+        """
+        while self._idle_count < min(count, self.max_idle):
+            index = self._search(self._free_pattern, False)
+            if index is None:
+                break
+            if self._bind(index):
+                self._set_idle(index)
+
+    def _search(self, pattern, even):
+        states = self._states
+        cursor = self._cursor
+        for start, end in ((cursor, len(states)), (0, min(cursor + 1, len(states)))):
+            pos = start
+            while True:
+                match = pattern.search(states, pos, end)
+                if not match:
+                    break
+                index = match.start()
+                if even and (self.min_port + index) & 1:
+                    pos = index + 1
+                    continue
+                return index
+
+    def _bind(self, index):
+        if self._states[index] == self.IDLE:
+            self._idle_count -= 1
+            return True
+        port = self.min_port + index
+        if not self.sockets.bind(port):
+            logger.warning("Relay port %d unavailable", port)
+            self._states[index] = self.UNAVAILABLE
+            return False
+        return True
+
+    def _set_idle(self, index):
+        self._states[index] = self.IDLE
+        self._idle_count += 1
+
+    def allocate(self, relay, even=False, reserve=False):
+        """Allocate a relay port to relay
+        :param even: Allocate an even port
+        :param reserve: Allocate an even port N and reserve N+1
+        :returns: (port, reservation token), (None, None) if exhausted
+        """
+        while True:
+            if reserve:
+                index = self._search(self._available_pair, True)
+            else:
+                index = self._search(self._idle_pattern, even)
+                if index is None:
+                    index = self._search(self._available, even)
+            if index is None:
+                logger.warning("Relay ports exhausted")
+                return None, None
+            if not self._bind(index):
+                continue
+            token = None
+            if reserve:
+                token = self._reserve(index + 1)
+                if not token:
+                    self._set_idle(index)
+                    continue
+            self._states[index] = self.USED
+            self._cursor = index + 1 if index + 1 < len(self._states) else 0
+            port = self.min_port + index
+            self._relays[port] = relay
+            return port, token
+
+    def _reserve(self, index):
+        if not self._bind(index):
+            return None
+        self._states[index] = self.RESERVED
+        token = os.urandom(8)
+        timer = self.server.timers.schedule(self.reservation_lifetime,
+                                            self._expire_reservation, token)
+        self._reservations[token] = (self.min_port + index, timer)
+        return token
+
+    def _expire_reservation(self, token):
+        port, _timer = self._reservations.pop(token)
+        logger.info("Reservation of relay port %d expired", port)
+        self._recycle(port)
+
+    def allocate_reserved(self, relay, token):
+        """Allocate the port held by a reservation token to relay
+        :returns: the port, None if the token is unknown or expired
+        """
+        port, timer = self._reservations.pop(bytes(token), (None, None))
+        if port is None:
+            return None
+        timer.cancel()
+        self._states[port - self.min_port] = self.USED
+        self._relays[port] = relay
+        return port
+
+    def release(self, port):
+        """Detach the relay of an allocated port and recycle its socket
+        """
+        del self._relays[port]
+        self._recycle(port)
+
+    def _recycle(self, port):
+        index = port - self.min_port
+        if self._idle_count < self.max_idle:
+            self._set_idle(index)
+        else:
+            self._states[index] = self.FREE
+            self.sockets.close(port)
+
+    def datagram_received(self, port, datagram, addr, now):
+        """Hand a datagram read from a relay port to its relay
+        Idle and reserved ports drop them.
+        """
+        relay = self._relays.get(port)
+        if relay is not None:
+            relay.datagram_received(datagram, addr, now)
+
+    def write(self, port, datagram, addr):
+        """Queue a datagram for the driver to send from a relay port
+        """
+        self._outgoing.append((port, datagram, addr))
+        if len(self._outgoing) == 1 and self.wakeup is not None:
+            self.wakeup()
+
+    def datagrams_to_send(self):
+        """
+        :returns: the [(port, datagram, addr)] queued since the last call
+        """
+        outgoing = self._outgoing
+        if outgoing:
+            self._outgoing = []
+        return outgoing
+
+    @property
+    def available(self):
+        return self._states.count(self.FREE) + self._states.count(self.IDLE)
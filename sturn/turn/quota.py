@@ -0,0 +1,79 @@
+class TokenBucket(object):
+    """Byte rate limit, refilled lazily when tokens are taken
+    """
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp')
+
+    def __init__(self, rate, burst, now):
+        """
+        :param rate: Bytes per second
+        :param burst: Bucket size in bytes
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = now
+
+    def consume(self, size, now):
+        """Take size tokens if available
+        :returns: False if the bucket holds less than size tokens
+        """
+        tokens = self.tokens + (now - self.stamp) * self.rate
+        if tokens > self.burst:
+            tokens = self.burst
+        self.stamp = now
+        if tokens < size:
+            self.tokens = tokens
+            return False
+        self.tokens = tokens - size
+        return True
+
+    def __repr__(self):
+        return "TokenBucket(rate={}, burst={}, tokens={:.0f})".format(
+            self.rate, self.burst, self.tokens)
+
+
+class UserQuotas(object):
+    """Allocation quota and shared rate limit of each user
+    Shared by the servers of all transports, like their RelayPortPool, so
+    the limits hold per user and not per transport.
+    """
+
+    def __init__(self, limits=None):
+        """
+        :param limits: Limits of TurnUdpServer, 0 or missing for unlimited
+        """
+        self.limits = limits or {}
+        self.allocations = {} # USERNAME -> number of allocations
+        self.buckets = {} # USERNAME -> TokenBucket shared by the allocations
+
+    def allocation_allowed(self, username):
+        quota = self.limits.get('allocations_per_user')
+        return not quota or self.allocations.get(username, 0) < quota
+
+    def add_allocation(self, username, now):
+        """Count an allocation of the user
+        :returns: tuple of the TokenBuckets limiting the allocation
+        """
+        self.allocations[username] = self.allocations.get(username, 0) + 1
+        limits = self.limits
+        buckets = []
+        rate = limits.get('allocation_rate')
+        if rate:
+            buckets.append(TokenBucket(rate, limits.get('allocation_burst') or rate, now))
+        rate = limits.get('user_rate')
+        if rate:
+            bucket = self.buckets.get(username)
+            if bucket is None:
+                bucket = self.buckets[username] = TokenBucket(
+                    rate, limits.get('user_burst') or rate, now)
+            buckets.append(bucket)
+        return tuple(buckets)
+
+    def remove_allocation(self, username):
+        """Release an allocation, the user's bucket with the last one
+        """
+        count = self.allocations.pop(username, 1) - 1
+        if count:
+            self.allocations[username] = count
+        else:
+            self.buckets.pop(username, None)
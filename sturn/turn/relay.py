@@ -1,5 +1,5 @@
-from twisted.internet.protocol import DatagramProtocol
-from ..stun.agent import Address, Message
+from ..stun.agent import Address
+import struct
 import logging
 from .. import stun, turn
 from . import attributes
@@ -8,7 +8,19 @@ from . import attributes
 logger = logging.getLogger(__name__)
 
 
-class Relay(DatagramProtocol):
+_channel_data = struct.Struct('>2H')
+
+
+def encode_channel_data(channel_number, data):
+    """Frame data in a ChannelData message
+    :see: http://tools.ietf.org/html/rfc5766#section-11.4
+    """
+    return b''.join((_channel_data.pack(channel_number, len(data)), data))
+
+
+class Relay(object):
+    """Allocation of a client, relaying through a port of the server's pool
+    """
     relay_addr = (None, None, None)
 
     def __init__(self, server, client_addr):
@@ -18,53 +30,158 @@ class Relay(DatagramProtocol):
         # Authentication information
         self.hmac_key = None
         self.nonce = None
+        self.username = None
+
+        self.buckets = () # TokenBuckets limiting the relayed bytes
 
         self.time_to_expiry = 10 * 60
-        self.permissions = []#('ipaddr', 'lifetime'),]
-        self._channels = {} # channel to peer bindings
+        self._timer = None
+        self.permissions = {} # peer host -> Timer expiring the permission
+        self._channels = {} # channel number -> peer address
+        self._peers = {} # peer address -> channel number
+        self._channel_timers = {} # channel number -> Timer
 
 
     @classmethod
-    def allocate(cls, server, client_addr, port=0):
+    def allocate(cls, server, client_addr, even_port=False, reserve=False,
+                 reservation_token=None):
+        """Allocate a port of the server's port pool to a relay
+        :param reservation_token: Token of a port reserved by an earlier allocation
+        :returns: (relay, reservation token), (None, None) if no port is available
+        """
         relay = cls(server, client_addr)
-        port = server.reactor.listenUDP(port, relay, server.interface)
-        family = Address.aftof(relay.transport.socket.family)
-        relay_ip, port = relay.transport.socket.getsockname()[:2]
-        relay.relay_addr = (family, port, relay_ip)
+        token = None
+        if reservation_token:
+            port = server.ports.allocate_reserved(relay, reservation_token)
+        else:
+            port, token = server.ports.allocate(relay, even_port, reserve)
+        if not port:
+            return None, None
+        # The relay ports are bound to the interface of the server
+        relay.relay_addr = (Address.aftof(server.family), port, server.interface or '0.0.0.0')
         logger.info("%s Allocated", relay)
-        return relay
+        return relay, token
+
+    def refresh(self, time_to_expiry):
+        """(Re)schedule the expiry of the allocation
+        :see: http://tools.ietf.org/html/rfc5766#section-7.2
+        """
+        self.time_to_expiry = time_to_expiry
+        if self._timer:
+            self._timer.reset(time_to_expiry)
+        else:
+            self._timer = self.server.timers.schedule(
+                time_to_expiry, self.server.deallocate, self)
 
-    def add_permission(self, peer_addr):
-        logger.info("%s Added permission for %s", self, peer_addr)
-        self.permissions.append(peer_addr)
+    def close(self):
+        """Release the relayed transport address and all timers
+        """
+        logger.info("%s Closed", self)
+        for timer in [self._timer] + list(self.permissions.values()) + \
+                list(self._channel_timers.values()):
+            if timer:
+                timer.cancel()
+        self.permissions.clear()
+        self._channels.clear()
+        self._peers.clear()
+        self._channel_timers.clear()
+        self.server.ports.release(self.relay_addr[1])
+
+    def add_permission(self, host):
+        """Install or refresh the permission for a peer host
+        :see: http://tools.ietf.org/html/rfc5766#section-8
+        """
+        timer = self.permissions.get(host)
+        if timer:
+            timer.reset(turn.PERMISSION_LIFETIME)
+        else:
+            logger.info("%s Added permission for %s", self, host)
+            self.permissions[host] = self.server.timers.schedule(
+                turn.PERMISSION_LIFETIME, self._expire_permission, host)
+
+    def _expire_permission(self, host):
+        logger.info("%s Permission for %s expired", self, host)
+        del self.permissions[host]
+
+    def bind_channel(self, channel_number, peer_addr):
+        """Bind or refresh the binding of a channel to a peer
+        :returns: False if the channel or the peer is bound elsewhere
+        :see: http://tools.ietf.org/html/rfc5766#section-11.2
+        """
+        if not turn.CHANNEL_NUMBER_MIN <= channel_number <= turn.CHANNEL_NUMBER_MAX:
+            return False
+        if self._channels.get(channel_number, peer_addr) != peer_addr:
+            return False
+        if self._peers.get(peer_addr, channel_number) != channel_number:
+            return False
+        timer = self._channel_timers.get(channel_number)
+        if timer:
+            timer.reset(turn.CHANNEL_LIFETIME)
+        else:
+            logger.info("%s Bound channel %#06x to %s:%d", self, channel_number, *peer_addr)
+            self._channels[channel_number] = peer_addr
+            self._peers[peer_addr] = channel_number
+            self._channel_timers[channel_number] = self.server.timers.schedule(
+                turn.CHANNEL_LIFETIME, self._expire_channel, channel_number)
+        # Binding a channel installs or refreshes the permission of the peer
+        self.add_permission(peer_addr[0])
+        return True
+
+    def _expire_channel(self, channel_number):
+        logger.info("%s Channel %#06x expired", self, channel_number)
+        del self._channel_timers[channel_number]
+        del self._peers[self._channels.pop(channel_number)]
 
     def send(self, data, addr):
         logger.info("%s -> %s:%d", self, *addr)
         host, _port = addr
         if host in self.permissions:
-            self.transport.write(data, addr)
+            if self.buckets and not self._admit(len(data), self.server.now):
+                return
+            self.server.ports.write(self.relay_addr[1], data, addr)
         else:
             logger.warning("No permissions for %s: Dropping Send request", host)
             logger.debug(data.hex())
 
-    def datagramReceived(self, datagram, addr):
+    def _admit(self, size, now):
+        """Take size bytes from the rate limits of the allocation
+        """
+        for bucket in self.buckets:
+            if not bucket.consume(size, now):
+                self.server.throttled += 1
+                return False
+        return True
+
+    def send_channel_data(self, channel_number, data):
+        """Relay ChannelData from the client to the peer bound to the channel
+        :see: http://tools.ietf.org/html/rfc5766#section-11.6
         """
+        peer_addr = self._channels.get(channel_number)
+        if peer_addr:
+            self.send(data, peer_addr)
+        else:
+            logger.warning("%s No peer bound to channel %#06x", self, channel_number)
+
+    def datagram_received(self, datagram, addr, now):
+        """Relay a datagram from a peer to the client
         :see: http://tools.ietf.org/html/rfc5766#section-10.3
         """
         logger.info("%s <- %s:%d", self, *addr)
         host, port = addr
         if host in self.permissions:
-            channel = self._channels.get(addr)
-            if channel:
-                # TODO: send channel message to client
-                raise NotImplementedError("Send channel message")
+            if self.buckets and not self._admit(len(datagram), now):
+                return
+            channel_number = self._peers.get(addr)
+            if channel_number:
+                data = encode_channel_data(channel_number, datagram)
             else:
-                msg = Message.encode(turn.METHOD_DATA,
-                                     stun.CLASS_INDICATION)
-                family = Address.aftof(self.transport.addressFamily)
+                msg = self.server.writer.begin(turn.METHOD_DATA,
+                                               stun.CLASS_INDICATION)
+                family = Address.aftof(self.server.family)
                 msg.add_attr(attributes.XorPeerAddress, family, port, host)
-                msg.add_attr(attributes.Data, datagram)
-            self.server.transport.write(msg, self.client_addr)
+                msg.write_attr(turn.ATTR_DATA, datagram)
+                data = msg.finalize()
+            self.server.write(data, self.client_addr)
         else:
             logger.warning("No permissions for %s: Dropping datagram", host)
             logger.debug(datagram.hex())
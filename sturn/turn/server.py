@@ -1,20 +1,51 @@
 from ..stun.server import StunUdpServer
 from .. import turn, stun
-from ..stun.attributes import ErrorCode, XorMappedAddress
+from ..stun.attributes import ErrorCode, XorMappedAddress, Software, Realm, Nonce
+from ..stun.template import ResponseTemplate
 from .attributes import XorRelayedAddress, ReservationToken, Lifetime
 from ..stun.agent import Address
 from .relay import Relay
+from .ports import RelayPortPool
+from .quota import UserQuotas
 
 
 class TurnUdpServer(StunUdpServer):
     max_lifetime = 3600
     default_lifetime = 600
 
-    def __init__(self, reactor, interface, port, software, credential_mechanism, overrides):
-        StunUdpServer.__init__(self, reactor, interface, port, software, overrides)
+    def __init__(self, interface, port, software, credential_mechanism, overrides,
+                 relay_ports=(49152, 65535), prebind_ports=0, quotas=None):
+        """
+        :param relay_ports: (min, max) range of the relayed transport address ports
+        :param prebind_ports: Number of relay sockets to bind at startup
+        :param quotas: Limits, 0 or missing for unlimited:
+            allocations_per_user: Number of allocations of a user
+            allocation_rate, allocation_burst: Relayed bytes/s (and bucket
+                size in bytes) of each allocation
+            user_rate, user_burst: Relayed bytes/s (and bucket size in bytes)
+                shared by all allocations of a user
+        """
+        StunUdpServer.__init__(self, interface, port, software, overrides)
         self._relays = {}
+        self.ports = RelayPortPool(self, *relay_ports)
+        self.prebind_ports = prebind_ports
+        self.user_quotas = UserQuotas(quotas)
+        self.throttled = 0 # datagrams dropped by the rate limits
+
+        self.metrics.gauge('sturn_allocations', "Allocations", lambda: len(self._relays))
+        self.metrics.gauge('sturn_permissions', "Permissions of all allocations",
+                           lambda: sum(len(relay.permissions)
+                                       for relay in list(self._relays.values())))
+        self.metrics.gauge('sturn_channels', "Channels bound by all allocations",
+                           lambda: sum(len(relay._channels)
+                                       for relay in list(self._relays.values())))
+        self.metrics.gauge('sturn_relay_ports_available', "Relay ports not allocated",
+                           lambda: self.ports.available)
+        self.metrics.counter('sturn_throttled_total', "Datagrams dropped by the rate limits",
+                             lambda: self.throttled)
         self.credential_mechanism = credential_mechanism
         self.overrides = overrides
+        self._challenge_templates = {} # method -> ResponseTemplate
 
         self._handlers.update({
             # Allocate handlers
@@ -34,42 +65,81 @@ class TurnUdpServer(StunUdpServer):
                 self._stun_channel_bind_request,
             })
 
+    def start(self, now):
+        StunUdpServer.start(self, now)
+        self.ports.prebind(self.prebind_ports)
+
+    def stats(self):
+        stats = StunUdpServer.stats(self)
+        stats['allocations'] = len(self._relays)
+        stats['relay_ports_available'] = self.ports.available
+        stats['throttled'] = self.throttled
+        return stats
+
+    def _challenge(self, msg, addr):
+        """Respond with a 401 (Unauthorized) error carrying REALM and NONCE
+        :see: http://tools.ietf.org/html/rfc5389#section-10.2.2
+        """
+        template = self._challenge_templates.get(msg.msg_method)
+        if template is None:
+            template = ResponseTemplate(msg.msg_method, stun.CLASS_RESPONSE_ERROR)
+            template.add_attr(ErrorCode, *stun.ERR_UNAUTHORIZED)
+            template.add_attr(Realm, self.credential_mechanism.realm)
+            template.add_variable_attr(Nonce, self.credential_mechanism.nonces.length)
+            template.add_attr(Software, self.software)
+            self._challenge_templates[msg.msg_method] = template
+        self.handler_metrics(msg.msg_method, msg.msg_class).errors.value += 1
+        nonce = self.credential_mechanism.nonces.generate(addr)
+        self.write(template.render(msg.transaction_id, values=(nonce,)), addr)
+
+    def _authenticate(self, msg, addr):
+        """Verify the long-term credentials of a request, reject it if invalid
+        :returns: HMAC key of the requesting user, None if the request was rejected
+        :see: http://tools.ietf.org/html/rfc5389#section-10.2.2
+        """
+        hmac_key, error = self.credential_mechanism.authenticate(msg, addr)
+        if error == stun.ERR_UNAUTHORIZED:
+            self._challenge(msg, addr)
+        elif error:
+            response = self.create_response(msg, stun.CLASS_RESPONSE_ERROR)
+            response.add_attr(ErrorCode, *error)
+            if error == stun.ERR_STALE_NONCE:
+                self.credential_mechanism.challenge(response, addr)
+            self.respond(response, addr)
+        return hmac_key
+
     def _stun_allocate_request(self, msg, addr):
         """
         :see: http://tools.ietf.org/html/rfc5766#section-6.2
         """
-        # Detect retransmission, resend success response
-        relay_allocation = self._relays.get(addr)
-        if relay_allocation and relay_allocation.transaction_id == msg.transaction_id:
-            # TODO: handle allocate retransmission
-            raise NotImplementedError("Allocation retransmission")
-
         # 1. require request to be authenticated
-        message_integrity = msg.get_attr(stun.ATTR_MESSAGE_INTEGRITY)
-        if not message_integrity:
-            response = msg.create_response(stun.CLASS_RESPONSE_ERROR)
-            response.add_attr(ErrorCode, *stun.ERR_UNAUTHORIZED)
-            self.respond(response, addr)
+        hmac_key = self._authenticate(msg, addr)
+        if not hmac_key:
             return
 
         # 2. Check if the 5-tuple is currently in use
+        relay_allocation = self._relays.get(addr)
         if relay_allocation:
-            response = msg.create_response(stun.CLASS_RESPONSE_ERROR)
+            if relay_allocation.transaction_id == msg.transaction_id:
+                # Retransmission whose response was evicted from the cache
+                self._respond_allocated(msg, addr, relay_allocation, None, hmac_key)
+                return
+            response = self.create_response(msg, stun.CLASS_RESPONSE_ERROR)
             response.add_attr(ErrorCode, *turn.ERR_ALLOCATION_MISMATCH)
-            self.respond(response, addr)
+            self.respond(response, addr, hmac_key)
             return
 
         # 3. Check REQUESTED-TRANSPORT attribute
         requested_transport = msg.get_attr(turn.ATTR_REQUESTED_TRANSPORT)
         if not requested_transport:
-            response = msg.create_response(stun.CLASS_RESPONSE_ERROR)
+            response = self.create_response(msg, stun.CLASS_RESPONSE_ERROR)
             response.add_attr(ErrorCode, *stun.ERR_BAD_REQUEST)
-            self.respond(response, addr)
+            self.respond(response, addr, hmac_key)
             return
         elif requested_transport.protocol != turn.TRANSPORT_UDP:
-            response = msg.create_response(stun.CLASS_RESPONSE_ERROR)
+            response = self.create_response(msg, stun.CLASS_RESPONSE_ERROR)
             response.add_attr(ErrorCode, *turn.ERR_UNSUPPORTED_TRANSPORT_PROTOCOL)
-            self.respond(response, addr)
+            self.respond(response, addr, hmac_key)
             return
 
         # 4. handle DONT-FRAGMENT attribute
@@ -77,49 +147,88 @@ class TurnUdpServer(StunUdpServer):
         # 5. Check RESERVATION-TOKEN attribute
         reservation_token = msg.get_attr(turn.ATTR_RESERVATION_TOKEN)
         even_port = msg.get_attr(turn.ATTR_EVEN_PORT)
-        if reservation_token:
-            if even_port:
-                pass # TODO: reject with 400
-            relay_addr = self.get_reserved_transport_address(reservation_token)
-            # TODO: check that token is in range and has not expired
-            # and that corresponding relayed address is still available
-            # if token not valid, reject with 508
+        if reservation_token and even_port:
+            response = self.create_response(msg, stun.CLASS_RESPONSE_ERROR)
+            response.add_attr(ErrorCode, *stun.ERR_BAD_REQUEST)
+            self.respond(response, addr, hmac_key)
+            return
         # 7. reject with 486 if username allocation quota reached
+        username = bytes(msg.get_attr(stun.ATTR_USERNAME))
+        if not self.user_quotas.allocation_allowed(username):
+            response = self.create_response(msg, stun.CLASS_RESPONSE_ERROR)
+            response.add_attr(ErrorCode, *turn.ERR_ALLOCATION_QUOTA_REACHED)
+            self.respond(response, addr, hmac_key)
+            return
         # 8. reject with 300 if we want to redirect to another server RFC5389
         # 6. Check EVEN-PORT
-        else:
-            relay, token = self._allocate_relay_addr(even_port, addr)
-            relay.transaction_id = msg.transaction_id
-            relay_addr = relay.relay_addr
+        relay, token = self._allocate_relay_addr(even_port, addr, reservation_token)
+        if not relay:
+            # Token unknown or expired, or the port range is exhausted
+            response = self.create_response(msg, stun.CLASS_RESPONSE_ERROR)
+            response.add_attr(ErrorCode, *turn.ERR_INSUFFICIENT_CAPACITY)
+            self.respond(response, addr, hmac_key)
+            return
+        relay.transaction_id = msg.transaction_id
+        self._add_user_allocation(relay, username)
 
         # Determine initial time-to-expiry
-        time_to_expiry = self._time_to_expiry(msg.get_attr(turn.ATTR_LIFETIME))
+        relay.refresh(self._time_to_expiry(msg.get_attr(turn.ATTR_LIFETIME)))
+        self._respond_allocated(msg, addr, relay, token, hmac_key)
 
-        response = msg.create_response(stun.CLASS_RESPONSE_SUCCESS)
-        response.add_attr(XorRelayedAddress, *relay_addr)
+    def _respond_allocated(self, msg, addr, relay, token, hmac_key):
+        response = self.create_response(msg, stun.CLASS_RESPONSE_SUCCESS)
+        response.add_attr(XorRelayedAddress, *relay.relay_addr)
         if token:
             response.add_attr(ReservationToken, token)
-        response.add_attr(Lifetime, time_to_expiry)
-        family = Address.aftof(self.transport.addressFamily)
+        response.add_attr(Lifetime, relay.time_to_expiry)
+        family = Address.aftof(self.family)
         host, port = self.overrides.get('mapped_address', addr)
         response.add_attr(XorMappedAddress, family, port, host)
 
-        self.respond(response, addr)
+        self.respond(response, addr, hmac_key)
+
+    def _allocate_relay_addr(self, even_port, addr, reservation_token=None):
+        """
+        :param even_port: EVEN-PORT attribute, if given the allocated port
+            number will be even and with even_port.reserve the next port
+            number is reserved under the returned token
+        :param reservation_token: RESERVATION-TOKEN attribute of a reserved port
+        :returns: (relay, reservation token), (None, None) if allocation failed
+        """
+        relay, token = Relay.allocate(self, addr, bool(even_port),
+                                      bool(even_port and even_port.reserve),
+                                      reservation_token)
+        if relay:
+            self._relays[addr] = relay
+        return relay, token
+
+    def _add_user_allocation(self, relay, username):
+        """Count an allocation against the user's quota and attach its rate limits
+        """
+        relay.username = username
+        relay.buckets = self.user_quotas.add_allocation(username, self.now)
+
+    def deallocate(self, relay):
+        """Delete an allocation, on expiry or a Refresh with zero lifetime
+        :see: http://tools.ietf.org/html/rfc5766#section-5
+        """
+        if self._relays.get(relay.client_addr) is relay:
+            del self._relays[relay.client_addr]
+            self.user_quotas.remove_allocation(relay.username)
+        relay.close()
 
-    def _allocate_relay_addr(self, even_port, addr):
+    def connection_closed(self, addr):
+        """Delete the allocation of a client whose connection is closed
+        :see: http://tools.ietf.org/html/rfc5766#section-2.1
         """
-        :param even_port: If True, the allocated addres port number will be even
-        :param even_port.reserve: Wether to reserve the next port number and assign a token
-                #TODO: find pair of port-numbers N, N+1 on same IP where
-                #      N is even, set relayed transport addr with N and
-                #      reserve N+1 for atleast 30s (until N released)
-                #      and assign a token to that reservation
+        relay = self._relays.get(addr)
+        if relay:
+            self.deallocate(relay)
+
+    def connection_idle(self, addr):
+        """Keep the connection of an allocation, its lifetime bounds the idle time
         """
-        if even_port:
-            raise NotImplementedError("EVEN-PORT handling")
-        relay = Relay.allocate(self, addr)
-        self._relays[addr] = relay
-        return relay, None
+        return addr not in self._relays
 
     def _time_to_expiry(self, lifetime):
         if lifetime:
@@ -132,52 +241,107 @@ class TurnUdpServer(StunUdpServer):
         """
         :see: http://tools.ietf.org/html/rfc5766#section-7.2
         """
+        hmac_key = self._authenticate(msg, addr)
+        if not hmac_key:
+            return
+
+        relay = self._relays.get(addr)
+        if not relay:
+            response = self.create_response(msg, stun.CLASS_RESPONSE_ERROR)
+            response.add_attr(ErrorCode, *turn.ERR_ALLOCATION_MISMATCH)
+            self.respond(response, addr, hmac_key)
+            return
+
         lifetime = msg.get_attr(turn.ATTR_LIFETIME)
         if lifetime and lifetime.time_to_expiry == 0:
             desired_lifetime = 0
+            self.deallocate(relay)
         else:
             desired_lifetime = self._time_to_expiry(lifetime)
+            relay.refresh(desired_lifetime)
 
-        if desired_lifetime:
-            response = msg.create_response(stun.CLASS_RESPONSE_SUCCESS)
-            response.add_attr(Lifetime, desired_lifetime)
-            self.respond(response, addr)
-        elif addr in self._relays:
-            del self._relays[addr]
+        response = self.create_response(msg, stun.CLASS_RESPONSE_SUCCESS)
+        response.add_attr(Lifetime, desired_lifetime)
+        self.respond(response, addr, hmac_key)
 
     def _stun_create_permission_request(self, msg, addr):
         """
         :see: http://tools.ietf.org/html/rfc5766#section-9.2
         """
         # 1. require request to be authenticated
-        message_integrity = msg.get_attr(stun.ATTR_MESSAGE_INTEGRITY)
-        if not message_integrity:
-            response = msg.create_response(stun.CLASS_RESPONSE_ERROR)
-            response.add_attr(ErrorCode, *stun.ERR_UNAUTHORIZED)
-            self.respond(response, addr)
+        hmac_key = self._authenticate(msg, addr)
+        if not hmac_key:
             return
 
-        relay = self._relays[addr]
-        peer_addr = msg.get_attr(turn.ATTR_XOR_PEER_ADDRESS)
-        relay.add_permission(peer_addr.address)
-        response = msg.create_response(stun.CLASS_RESPONSE_SUCCESS)
-        self.respond(response, addr)
+        relay = self._relays.get(addr)
+        if not relay:
+            response = self.create_response(msg, stun.CLASS_RESPONSE_ERROR)
+            response.add_attr(ErrorCode, *turn.ERR_ALLOCATION_MISMATCH)
+            self.respond(response, addr, hmac_key)
+            return
+
+        peer_addrs = msg.get_attrs(turn.ATTR_XOR_PEER_ADDRESS)
+        if not peer_addrs:
+            response = self.create_response(msg, stun.CLASS_RESPONSE_ERROR)
+            response.add_attr(ErrorCode, *stun.ERR_BAD_REQUEST)
+            self.respond(response, addr, hmac_key)
+            return
+
+        for peer_addr in peer_addrs:
+            relay.add_permission(peer_addr.address)
+        response = self.create_response(msg, stun.CLASS_RESPONSE_SUCCESS)
+        self.respond(response, addr, hmac_key)
 
     def _stun_send_indication(self, msg, addr):
         """
         :see: http://tools.ietf.org/html/rfc5766#section-10.2
         """
-        # TODO: [preliminary implementation]
-        relay = self._relays[addr]
+        # Indications are never answered, invalid ones are silently discarded
+        relay = self._relays.get(addr)
         peer_addr = msg.get_attr(turn.ATTR_XOR_PEER_ADDRESS)
         data = msg.get_attr(turn.ATTR_DATA)
+        if relay is None or peer_addr is None or data is None:
+            self.handler_metrics(msg.msg_method, msg.msg_class).drops.value += 1
+            return
         relay.send(data, (peer_addr.address, peer_addr.port))
 
+    def _channel_data_received(self, channel_number, data, addr):
+        """
+        :see: http://tools.ietf.org/html/rfc5766#section-11.6
+        """
+        relay = self._relays.get(addr)
+        if relay:
+            relay.send_channel_data(channel_number, data)
+        else:
+            self.dropped += 1
+
     def _stun_channel_bind_request(self, msg, addr):
         """
         :see: http://tools.ietf.org/html/rfc5766#section-11.2
         """
-        raise NotImplementedError("ChannelBind request")
+        hmac_key = self._authenticate(msg, addr)
+        if not hmac_key:
+            return
+
+        relay = self._relays.get(addr)
+        if not relay:
+            response = self.create_response(msg, stun.CLASS_RESPONSE_ERROR)
+            response.add_attr(ErrorCode, *turn.ERR_ALLOCATION_MISMATCH)
+            self.respond(response, addr, hmac_key)
+            return
+
+        channel_number = msg.get_attr(turn.ATTR_CHANNEL_NUMBER)
+        peer_addr = msg.get_attr(turn.ATTR_XOR_PEER_ADDRESS)
+        if (not channel_number or not peer_addr or
+                not relay.bind_channel(channel_number.channel_number,
+                                       (peer_addr.address, peer_addr.port))):
+            response = self.create_response(msg, stun.CLASS_RESPONSE_ERROR)
+            response.add_attr(ErrorCode, *stun.ERR_BAD_REQUEST)
+            self.respond(response, addr, hmac_key)
+            return
+
+        response = self.create_response(msg, stun.CLASS_RESPONSE_SUCCESS)
+        self.respond(response, addr, hmac_key)
 
     def __str__(self):
         return ("interface={0.interface}, port={0.port}, "
@@ -23,6 +23,15 @@ ATTR_RESERVATION_TOKEN =   0x0022
 TRANSPORT_UDP = 0x11
 
 
+# Channel numbers available to ChannelBind
+CHANNEL_NUMBER_MIN = 0x4000
+CHANNEL_NUMBER_MAX = 0x7FFE
+
+# Lifetimes in seconds
+PERMISSION_LIFETIME = 5 * 60
+CHANNEL_LIFETIME = 10 * 60
+
+
 # Error codes (class, number) and recommended reason phrases:
 ERR_FORBIDDEN =                         4, 3, "Forbidden"
 ERR_ALLOCATION_MISMATCH =               4,37, "Allocation Mismatch"
@@ -0,0 +1,279 @@
+"""Twisted driver of the sans-IO protocols over UDP
+"""
+import socket
+import logging
+from zope.interface import implementer
+from twisted.internet import defer
+from twisted.internet.error import CannotListenError
+from twisted.internet.address import IPv4Address, IPv6Address
+from twisted.internet.interfaces import IReadDescriptor
+from twisted.internet.protocol import DatagramProtocol
+from twisted.python.failure import Failure
+from . import driver, mmsg
+
+
+logger = logging.getLogger(__name__)
+
+
+@implementer(IReadDescriptor)
+class MMsgPort(object):
+    """Linux UDP transport reading and writing batches of datagrams
+    A readable socket is drained with recvmmsg into reusable buffers and the
+    batch handed to the protocol's datagramsReceived (or datagramReceived per
+    datagram). Writes are queued and flushed with sendmmsg at the end of the
+    batch, or on the next reactor iteration when written outside of one.
+    :see: http://man7.org/linux/man-pages/man2/recvmmsg.2.html
+    """
+    max_batches = 16 # recvmmsg calls per readable event
+
+    def __init__(self, reactor, sock, protocol, batch_size=64, max_size=8192):
+        self.reactor = reactor
+        self.socket = sock
+        self.addressFamily = sock.family
+        self.protocol = protocol
+        self.port = sock.getsockname()[1]
+        self.batch_size = batch_size
+        self.mmsg = mmsg.MMsgSocket(sock, batch_size, max_size)
+        self._queue = []
+        self._reading = False
+        self._flush_call = None
+        self.connected = True
+
+    @property
+    def recv_calls(self):
+        return self.mmsg.recv_calls
+
+    @property
+    def send_calls(self):
+        return self.mmsg.send_calls
+
+    @property
+    def truncated(self):
+        return self.mmsg.truncated
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def logPrefix(self):
+        return type(self.protocol).__name__
+
+    def getHost(self):
+        host, port = self.socket.getsockname()[:2]
+        if self.addressFamily == socket.AF_INET6:
+            return IPv6Address('UDP', host, port)
+        return IPv4Address('UDP', host, port)
+
+    def startReading(self):
+        self.reactor.addReader(self)
+
+    def doRead(self):
+        self._reading = True
+        try:
+            for _ in range(self.max_batches):
+                batch, full = self.mmsg.receive()
+                if batch:
+                    try:
+                        self._dispatch(batch)
+                    finally:
+                        self.flush()
+                if not full:
+                    break
+        finally:
+            self._reading = False
+
+    def _dispatch(self, batch):
+        # Like twisted's udp.Port, an exception of the protocol is logged and
+        # the port keeps reading
+        batch_received = getattr(self.protocol, 'datagramsReceived', None)
+        if batch_received:
+            try:
+                batch_received(batch)
+            except Exception:
+                logger.exception("Unhandled error in %s.datagramsReceived", self.logPrefix())
+            return
+        for datagram, addr in batch:
+            try:
+                self.protocol.datagramReceived(datagram, addr)
+            except Exception:
+                logger.exception("Unhandled error in %s.datagramReceived", self.logPrefix())
+
+    def write(self, datagram, addr):
+        self._queue.append((bytes(datagram), addr))
+        if len(self._queue) >= self.batch_size:
+            self.flush()
+        elif not self._reading and self._flush_call is None:
+            self._flush_call = self.reactor.callLater(0, self.flush)
+
+    def flush(self):
+        """Send the queued datagrams with as few sendmmsg calls as possible
+        """
+        if self._flush_call is not None:
+            if self._flush_call.active():
+                self._flush_call.cancel()
+            self._flush_call = None
+        queue = self._queue
+        if queue:
+            self._queue = []
+            self.mmsg.send(queue)
+
+    def stopListening(self):
+        if not self.connected:
+            return
+        self.flush()
+        self.reactor.removeReader(self)
+        self.connected = False
+        self.socket.close()
+        self.protocol.doStop()
+
+    def connectionLost(self, reason):
+        self.stopListening()
+
+
+def listen_udp(reactor, port, protocol, interface='', batch_size=0, reuse_port=False):
+    """Listen on a UDP port, like reactor.listenUDP
+    :param batch_size: Read and write batches of datagrams with a MMsgPort
+    :param reuse_port: Share the port with other processes through
+        SO_REUSEPORT, the kernel hashes each 5-tuple to one of the sockets
+    :returns: the listening port, the transport of protocol
+    """
+    if not batch_size and not reuse_port:
+        return reactor.listenUDP(port, protocol, interface)
+    family = socket.AF_INET6 if ':' in interface else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_DGRAM)
+    try:
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((interface, port))
+    except socket.error as e:
+        sock.close()
+        raise CannotListenError(interface, port, e)
+    sock.setblocking(False)
+    if not batch_size:
+        # The reactor adopts a duplicate of the descriptor
+        transport = reactor.adoptDatagramPort(sock.fileno(), family, protocol)
+        sock.close()
+        return transport
+    transport = MMsgPort(reactor, sock, protocol, batch_size)
+    protocol.makeConnection(transport)
+    transport.startReading()
+    return transport
+
+
+class DatagramDriver(driver.Driver, DatagramProtocol):
+    """Runs a STUN protocol on a UDP port of the reactor
+    """
+
+    def __init__(self, reactor, protocol):
+        driver.Driver.__init__(self, protocol)
+        self.reactor = reactor
+
+    def seconds(self):
+        return self.reactor.seconds()
+
+    def call_later(self, delay, f):
+        return self.reactor.callLater(delay, f)
+
+    def write(self, datagram, addr):
+        try:
+            self.transport.write(datagram, addr)
+        except OSError as e:
+            self.send_errors += 1
+            logger.debug("Dropping datagram to %s:%d: %s", addr[0], addr[1], e)
+
+    def startProtocol(self):
+        self.start_protocol()
+
+    def stopProtocol(self):
+        self.stop_protocol()
+
+    def datagramReceived(self, datagram, addr):
+        self.datagram_received(datagram, addr)
+
+    def datagramsReceived(self, datagrams):
+        self.datagrams_received(datagrams)
+
+
+class _RelayPortProtocol(DatagramProtocol):
+    def __init__(self, sockets, port):
+        self.sockets = sockets
+        self.port = port
+
+    def datagramReceived(self, datagram, addr):
+        self.sockets.datagram_received(self.port, datagram, addr)
+
+    def datagramsReceived(self, datagrams):
+        self.sockets.datagrams_received(self.port, datagrams)
+
+
+class RelaySockets(driver.RelaySockets):
+    """UDP ports of the reactor bound for a RelayPortPool
+    """
+
+    def __init__(self, reactor, pool, interface='', batch_size=0):
+        driver.RelaySockets.__init__(self, pool)
+        self.reactor = reactor
+        self.interface = interface
+        self.batch_size = batch_size
+        self.ports = {} # port -> listening port
+
+    def seconds(self):
+        return self.reactor.seconds()
+
+    def bind(self, port):
+        try:
+            self.ports[port] = listen_udp(self.reactor, port, _RelayPortProtocol(self, port),
+                                          self.interface, self.batch_size)
+        except CannotListenError:
+            return False
+        return True
+
+    def close(self, port):
+        listening = self.ports.pop(port, None)
+        if listening is not None:
+            listening.stopListening()
+
+    def write(self, port, datagram, addr):
+        listening = self.ports.get(port)
+        if listening is None:
+            return
+        try:
+            listening.write(datagram, addr)
+        except OSError as e:
+            self.send_errors += 1
+            logger.debug("Dropping datagram to %s:%d: %s", addr[0], addr[1], e)
+
+
+def relay_sockets(reactor, protocol, batch_size=0):
+    """Bind the relay ports of a TURN protocol with the reactor
+    Pools shared by the protocols of several transports are bound once.
+    """
+    pool = getattr(protocol, 'ports', None)
+    if pool is not None and pool.sockets is None:
+        RelaySockets(reactor, pool, protocol.interface, batch_size)
+
+
+def listen(reactor, protocol, reuse_port=False, batch_size=0):
+    """Run a STUN protocol on its UDP port
+    :returns: the DatagramDriver, driver.transport is the listening port
+    """
+    relay_sockets(reactor, protocol, batch_size)
+    datagram_driver = DatagramDriver(reactor, protocol)
+    listen_udp(reactor, protocol.port, datagram_driver, protocol.interface, batch_size,
+               reuse_port)
+    return datagram_driver
+
+
+def deferred(future):
+    """Deferred firing with the result of a Future of a protocol
+    """
+    d = defer.Deferred()
+
+    def done(future):
+        if future.cancelled():
+            d.cancel()
+        elif future.exception() is not None:
+            d.errback(Failure(future.exception()))
+        else:
+            d.callback(future.result())
+    future.add_done_callback(done)
+    return d
@@ -0,0 +1,136 @@
+import math
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+class Timer(object):
+    """Timer scheduled on a TimerWheel, mirrors twisted's DelayedCall API
+    """
+    __slots__ = ('wheel', 'expires', 'callback', 'args', '_slot')
+
+    def __init__(self, wheel, expires, callback, args):
+        self.wheel = wheel
+        self.expires = expires # tick
+        self.callback = callback
+        self.args = args
+        self._slot = None
+
+    def active(self):
+        return self._slot is not None
+
+    def cancel(self):
+        if self._slot is not None:
+            self._slot.discard(self)
+            self._slot = None
+
+    def reset(self, delay):
+        """Reschedule the timer to expire delay seconds from now
+        """
+        self.cancel()
+        self.wheel._insert(self, delay)
+
+    def getTime(self):
+        return self.expires * self.wheel.resolution
+
+
+class TimerWheel(object):
+    """Hierarchical timing wheel
+    Level 0 has a slot per tick, each slot of a higher level spans a whole
+    revolution of the level below. Timers cascade down a level when the
+    wheel turns past their slot. Scheduling, cancelling and resetting a
+    timer is O(1), expired timers are reaped a slot at a time by advance.
+    """
+
+    def __init__(self, resolution=1., now=0., bits=(8, 6, 6, 6)):
+        """
+        :param resolution: Seconds per tick
+        :param bits: log2 of the number of slots of each level
+        """
+        self.resolution = resolution
+        self._tick = int(now / resolution)
+        self._levels = []
+        shift = 0
+        for level_bits in bits:
+            slots = [set() for _ in range(1 << level_bits)]
+            self._levels.append((shift, (1 << level_bits) - 1, 1 << shift + level_bits, slots))
+            shift += level_bits
+        self._range = 1 << shift
+
+    @property
+    def now(self):
+        return self._tick * self.resolution
+
+    def schedule(self, delay, callback, *args):
+        """Call callback(*args) in delay seconds (rounded up to a tick)
+        """
+        timer = Timer(self, None, callback, args)
+        self._insert(timer, delay)
+        return timer
+
+    def _insert(self, timer, delay):
+        ticks = max(1, int(math.ceil(delay / self.resolution)))
+        timer.expires = self._tick + ticks
+        self._place(timer)
+
+    def _place(self, timer):
+        delta = min(timer.expires - self._tick, self._range - 1)
+        for shift, mask, span, slots in self._levels:
+            if delta < span:
+                break
+        slot = slots[(self._tick + delta) >> shift & mask]
+        slot.add(timer)
+        timer._slot = slot
+
+    def _cascade(self, level):
+        shift, mask, _span, slots = self._levels[level]
+        index = self._tick >> shift & mask
+        timers = slots[index]
+        slots[index] = set()
+        for timer in timers:
+            self._place(timer)
+        return index
+
+    def jump(self, now):
+        """Turn an empty wheel to now, without visiting the ticks in between
+        """
+        self._tick = int(now / self.resolution)
+
+    def advance(self, now):
+        """Turn the wheel to now and call the expired timers
+        :returns: the number of expired timers
+        """
+        target = int(now / self.resolution)
+        expired = 0
+        while self._tick < target:
+            self._tick += 1
+            _shift, mask, _span, slots = self._levels[0]
+            index = self._tick & mask
+            if not index:
+                for level in range(1, len(self._levels)):
+                    if self._cascade(level):
+                        break
+            timers = slots[index]
+            if not timers:
+                continue
+            slots[index] = set()
+            for timer in list(timers):
+                if timer._slot is not timers:
+                    # Cancelled or reset by an earlier callback of the slot
+                    continue
+                if timer.expires > self._tick:
+                    # Beyond the range of the wheel when scheduled
+                    self._place(timer)
+                    continue
+                timer._slot = None
+                expired += 1
+                try:
+                    timer.callback(*timer.args)
+                except Exception:
+                    logger.exception("Timer callback %r failed", timer.callback)
+        return expired
+
+    def __len__(self):
+        return sum(len(slot) for _shift, _mask, _span, slots in self._levels
+                   for slot in slots)
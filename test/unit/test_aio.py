@@ -0,0 +1,90 @@
+#!/usr/bin/env vpython3
+import socket
+import asyncio
+import unittest
+from sturn import stun, mmsg
+from sturn.aio import listen, new_event_loop
+from sturn.stun.agent import Message, MessageWriter
+from sturn.stun.server import StunUdpServer
+from sturn.stun.client import StunUdpClient, TransactionTimeout
+
+
+class AsyncioDriverTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = new_event_loop()
+        self.client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.client.bind(('127.0.0.1', 0))
+        self.client.settimeout(1)
+
+    def tearDown(self):
+        self.client.close()
+        self.loop.close()
+
+    def run_for(self, seconds):
+        self.loop.run_until_complete(asyncio.sleep(seconds))
+
+    def listen(self, protocol, batch_size=0):
+        driver = listen(self.loop, protocol, batch_size=batch_size)
+        self.addCleanup(driver.close)
+        return driver
+
+    def binding(self, port, count=1):
+        requests = [MessageWriter().begin(stun.METHOD_BINDING, stun.CLASS_REQUEST)
+                    for _ in range(count)]
+        for request in requests:
+            self.client.sendto(request.finalize(), ('127.0.0.1', port))
+        self.run_for(0.05)
+        responses = [Message.decode(self.client.recv(2048)) for _ in requests]
+        self.assertEqual([response.transaction_id for response in responses],
+                         [request.transaction_id for request in requests])
+        return responses
+
+    def test_binding(self):
+        driver = self.listen(StunUdpServer('127.0.0.1', 0, 'sturn'))
+        response, = self.binding(driver.endpoint.port)
+        self.assertEqual(response.msg_class, stun.CLASS_RESPONSE_SUCCESS)
+        mapped_address = response.get_attr(stun.ATTR_XOR_MAPPED_ADDRESS)
+        self.assertEqual((mapped_address.address, mapped_address.port),
+                         self.client.getsockname())
+
+    def test_batch(self):
+        server = StunUdpServer('127.0.0.1', 0, 'sturn')
+        batches = []
+        datagrams_received = server.datagrams_received
+        server.datagrams_received = lambda datagrams, now: (
+            batches.append(len(datagrams)), datagrams_received(datagrams, now))
+        driver = self.listen(server, batch_size=8)
+        self.binding(driver.endpoint.port, count=3)
+        self.assertEqual(batches, [3])
+        if mmsg.available:
+            self.assertEqual(driver.endpoint.mmsg.send_calls, 1)
+
+    def test_timer(self):
+        server = StunUdpServer('127.0.0.1', 0, 'sturn')
+        server.timer_resolution = .01
+        self.listen(server)
+        self.run_for(0.1)
+        self.assertGreater(server.timers.now, 0.)
+
+    def test_client(self):
+        server = self.listen(StunUdpServer('127.0.0.1', 0, 'sturn'))
+        client = StunUdpClient('127.0.0.1')
+        client_driver = self.listen(client)
+        transaction = client.bind(('127.0.0.1', server.endpoint.port))
+        result = self.loop.run_until_complete(
+            asyncio.wait_for(asyncio.wrap_future(transaction, loop=self.loop), 1))
+        self.assertEqual(result, ('127.0.0.1', client_driver.endpoint.port))
+        self.assertIsNone(client.get_timer())
+
+    def test_client_timeout(self):
+        client = StunUdpClient('127.0.0.1', RTO=.05, Rc=2, Rm=2)
+        self.listen(client)
+        transaction = client.bind(self.client.getsockname())
+        with self.assertRaises(TransactionTimeout):
+            self.loop.run_until_complete(
+                asyncio.wait_for(asyncio.wrap_future(transaction, loop=self.loop), 1))
+        self.assertEqual(transaction.transmissions, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env vpython3
+import unittest
+from sturn import stun
+from sturn.stun.agent import Message, MessageWriter
+from sturn.stun import attributes
+from sturn.stun.authentication import LongTermCredentialMechanism, StatelessNonces
+from sturn.utils import ha1
+
+
+class LongTermCredentialMechanismTest(unittest.TestCase):
+    def setUp(self):
+        self.realm = b'realm'
+        self.credential_mechanism = LongTermCredentialMechanism(self.realm, {
+            'passuser': {'password': 'password'},
+            'keyuser': {'key': ha1('keyuser', self.realm, 'secret').hex()},
+            })
+        self.writer = MessageWriter()
+        self.addr = ('192.168.2.1', 54321)
+
+    def request(self, username, password, nonce=None, realm=None, integrity=True):
+        msg = self.writer.begin(stun.METHOD_BINDING, stun.CLASS_REQUEST)
+        msg.add_attr(attributes.Software, "sturn")
+        if username:
+            msg.add_attr(attributes.Username, username)
+        msg.add_attr(attributes.Realm, realm or self.realm)
+        msg.add_attr(attributes.Nonce, nonce or self.credential_mechanism.nonces.generate(self.addr))
+        if integrity:
+            msg.add_attr(attributes.MessageIntegrity, ha1(username, self.realm, password))
+        msg.add_attr(attributes.Fingerprint)
+        return Message.decode(msg.finalize(), lazy=True)
+
+    def authenticate(self, *args, **kwargs):
+        return self.credential_mechanism.authenticate(self.request(*args, **kwargs), self.addr)
+
+    def test_authenticate(self):
+        hmac_key, error = self.authenticate('passuser', 'password')
+        self.assertIsNone(error)
+        self.assertEqual(hmac_key, ha1('passuser', self.realm, 'password'))
+
+        hmac_key, error = self.authenticate('keyuser', 'secret')
+        self.assertIsNone(error)
+        self.assertEqual(hmac_key, ha1('keyuser', self.realm, 'secret'))
+
+    def test_reject(self):
+        self.assertEqual(self.authenticate('passuser', 'wrong'),
+                         (None, stun.ERR_UNAUTHORIZED))
+        self.assertEqual(self.authenticate('nobody', 'password'),
+                         (None, stun.ERR_UNAUTHORIZED))
+        self.assertEqual(self.authenticate('passuser', 'password', integrity=False),
+                         (None, stun.ERR_UNAUTHORIZED))
+        self.assertEqual(self.authenticate('passuser', 'password', realm=b'other'),
+                         (None, stun.ERR_UNAUTHORIZED))
+        self.assertEqual(self.authenticate('passuser', 'password', nonce=b'stale'),
+                         (None, stun.ERR_STALE_NONCE))
+
+    def test_tampered(self):
+        data = bytearray(self.request('passuser', 'password').data)
+        data[24] ^= 0xff # Flip a bit in the SOFTWARE attribute
+        msg = Message.decode(bytes(data), lazy=True)
+        self.assertEqual(self.credential_mechanism.authenticate(msg, self.addr),
+                         (None, stun.ERR_UNAUTHORIZED))
+
+
+class StatelessNoncesTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000000.
+        self.nonces = StatelessNonces(lifetime=600, clock=lambda: self.now)
+        self.addr = ('192.168.2.1', 54321)
+
+    def test_validate(self):
+        nonce = self.nonces.generate(self.addr)
+        self.assertEqual(len(nonce), StatelessNonces.length)
+        self.assertTrue(self.nonces.validate(nonce, self.addr))
+        self.assertFalse(self.nonces.validate(nonce, ('192.168.2.1', 54322)))
+        self.assertFalse(self.nonces.validate(nonce, ('192.168.2.2', 54321)))
+        tampered = nonce[:-1] + (b'1' if nonce.endswith(b'0') else b'0')
+        self.assertFalse(self.nonces.validate(tampered, self.addr))
+        self.assertFalse(self.nonces.validate(b'x' * StatelessNonces.length, self.addr))
+        self.assertFalse(self.nonces.validate(b'short', self.addr))
+
+    def test_expiry(self):
+        nonce = self.nonces.generate(self.addr)
+        self.now += 599
+        self.assertTrue(self.nonces.validate(nonce, self.addr))
+        self.now += 2
+        self.assertFalse(self.nonces.validate(nonce, self.addr))
+
+    def test_rotation(self):
+        self.now += 300
+        nonce = self.nonces.generate(self.addr)
+        self.now += 400 # Secret rotated, nonce signed by the previous one
+        self.assertTrue(self.nonces.validate(nonce, self.addr))
+        self.assertNotEqual(self.nonces.generate(self.addr)[8:], nonce[8:])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,48 @@
+#!/usr/bin/env vpython3
+import unittest
+from sturn.metrics import Registry, HandlerMetrics
+from sturn import stun
+
+
+class RegistryTest(unittest.TestCase):
+    def setUp(self):
+        self.registry = Registry()
+
+    def test_render(self):
+        counter = self.registry.counter('requests_total', "Requests", method='binding')
+        counter.inc(3)
+        self.registry.gauge('allocations', "Allocations", lambda: 7)
+        histogram = self.registry.histogram('seconds', "Time", bounds=(.1, 1.))
+        histogram.observe(.05)
+        histogram.observe(.5)
+        histogram.observe(5)
+        self.assertEqual(self.registry.render().splitlines(), [
+            '# HELP allocations Allocations',
+            '# TYPE allocations gauge',
+            'allocations 7',
+            '# HELP requests_total Requests',
+            '# TYPE requests_total counter',
+            'requests_total{method="binding"} 3',
+            '# HELP seconds Time',
+            '# TYPE seconds histogram',
+            'seconds_bucket{le="0.1"} 1',
+            'seconds_bucket{le="1.0"} 2',
+            'seconds_bucket{le="+Inf"} 3',
+            'seconds_sum 5.55',
+            'seconds_count 3',
+            ])
+
+    def test_as_dict(self):
+        metrics = HandlerMetrics(self.registry, stun.METHOD_BINDING, stun.CLASS_REQUEST)
+        metrics.observe(20, .001)
+        metrics.observe(28, .003)
+        values = self.registry.as_dict()
+        labels = '{class="request",method="binding"}'
+        self.assertEqual(values['sturn_messages_total' + labels], 2)
+        self.assertEqual(values['sturn_message_bytes_total' + labels], 48)
+        self.assertEqual(values['sturn_handler_seconds' + labels + '_count'], 2)
+        self.assertAlmostEqual(values['sturn_handler_seconds' + labels + '_sum'], .004)
+
+
+if __name__ == "__main__":
+    unittest.main()
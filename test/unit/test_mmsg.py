@@ -0,0 +1,154 @@
+#!/usr/bin/env vpython3
+import socket
+import unittest
+from twisted.internet.task import Clock
+from twisted.internet.protocol import DatagramProtocol
+from twisted.internet.error import CannotListenError
+from sturn import mmsg, stun, udp
+from sturn.stun.agent import Message
+from sturn.stun.server import StunUdpServer
+
+
+class FakeReactor(Clock):
+    def __init__(self):
+        Clock.__init__(self)
+        self.readers = set()
+
+    def addReader(self, reader):
+        self.readers.add(reader)
+
+    def removeReader(self, reader):
+        self.readers.discard(reader)
+
+
+class EchoProtocol(DatagramProtocol):
+    def __init__(self):
+        self.batches = []
+
+    def datagramsReceived(self, datagrams):
+        self.batches.append(datagrams)
+        for datagram, addr in datagrams:
+            self.transport.write(datagram.upper(), addr)
+
+
+class FailingProtocol(DatagramProtocol):
+    def __init__(self):
+        self.received = []
+
+    def datagramReceived(self, datagram, addr):
+        if datagram == b'fail':
+            raise KeyError(addr)
+        self.received.append(datagram)
+        self.transport.write(datagram.upper(), addr)
+
+
+@unittest.skipUnless(mmsg.available, "recvmmsg/sendmmsg not available")
+class MMsgPortTest(unittest.TestCase):
+    def setUp(self):
+        self.reactor = FakeReactor()
+        self.protocol = EchoProtocol()
+        self.port = udp.listen_udp(self.reactor, 0, self.protocol, '127.0.0.1', batch_size=8)
+        self.peer = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.peer.bind(('127.0.0.1', 0))
+        self.peer.settimeout(1)
+
+    def tearDown(self):
+        self.port.stopListening()
+        self.peer.close()
+
+    def test_batch(self):
+        self.assertIn(self.port, self.reactor.readers)
+        datagrams = [b'datagram %d' % i for i in range(20)]
+        for datagram in datagrams:
+            self.peer.sendto(datagram, ('127.0.0.1', self.port.getHost().port))
+        self.port.doRead()
+        self.assertEqual([len(batch) for batch in self.protocol.batches], [8, 8, 4])
+        received = [datagram for batch in self.protocol.batches for datagram, _ in batch]
+        self.assertEqual(received, datagrams)
+        self.assertEqual(self.protocol.batches[0][0][1], self.peer.getsockname())
+        # One recvmmsg and one sendmmsg per batch
+        self.assertEqual(self.port.recv_calls, 3)
+        self.assertEqual(self.port.send_calls, 3)
+        echoed = [self.peer.recvfrom(2048)[0] for _ in datagrams]
+        self.assertEqual(echoed, [datagram.upper() for datagram in datagrams])
+
+    def test_write_outside_batch(self):
+        self.port.write(b'one', self.peer.getsockname())
+        self.port.write(b'two', self.peer.getsockname())
+        self.assertEqual(self.port.send_calls, 0)
+        self.reactor.advance(0)
+        self.assertEqual(self.port.send_calls, 1)
+        self.assertEqual(self.peer.recvfrom(2048), (b'one', self.port.socket.getsockname()))
+        self.assertEqual(self.peer.recv(2048), b'two')
+
+    def send(self, datagrams, port=None):
+        for datagram in datagrams:
+            self.peer.sendto(datagram, ('127.0.0.1', (port or self.port).getHost().port))
+
+    def test_protocol_error(self):
+        protocol = FailingProtocol()
+        port = udp.listen_udp(self.reactor, 0, protocol, '127.0.0.1', batch_size=8)
+        self.addCleanup(port.stopListening)
+        self.send([b'one', b'fail', b'two'], port)
+        port.doRead()
+        self.assertEqual(protocol.received, [b'one', b'two'])
+        self.assertTrue(port.connected)
+        self.assertEqual([self.peer.recv(2048) for _ in range(2)], [b'ONE', b'TWO'])
+        self.send([b'three'], port)
+        port.doRead()
+        self.assertEqual(protocol.received[-1], b'three')
+
+    def test_truncated(self):
+        self.send([b'x' * 10000, b'small'])
+        self.port.doRead()
+        self.assertEqual([datagram for batch in self.protocol.batches for datagram, _ in batch],
+                         [b'small'])
+        self.assertEqual(self.port.truncated, 1)
+
+    def test_max_batches(self):
+        self.port.max_batches = 2
+        self.send([b'datagram %d' % i for i in range(20)])
+        self.port.doRead()
+        self.assertEqual([len(batch) for batch in self.protocol.batches], [8, 8])
+        self.port.doRead()
+        self.assertEqual([len(batch) for batch in self.protocol.batches], [8, 8, 4])
+
+    def test_cannot_listen(self):
+        self.assertRaises(CannotListenError, udp.listen_udp, self.reactor,
+                          self.port.getHost().port, DatagramProtocol(), '127.0.0.1', 8)
+
+
+@unittest.skipUnless(mmsg.available, "recvmmsg/sendmmsg not available")
+class DatagramDriverTest(unittest.TestCase):
+    def setUp(self):
+        self.reactor = FakeReactor()
+        self.server = StunUdpServer('127.0.0.1', 0, 'sturn')
+        self.driver = udp.listen(self.reactor, self.server, batch_size=8)
+        self.addCleanup(self.driver.transport.stopListening)
+        self.peer = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.peer.bind(('127.0.0.1', 0))
+        self.peer.settimeout(1)
+        self.addCleanup(self.peer.close)
+
+    def test_batch(self):
+        requests = [Message.encode(stun.METHOD_BINDING, stun.CLASS_REQUEST) for _ in range(3)]
+        for request in requests:
+            self.peer.sendto(bytes(request), ('127.0.0.1', self.driver.transport.port))
+        self.driver.transport.doRead()
+        self.assertEqual(self.server.received_stun, 3)
+        # The responses to a batch go out together
+        self.assertEqual(self.driver.transport.send_calls, 1)
+        responses = [Message.decode(self.peer.recv(2048)) for _ in requests]
+        self.assertEqual([response.transaction_id for response in responses],
+                         [request.transaction_id for request in requests])
+
+    def test_timer(self):
+        self.assertEqual([call.getTime() for call in self.reactor.getDelayedCalls()],
+                         [self.server.timer_resolution])
+        self.reactor.advance(self.server.timer_resolution)
+        self.assertEqual(self.server.timers.now, self.server.timer_resolution)
+        self.assertEqual(len(self.reactor.getDelayedCalls()), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
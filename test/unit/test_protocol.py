@@ -0,0 +1,47 @@
+#!/usr/bin/env vpython3
+import unittest
+from sturn import stun
+from sturn.stun.agent import Message
+from sturn.stun.protocol import StunUdpProtocol
+
+
+class RecordingProtocol(StunUdpProtocol):
+    def __init__(self):
+        StunUdpProtocol.__init__(self, '127.0.0.1', 0, 'sturn')
+        self.received = []
+
+    def _stun_received(self, msg, addr):
+        self.received.append(('stun', msg.transaction_id, addr))
+
+    def _channel_data_received(self, channel_number, data, addr):
+        self.received.append(('channel', channel_number, bytes(data), addr))
+
+
+class DemultiplexTest(unittest.TestCase):
+    def setUp(self):
+        self.protocol = RecordingProtocol()
+        self.addr = ('192.168.2.1', 54321)
+
+    def test_stun(self):
+        msg = Message.encode(stun.METHOD_BINDING, stun.CLASS_REQUEST)
+        self.protocol.datagram_received(bytes(msg), self.addr, 0.)
+        self.assertEqual(self.protocol.received, [('stun', msg.transaction_id, self.addr)])
+        self.assertEqual(self.protocol.received_stun, 1)
+
+    def test_channel_data(self):
+        self.protocol.datagram_received(b'\x40\x01\x00\x05hello\x00\x00\x00', self.addr, 0.)
+        self.assertEqual(self.protocol.received, [('channel', 0x4001, b'hello', self.addr)])
+        self.assertEqual(self.protocol.received_channel_data, 1)
+
+    def test_junk(self):
+        msg = bytes(Message.encode(stun.METHOD_BINDING, stun.CLASS_REQUEST))
+        for datagram in (b'', b'\x00', b'\x80\x00\x00\x00', b'\xff' * 64,
+                         msg[:19], msg[:2] + b'\x00\x04' + msg[4:], # Truncated STUN
+                         b'\x40\x01\x00\x08hello'): # Truncated ChannelData
+            self.protocol.datagram_received(datagram, self.addr, 0.)
+        self.assertEqual(self.protocol.received, [])
+        self.assertEqual(self.protocol.dropped, 7)
+
+
+if __name__ == "__main__":
+    unittest.main()
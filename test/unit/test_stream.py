@@ -0,0 +1,138 @@
+#!/usr/bin/env vpython3
+import random
+import unittest
+from twisted.internet.address import IPv4Address
+from twisted.internet.task import Clock
+from twisted.internet.testing import StringTransport
+from sturn import stun
+from sturn.stun.agent import Message
+from sturn.stun.server import StunUdpServer
+from sturn.stream import StreamFramer, StreamPort, FramingError
+
+
+def stun_message(body_length):
+    msg = Message.encode(stun.METHOD_BINDING, stun.CLASS_REQUEST)
+    return (bytes(msg[:2]) + body_length.to_bytes(2, 'big') + bytes(msg[4:20]) +
+            bytes(i & 0xff for i in range(body_length)))
+
+
+class StreamFramerTest(unittest.TestCase):
+    def test_split(self):
+        frames = [stun_message(0), b'\x40\x00\x00\x05hello', stun_message(1024),
+                  b'\x40\x01\x00\x08channels', stun_message(8)]
+        padding = [b'', b'\x00\x00\x00', b'', b'', b'']
+        stream = b''.join(frame + pad for frame, pad in zip(frames, padding))
+        rng = random.Random(0)
+        for _ in range(20):
+            framer = StreamFramer(size=64)
+            received = []
+            offset = 0
+            while offset < len(stream):
+                size = rng.randint(1, 100)
+                received.extend(bytes(frame) for frame in framer.feed(stream[offset:offset+size]))
+                offset += size
+            self.assertEqual(received, frames)
+            self.assertEqual(len(framer), 0)
+            self.assertEqual(framer.capacity, 64)
+
+    def test_wrap(self):
+        framer = StreamFramer(size=32)
+        frame = b'\x40\x00\x00\x10' + bytes(range(16))
+        # Each frame starts 20 bytes further in the ring, every other one wraps
+        for _ in range(10):
+            self.assertEqual([bytes(view) for view in framer.feed(frame + frame[:4])], [frame])
+            self.assertEqual([bytes(view) for view in framer.feed(frame[4:])], [frame])
+
+    def test_grow(self):
+        framer = StreamFramer(size=64)
+        frame = stun_message(4000)
+        self.assertEqual(list(framer.feed(frame[:3000])), [])
+        self.assertGreaterEqual(framer.capacity, len(frame))
+        self.assertEqual([bytes(view) for view in framer.feed(frame[3000:])], [frame])
+        self.assertEqual(framer.capacity, 64)
+
+    def test_invalid(self):
+        for data in (b'\x80\x00\x00\x00', b'\x00\x01\x00\x05' + bytes(16)):
+            with self.assertRaises(FramingError):
+                list(StreamFramer().feed(data))
+
+
+class TcpTransport(StringTransport):
+    def setTcpNoDelay(self, enabled):
+        pass
+
+
+class StreamPortTest(unittest.TestCase):
+    client_addr = ('192.168.2.1', 54321)
+
+    def setUp(self):
+        self.reactor = Clock()
+        self.server = StunUdpServer('127.0.0.1', 3478, 'sturn')
+        self.port = StreamPort(self.reactor, self.server)
+        self.port.start_protocol()
+        self.connection = self.port.buildProtocol(IPv4Address('TCP', *self.client_addr))
+        self.transport = TcpTransport()
+        self.connection.makeConnection(self.transport)
+
+    def test_binding(self):
+        requests = [Message.encode(stun.METHOD_BINDING, stun.CLASS_REQUEST) for _ in range(3)]
+        data = b''.join(bytes(request) for request in requests)
+        self.connection.dataReceived(data[:30])
+        self.connection.dataReceived(data[30:])
+        framer = StreamFramer()
+        responses = [Message.decode(bytes(frame)) for frame in framer.feed(self.transport.value())]
+        self.assertEqual([response.transaction_id for response in responses],
+                         [request.transaction_id for request in requests])
+        address = responses[0].get_attr(stun.ATTR_XOR_MAPPED_ADDRESS)
+        self.assertEqual((address.address, address.port), self.client_addr)
+
+    def test_coalesced_writes(self):
+        self.port.write(b'\x40\x00\x00\x05hello', self.client_addr)
+        self.port.write(b'\x40\x00\x00\x04four', self.client_addr)
+        self.assertEqual(self.transport.value(), b'')
+        self.reactor.advance(0)
+        self.assertEqual(self.transport.value(),
+                         b'\x40\x00\x00\x05hello\x00\x00\x00\x40\x00\x00\x04four')
+
+    def test_congested(self):
+        self.connection.pauseProducing()
+        self.port.write(b'\x40\x00\x00\x05hello', self.client_addr)
+        self.reactor.advance(0)
+        self.assertEqual(self.transport.value(), b'')
+        self.assertEqual(self.port.dropped, 1)
+
+    def test_framing_error(self):
+        self.connection.dataReceived(b'\xff' * 20)
+        self.assertTrue(self.transport.disconnecting)
+        self.connection.connectionLost(None)
+        self.assertEqual(self.port.connections, {})
+
+    def test_first_frame_timeout(self):
+        self.connection.dataReceived(b'\x00\x01')
+        self.reactor.advance(self.port.frame_timeout - 1)
+        self.assertFalse(self.transport.disconnecting)
+        self.reactor.advance(1)
+        self.assertTrue(self.transport.disconnecting)
+        self.assertEqual(self.port.timed_out, 1)
+
+    def test_idle_timeout(self):
+        request = bytes(Message.encode(stun.METHOD_BINDING, stun.CLASS_REQUEST))
+        self.connection.dataReceived(request)
+        self.reactor.advance(self.port.frame_timeout + self.port.idle_timeout - 1)
+        self.assertFalse(self.transport.disconnecting)
+        self.connection.dataReceived(request)
+        self.reactor.advance(self.port.idle_timeout)
+        self.assertFalse(self.transport.disconnecting)
+        self.reactor.advance(self.port.idle_timeout)
+        self.assertTrue(self.transport.disconnecting)
+        self.connection.connectionLost(None)
+        self.assertEqual(len(self.server.timers), 0)
+
+    def test_max_connections(self):
+        self.port.max_connections = 1
+        self.assertIsNone(self.port.buildProtocol(IPv4Address('TCP', '192.168.2.2', 54321)))
+        self.assertEqual(self.port.refused, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
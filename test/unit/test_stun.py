@@ -1,8 +1,13 @@
 #!/usr/bin/env vpython3
 import unittest
 from sturn import stun
-from sturn.stun.agent import Message, Address, Unknown
+from sturn.stun import agent
+from sturn.stun.agent import Message, MessageWriter, Address, Unknown
 from sturn.stun import attributes
+from sturn.stun.template import ResponseTemplate
+from sturn.stun.cache import ResponseCache
+from sturn.stun.client import StunUdpClient, TransactionTimeout
+from sturn.manual import ManualDriver
 from sturn.utils import ha1
 
 class MessageTest(unittest.TestCase):
@@ -36,6 +41,34 @@ class MessageTest(unittest.TestCase):
         fingerprint = self.msg.get_attr(stun.ATTR_FINGERPRINT)
         self.assertEqual(fingerprint, bytes.fromhex('5a4c0c70'))
 
+    def test_decode_lazy(self):
+        msg = Message.decode(bytes(self.msg), lazy=True)
+        self.assertEqual(msg.transaction_id, self.msg.transaction_id)
+        self.assertEqual(msg.length, self.msg.length)
+        self.assertFalse(msg._decoded)
+
+        error_code = msg.get_attr(stun.ATTR_ERROR_CODE)
+        self.assertEqual(error_code.code, 401)
+        self.assertEqual(len(msg._decoded), 1)
+
+        self.assertEqual(msg.get_attr(stun.ATTR_NONCE), b'60327c17145a7788')
+        self.assertEqual(msg.get_attr(stun.ATTR_FINGERPRINT), bytes.fromhex('5a4c0c70'))
+        self.assertEqual(msg._attributes, self.msg._attributes)
+        self.assertEqual(msg.unknown_comp_required_attrs(), ())
+
+    def test_get_attrs(self):
+        msg = Message.encode(stun.METHOD_BINDING, stun.CLASS_REQUEST)
+        msg.add_attr(attributes.MappedAddress, Address.FAMILY_IPv4, 1337, '192.168.2.1')
+        msg.add_attr(attributes.XorMappedAddress, Address.FAMILY_IPv4, 1338, '192.168.2.2')
+        msg.add_attr(attributes.XorMappedAddress, Address.FAMILY_IPv4, 1339, '192.168.2.3')
+
+        for decoded in (msg, Message.decode(bytes(msg)), Message.decode(bytes(msg), lazy=True)):
+            address = decoded.get_attr(stun.ATTR_XOR_MAPPED_ADDRESS, stun.ATTR_MAPPED_ADDRESS)
+            self.assertEqual((address.port, address.address), (1338, '192.168.2.2'))
+            addresses = decoded.get_attrs(stun.ATTR_XOR_MAPPED_ADDRESS)
+            self.assertEqual([a.port for a in addresses], [1338, 1339])
+            self.assertEqual(decoded.get_attrs(stun.ATTR_USERNAME), [])
+
     def test_encode(self):
         msg = Message.encode(stun.METHOD_BINDING,
                              stun.CLASS_REQUEST,
@@ -74,6 +107,256 @@ class MessageTest(unittest.TestCase):
         self.assertEqual(bytes(msg), msg_data)
 
 
+class MessageWriterTest(unittest.TestCase):
+    def encode(self, msg):
+        msg.add_attr(attributes.Username, "johndoe")
+        msg.add_attr(attributes.Realm, b"pexip.com")
+        msg.add_attr(attributes.XorMappedAddress, Address.FAMILY_IPv6, 1337, '2001:db8::1')
+        msg.add_attr(attributes.Software, "sturn 0.1")
+        msg.add_attr(attributes.MessageIntegrity, ha1('username', b'realm', 'password'))
+        msg.add_attr(attributes.Fingerprint)
+
+    def test_finalize(self):
+        msg = Message.encode(stun.METHOD_BINDING, stun.CLASS_REQUEST,
+                             transaction_id=b'fixedtransid')
+        msg._padding = b'\x00'.__mul__
+        self.encode(msg)
+
+        writer = MessageWriter(256)
+        for _ in range(2): # reused buffer yields identical messages
+            self.encode(writer.begin(stun.METHOD_BINDING, stun.CLASS_REQUEST,
+                                     transaction_id=b'fixedtransid'))
+            self.assertEqual(writer.finalize(), bytes(msg))
+
+    def test_overflow(self):
+        writer = MessageWriter(32).begin(stun.METHOD_BINDING, stun.CLASS_REQUEST)
+        self.assertRaises(ValueError, writer.add_attr, attributes.Realm, b'x' * 16)
+
+
+class BatchCodecTest(unittest.TestCase):
+    def setUp(self):
+        self.numpy = agent.numpy
+
+    def tearDown(self):
+        agent.numpy = self.numpy
+
+    def datagrams(self):
+        request = Message.encode(stun.METHOD_BINDING, stun.CLASS_REQUEST,
+                                 transaction_id=b'transaction\0')
+        request.add_attr(attributes.Software, "sturn")
+        request = bytes(request)
+        return [
+            request,
+            b'\x40\x00\x00\x04data', # ChannelData
+            request[:4] + b'\0\0\0\0' + request[8:], # Bad magic cookie
+            request[:-4], # Truncated
+            request[:12],
+            bytes(Message.encode(stun.METHOD_BINDING, stun.CLASS_INDICATION)),
+            ]
+
+    def check_decode_many(self):
+        datagrams = self.datagrams()
+        messages = Message.decode_many(datagrams)
+        self.assertEqual([msg is not None for msg in messages],
+                         [True, False, False, False, False, True])
+        self.assertEqual(messages[0].transaction_id, b'transaction\0')
+        self.assertEqual(messages[0].get_attr(stun.ATTR_SOFTWARE), b'sturn')
+        self.assertEqual((messages[0].msg_method, messages[0].msg_class),
+                         (stun.METHOD_BINDING, stun.CLASS_REQUEST))
+        self.assertEqual((messages[5].msg_method, messages[5].msg_class),
+                         (stun.METHOD_BINDING, stun.CLASS_INDICATION))
+
+        stride = 64
+        packed = b''.join(datagram.ljust(stride, b'\0') for datagram in datagrams)
+        lengths = [len(datagram) for datagram in datagrams]
+        packed_messages = Message.decode_many(packed, lengths)
+        self.assertEqual([bytes(msg) if msg else None for msg in packed_messages],
+                         [bytes(msg) if msg else None for msg in messages])
+
+    def check_encode_many(self):
+        transaction_ids = [b'transaction\0', b'\0' * 12, b'fixedtransid']
+        for family, hosts in ((Address.FAMILY_IPv4, ('10.0.0.1', '192.168.2.255', '0.0.0.0')),
+                              (Address.FAMILY_IPv6, ('::1', '2001:db8::1', 'fe80::ff'))):
+            addrs = list(zip(hosts, (1, 1337, 65535)))
+            responses = Message.encode_many(stun.METHOD_BINDING,
+                                            stun.CLASS_RESPONSE_SUCCESS,
+                                            transaction_ids, addrs, family)
+            for response, transaction_id, (host, port) in zip(responses, transaction_ids, addrs):
+                expected = Message.encode(stun.METHOD_BINDING, stun.CLASS_RESPONSE_SUCCESS,
+                                          transaction_id=transaction_id)
+                expected.add_attr(attributes.XorMappedAddress, family, port, host)
+                self.assertEqual(response, bytes(expected))
+
+    def test_decode_many(self):
+        agent.numpy = None
+        self.check_decode_many()
+
+    def test_encode_many(self):
+        agent.numpy = None
+        self.check_encode_many()
+
+    @unittest.skipUnless(agent.numpy, "numpy not installed")
+    def test_decode_many_numpy(self):
+        self.check_decode_many()
+
+    @unittest.skipUnless(agent.numpy, "numpy not installed")
+    def test_encode_many_numpy(self):
+        self.check_encode_many()
+
+
+class ResponseTemplateTest(unittest.TestCase):
+    def expected(self, transaction_id, family, host, port):
+        msg = Message.encode(stun.METHOD_BINDING, stun.CLASS_RESPONSE_SUCCESS,
+                             transaction_id=transaction_id)
+        msg._padding = b'\x00'.__mul__
+        msg.add_attr(attributes.XorMappedAddress, family, port, host)
+        msg.add_attr(attributes.Software, "sturn")
+        msg.add_attr(attributes.Fingerprint)
+        return bytes(msg)
+
+    def test_render(self):
+        for family, host in ((Address.FAMILY_IPv4, '192.168.2.255'),
+                             (Address.FAMILY_IPv6, '2001:db8::1')):
+            template = ResponseTemplate(stun.METHOD_BINDING,
+                                        stun.CLASS_RESPONSE_SUCCESS, family)
+            template.add_attr(attributes.Software, "sturn")
+            for transaction_id, port in ((b'fixedtransid', 1337), (b'othertransid', 40000)):
+                response = template.render(transaction_id, (host, port))
+                self.assertEqual(bytes(response),
+                                 self.expected(transaction_id, family, host, port))
+                address = Message.decode(response).get_attr(stun.ATTR_XOR_MAPPED_ADDRESS)
+                self.assertEqual((address.address, address.port), (host, port))
+
+    def test_render_variable(self):
+        template = ResponseTemplate(stun.METHOD_BINDING, stun.CLASS_RESPONSE_ERROR)
+        template.add_attr(attributes.ErrorCode, *stun.ERR_STALE_NONCE)
+        template.add_variable_attr(attributes.Nonce, 6)
+        template.add_attr(attributes.Realm, b"realm")
+        for nonce in (b'nonce1', b'nonce2'):
+            msg = Message.decode(template.render(b'fixedtransid', values=(nonce,)))
+            self.assertEqual(msg.get_attr(stun.ATTR_NONCE), nonce)
+            self.assertEqual(msg.get_attr(stun.ATTR_REALM), b"realm")
+            self.assertEqual(msg.get_attr(stun.ATTR_ERROR_CODE).code, 438)
+
+
+
+class ResponseCacheTest(unittest.TestCase):
+    def test_ttl(self):
+        cache = ResponseCache(ttl=40)
+        cache.put('a', b'response', 0)
+        self.assertEqual(cache.get('a', 39.9), b'response')
+        self.assertIsNone(cache.get('a', 40))
+        self.assertEqual((len(cache), cache.size), (0, 0))
+
+    def test_lru(self):
+        cache = ResponseCache(max_bytes=20)
+        cache.put('a', bytes(8), 0)
+        cache.put('b', bytes(8), 0)
+        cache.get('a', 1)
+        cache.put('c', bytes(8), 1)
+        self.assertIsNone(cache.get('b', 1))
+        self.assertEqual(cache.get('a', 1), bytes(8))
+        self.assertEqual(cache.size, 16)
+
+    def test_expired_evicted(self):
+        cache = ResponseCache(ttl=40)
+        cache.put('a', bytes(8), 0)
+        cache.put('b', bytes(8), 40)
+        self.assertEqual(len(cache), 1)
+
+class StunClientTest(unittest.TestCase):
+    server_addr = ('192.168.2.2', 3478)
+
+    def setUp(self):
+        self.driver = ManualDriver()
+        self.client = StunUdpClient('192.168.2.1', 54321)
+        self.outbox = self.driver.connect(self.client)
+        self.results = []
+
+    def advance(self, seconds):
+        steps = int(round(seconds / self.client.timer_resolution))
+        for _ in range(steps):
+            self.driver.advance(self.client.timer_resolution)
+
+    def respond(self, transaction):
+        response = Message.encode(stun.METHOD_BINDING, stun.CLASS_RESPONSE_SUCCESS,
+                                  transaction_id=transaction.transaction_id)
+        response.add_attr(attributes.XorMappedAddress, Address.FAMILY_IPv4, 54321, '192.168.2.1')
+        self.client.datagram_received(bytes(response), self.server_addr, self.driver.now)
+
+    def test_rtt_sample(self):
+        transaction = self.client.bind(self.server_addr)
+        self.advance(.2)
+        self.respond(transaction)
+        self.assertAlmostEqual(transaction.rtt, .2)
+        self.assertEqual(len(self.outbox.written), 1)
+        # SRTT + 4 * RTTVAR
+        self.assertAlmostEqual(self.client.rto(self.server_addr[0]), .6)
+        self.assertEqual(self.client.rto('192.168.2.3'), self.client.RTO)
+        self.assertEqual(len(self.client.timers), 0)
+
+    def test_karn(self):
+        transaction = self.client.bind(self.server_addr)
+        self.advance(.5)
+        self.assertEqual(len(self.outbox.written), 2)
+        self.respond(transaction)
+        self.assertIsNone(transaction.rtt)
+        # The backed off RTO is kept for the next transaction
+        self.assertAlmostEqual(self.client.rto(self.server_addr[0]), 1.)
+        self.driver.advance(self.client.rto_lifetime)
+        self.assertEqual(self.client.rto(self.server_addr[0]), self.client.RTO)
+
+    def test_bind_many(self):
+        servers = [('192.168.2.{}'.format(i), 3478) for i in range(2, 5)]
+        done = self.client.bind_many(servers, count=2, concurrency=2,
+                                     callback=lambda transaction, result: self.results.append(
+                                         (transaction.addr, result)))
+        for _ in range(3):
+            self.assertEqual(len(self.client._transactions), 2)
+            for transaction in list(self.client._transactions.values()):
+                self.respond(transaction)
+        self.assertTrue(done.done())
+        self.assertEqual([addr for addr, _ in self.results], servers + servers)
+        self.assertEqual(set(result for _, result in self.results), {('192.168.2.1', 54321)})
+        self.assertEqual(done.result(), [(addr, ('192.168.2.1', 54321)) for addr in servers * 2])
+
+    def test_bind_many_timeout(self):
+        # Duplicates are probed and reported each
+        done = self.client.bind_many([self.server_addr, self.server_addr])
+        self.advance(60)
+        self.assertEqual([addr for addr, _ in done.result()], [self.server_addr] * 2)
+        self.assertTrue(all(isinstance(result, TransactionTimeout)
+                            for _, result in done.result()))
+
+    def test_idle(self):
+        # The timer wheel only turns while transactions are pending
+        self.assertIsNone(self.client.get_timer())
+        transaction = self.client.bind(self.server_addr)
+        self.assertIsNotNone(self.client.get_timer())
+        self.respond(transaction)
+        self.assertIsNone(self.client.get_timer())
+        self.driver.advance(3600)
+        self.client.bind(self.server_addr)
+        rto = self.client.rto(self.server_addr[0])
+        self.advance(rto - self.client.timer_resolution)
+        self.assertEqual(len(self.outbox.written), 2)
+        self.advance(self.client.timer_resolution)
+        self.assertEqual(len(self.outbox.written), 3)
+
+    def test_time_out(self):
+        transaction = self.client.bind(self.server_addr)
+        transaction.add_done_callback(
+            lambda transaction: self.results.append(type(transaction.exception())))
+        # Requests at 0, .5, 1.5, 3.5, 7.5, 15.5 and 31.5s, then Rm * RTO
+        self.advance(31.5)
+        self.assertEqual(len(self.outbox.written), 7)
+        self.advance(7.9)
+        self.assertEqual(self.results, [])
+        self.advance(.1)
+        self.assertEqual(self.results, [TransactionTimeout])
+        self.assertEqual(self.client._transactions, {})
+
+
 if __name__ == "__main__":
     #import sys;sys.argv = ['', 'Test.testName']
     unittest.main()
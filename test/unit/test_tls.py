@@ -0,0 +1,141 @@
+#!/usr/bin/env vpython3
+import os
+import ssl
+import unittest
+from twisted.internet.address import IPv4Address
+from twisted.internet.task import Clock
+from twisted.internet.testing import StringTransport
+from sturn import stun
+from sturn.stun.agent import Message
+from sturn.stun.server import StunUdpServer
+from sturn.stream import StreamFramer
+from sturn.tls import TlsPort, server_context
+
+
+CERTIFICATE = os.path.join(os.path.dirname(__file__), 'localhost.pem')
+
+
+class TcpTransport(StringTransport):
+    def setTcpNoDelay(self, enabled):
+        pass
+
+
+class TlsClient(object):
+    """Client end of a TLS connection over memory BIOs
+    """
+    def __init__(self, port, addr, context, session=None):
+        self.incoming = ssl.MemoryBIO()
+        self.outgoing = ssl.MemoryBIO()
+        self.tls = context.wrap_bio(self.incoming, self.outgoing, session=session)
+        self.connection = port.buildProtocol(IPv4Address('TCP', *addr))
+        self.transport = TcpTransport()
+        self.connection.makeConnection(self.transport)
+
+    def exchange(self):
+        """Move the records between the client and the server
+        """
+        while True:
+            sent = self.outgoing.read()
+            if sent:
+                self.connection.dataReceived(sent)
+            received = self.transport.value()
+            self.transport.clear()
+            if received:
+                self.incoming.write(received)
+            if not sent and not received:
+                return
+
+    def handshake(self):
+        while True:
+            try:
+                self.tls.do_handshake()
+                break
+            except ssl.SSLWantReadError:
+                if not self.outgoing.pending and self.transport.value() == b'':
+                    raise
+                self.exchange()
+        self.exchange()
+
+    def read(self):
+        self.exchange()
+        chunks = []
+        while True:
+            try:
+                chunks.append(self.tls.read(65536))
+            except ssl.SSLWantReadError:
+                return b''.join(chunks)
+
+    def write(self, data):
+        self.tls.write(data)
+        self.exchange()
+
+
+class TlsPortTest(unittest.TestCase):
+    client_addr = ('192.168.2.1', 54321)
+
+    def setUp(self):
+        self.reactor = Clock()
+        self.server = StunUdpServer('127.0.0.1', 5349, 'sturn')
+        self.port = TlsPort(self.reactor, self.server, server_context(CERTIFICATE))
+        self.port.start_protocol()
+        self.context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        self.context.check_hostname = False
+        self.context.verify_mode = ssl.CERT_NONE
+
+    def binding(self, client):
+        request = Message.encode(stun.METHOD_BINDING, stun.CLASS_REQUEST)
+        client.write(bytes(request))
+        frames = list(StreamFramer().feed(client.read()))
+        self.assertEqual(len(frames), 1)
+        response = Message.decode(bytes(frames[0]))
+        self.assertEqual(response.transaction_id, request.transaction_id)
+        return response
+
+    def test_binding(self):
+        client = TlsClient(self.port, self.client_addr, self.context)
+        client.handshake()
+        self.assertFalse(client.connection.handshaking)
+        self.assertFalse(client.connection.resumed)
+        self.assertGreater(client.connection.handshake_steps, 0)
+        self.assertGreater(client.connection.handshake_cpu, 0)
+        address = self.binding(client).get_attr(stun.ATTR_XOR_MAPPED_ADDRESS)
+        self.assertEqual((address.address, address.port), self.client_addr)
+        self.assertEqual(self.port.full_handshakes.value, 1)
+
+    def test_resumption(self):
+        client = TlsClient(self.port, self.client_addr, self.context)
+        client.handshake()
+        # TLS 1.3 tickets arrive after the handshake
+        self.binding(client)
+        self.assertIsNotNone(client.tls.session)
+        resumed = TlsClient(self.port, ('192.168.2.1', 54322), self.context, client.tls.session)
+        resumed.handshake()
+        self.assertTrue(resumed.tls.session_reused)
+        self.assertTrue(resumed.connection.resumed)
+        self.binding(resumed)
+        self.assertEqual(self.port.full_handshakes.value, 1)
+        self.assertEqual(self.port.resumed_handshakes.value, 1)
+
+    def test_handshake_failure(self):
+        client = TlsClient(self.port, self.client_addr, self.context)
+        client.connection.dataReceived(b'\x16\x03\x01\x00\x05hello')
+        self.assertTrue(client.transport.disconnecting)
+        self.assertEqual(self.port.handshake_failures.value, 1)
+        client.connection.connectionLost(None)
+        self.assertEqual(self.port.connections, {})
+
+    def test_handshake_timeout(self):
+        client = TlsClient(self.port, self.client_addr, self.context)
+        try:
+            client.tls.do_handshake()
+        except ssl.SSLWantReadError:
+            pass
+        # The ClientHello is answered but the handshake never finishes
+        client.connection.dataReceived(client.outgoing.read())
+        self.reactor.advance(self.port.frame_timeout)
+        self.assertTrue(client.transport.disconnecting)
+        self.assertEqual(self.port.timed_out, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
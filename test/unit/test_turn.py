@@ -0,0 +1,465 @@
+#!/usr/bin/env vpython3
+import unittest
+from sturn import stun, turn
+from sturn.stun.agent import Message, MessageWriter, Address
+from sturn.stun import attributes
+from sturn.stun.authentication import LongTermCredentialMechanism
+from sturn.turn import attributes as turn_attributes
+from sturn.turn.server import TurnUdpServer
+from sturn.turn.client import TurnUdpClient
+from sturn.turn.ports import split_port_range
+from sturn.manual import ManualDriver
+from sturn.turn.quota import TokenBucket
+from sturn.utils import ha1
+
+
+class TurnServerTest(unittest.TestCase):
+    client_addr = ('192.168.2.1', 54321)
+    peer_addr = ('192.168.2.2', 40000)
+
+    def setUp(self):
+        self.driver = ManualDriver()
+        self.realm = b'realm'
+        self.credential_mechanism = LongTermCredentialMechanism(
+            self.realm, {'username': {'password': 'password'}})
+        self.hmac_key = ha1('username', self.realm, 'password')
+        self.server = TurnUdpServer('127.0.0.1', 3478, 'sturn',
+                                    self.credential_mechanism, {}, (50000, 50009))
+        self.outbox = self.driver.connect(self.server)
+        self.writer = MessageWriter()
+
+    def request(self, msg_method, *attrs):
+        """Send an authenticated request, return the decoded response
+        """
+        return self.send(self.encode_request(msg_method, *attrs))
+
+    def send(self, request):
+        self.server.datagram_received(request, self.client_addr, self.driver.now)
+        data, addr = self.outbox.written.pop()
+        self.assertEqual(addr, self.client_addr)
+        return Message.decode(data, lazy=True)
+
+    def encode_request(self, msg_method, *attrs):
+        msg = self.writer.begin(msg_method, stun.CLASS_REQUEST)
+        for attr in attrs:
+            msg.add_attr(*attr)
+        msg.add_attr(attributes.Username, 'username')
+        msg.add_attr(attributes.Realm, self.realm)
+        msg.add_attr(attributes.Nonce,
+                     self.credential_mechanism.nonces.generate(self.client_addr))
+        msg.add_attr(attributes.MessageIntegrity, self.hmac_key)
+        msg.add_attr(attributes.Fingerprint)
+        return msg.finalize()
+
+    def allocate(self, lifetime=None, *attrs):
+        attrs = [(turn_attributes.RequestedTransport, turn.TRANSPORT_UDP)] + list(attrs)
+        if lifetime:
+            attrs.append((turn_attributes.Lifetime, lifetime))
+        response = self.request(turn.METHOD_ALLOCATE, *attrs)
+        self.assertEqual(response.msg_class, stun.CLASS_RESPONSE_SUCCESS)
+        relay_addr = response.get_attr(turn.ATTR_XOR_RELAYED_ADDRESS)
+        self.relay = self.server._relays[self.client_addr]
+        self.reservation_token = response.get_attr(turn.ATTR_RESERVATION_TOKEN)
+        return self.driver.ports[relay_addr.port]
+
+    def deallocate(self):
+        response = self.request(turn.METHOD_REFRESH, (turn_attributes.Lifetime, 0))
+        self.assertEqual(response.msg_class, stun.CLASS_RESPONSE_SUCCESS)
+
+    def peer_attr(self, peer_addr=None):
+        host, port = peer_addr or self.peer_addr
+        return turn_attributes.XorPeerAddress, Address.FAMILY_IPv4, port, host
+
+    def test_allocation_expiry(self):
+        relay_port = self.allocate()
+        self.driver.advance(self.server.default_lifetime - 1)
+        response = self.request(turn.METHOD_REFRESH, (turn_attributes.Lifetime, 1200))
+        self.assertEqual(response.get_attr(turn.ATTR_LIFETIME).time_to_expiry, 1200)
+        self.driver.advance(1199)
+        self.assertIn(self.client_addr, self.server._relays)
+        self.driver.advance(1)
+        self.assertNotIn(self.client_addr, self.server._relays)
+        self.assertNotIn(relay_port.port, self.server.ports._relays)
+
+        response = self.request(turn.METHOD_REFRESH)
+        self.assertEqual(response.get_attr(stun.ATTR_ERROR_CODE).code, 437)
+
+    def test_deallocate(self):
+        relay_port = self.allocate()
+        self.request(turn.METHOD_CREATE_PERMISSION, self.peer_attr())
+        response = self.request(turn.METHOD_REFRESH, (turn_attributes.Lifetime, 0))
+        self.assertEqual(response.msg_class, stun.CLASS_RESPONSE_SUCCESS)
+        self.assertEqual(response.get_attr(turn.ATTR_LIFETIME).time_to_expiry, 0)
+        self.assertNotIn(self.client_addr, self.server._relays)
+        self.assertNotIn(relay_port.port, self.server.ports._relays)
+        self.assertEqual(self.server.ports.available, 10)
+        self.assertEqual(len(self.server.timers), 0)
+
+    def test_create_permission(self):
+        relay_port = self.allocate()
+        peers = [('192.168.2.{}'.format(i), 40000 + i) for i in range(2, 6)]
+        response = self.request(turn.METHOD_CREATE_PERMISSION,
+                                *[self.peer_attr(peer_addr) for peer_addr in peers])
+        self.assertEqual(response.msg_class, stun.CLASS_RESPONSE_SUCCESS)
+        self.assertEqual(sorted(self.relay.permissions), [host for host, _ in peers])
+
+        self.relay.send(b'hello', peers[-1])
+        self.relay.send(b'hello', ('192.168.2.6', 40000))
+        self.assertEqual(relay_port.written, [(b'hello', peers[-1])])
+
+    def test_permission_expiry(self):
+        self.allocate()
+        self.request(turn.METHOD_CREATE_PERMISSION, self.peer_attr())
+        self.driver.advance(turn.PERMISSION_LIFETIME - 1)
+        self.request(turn.METHOD_CREATE_PERMISSION, self.peer_attr())
+        self.driver.advance(turn.PERMISSION_LIFETIME - 1)
+        self.assertIn(self.peer_addr[0], self.relay.permissions)
+        self.driver.advance(1)
+        self.assertNotIn(self.peer_addr[0], self.relay.permissions)
+
+        self.relay.datagram_received(b'hello', self.peer_addr, self.driver.now)
+        self.assertEqual(self.outbox.written, [])
+
+    def test_permissions_expiring_with_allocation(self):
+        self.allocate(600)
+        self.driver.advance(300)
+        for i in range(10):
+            self.request(turn.METHOD_CREATE_PERMISSION,
+                         self.peer_attr(('192.168.2.{}'.format(i + 2), 40000)))
+        # The allocation cancels the permission timers of its own tick
+        self.driver.advance(300)
+        self.assertNotIn(self.client_addr, self.server._relays)
+        self.assertEqual(len(self.server.timers), 0)
+        # The timers keep running
+        self.allocate(600)
+        self.driver.advance(600)
+        self.assertNotIn(self.client_addr, self.server._relays)
+        self.assertEqual(self.server.ports.available, 10)
+
+    def send_indication(self, *attrs):
+        indication = self.writer.begin(turn.METHOD_SEND, stun.CLASS_INDICATION)
+        for attr in attrs:
+            indication.add_attr(*attr)
+        self.server.datagram_received(indication.finalize(), self.client_addr, self.driver.now)
+
+    def test_invalid_send_indication(self):
+        data_attr = turn_attributes.Data, b'hello'
+        # Without an allocation
+        self.send_indication(self.peer_attr(), data_attr)
+        relay_port = self.allocate()
+        self.request(turn.METHOD_CREATE_PERMISSION, self.peer_attr())
+        self.send_indication(data_attr)
+        self.send_indication(self.peer_attr())
+        self.assertEqual(relay_port.written, [])
+        self.assertEqual(self.outbox.written, [])
+        labels = '{class="indication",method="send"}'
+        self.assertEqual(self.server.metrics.as_dict()['sturn_dropped_messages_total' + labels], 3)
+        self.send_indication(self.peer_attr(), data_attr)
+        self.assertEqual(relay_port.written, [(b'hello', self.peer_addr)])
+
+    def test_channel_bind(self):
+        relay_port = self.allocate()
+        response = self.request(turn.METHOD_CHANNEL_BIND,
+                                (turn_attributes.ChannelNumber, 0x4000), self.peer_attr())
+        self.assertEqual(response.msg_class, stun.CLASS_RESPONSE_SUCCESS)
+
+        # Client -> peer
+        self.server.datagram_received(b'\x40\x00\x00\x05hello\x00\x00\x00', self.client_addr, self.driver.now)
+        self.assertEqual(relay_port.written, [(b'hello', self.peer_addr)])
+
+        # Peer -> client
+        self.relay.datagram_received(b'world', self.peer_addr, self.driver.now)
+        self.assertEqual(self.outbox.written, [(b'\x40\x00\x00\x05world', self.client_addr)])
+
+    def test_channel_bind_conflict(self):
+        self.allocate()
+        self.request(turn.METHOD_CHANNEL_BIND,
+                     (turn_attributes.ChannelNumber, 0x4000), self.peer_attr())
+        for channel_number, peer_addr in ((0x4001, self.peer_addr),
+                                          (0x4000, ('192.168.2.3', 40000)),
+                                          (0x3fff, ('192.168.2.3', 40000)),
+                                          (0x7fff, ('192.168.2.3', 40000))):
+            response = self.request(turn.METHOD_CHANNEL_BIND,
+                                    (turn_attributes.ChannelNumber, channel_number),
+                                    self.peer_attr(peer_addr))
+            self.assertEqual(response.get_attr(stun.ATTR_ERROR_CODE).code, 400)
+
+    def test_channel_expiry(self):
+        self.allocate(lifetime=3600)
+        self.request(turn.METHOD_CHANNEL_BIND,
+                     (turn_attributes.ChannelNumber, 0x4000), self.peer_attr())
+        self.driver.advance(turn.CHANNEL_LIFETIME - 1)
+        self.request(turn.METHOD_CHANNEL_BIND,
+                     (turn_attributes.ChannelNumber, 0x4000), self.peer_attr())
+        self.driver.advance(turn.CHANNEL_LIFETIME - 1)
+        self.assertEqual(self.relay._channels, {0x4000: self.peer_addr})
+        self.driver.advance(1)
+        self.assertEqual(self.relay._channels, {})
+        self.assertEqual(self.relay._peers, {})
+
+    def test_connection_closed(self):
+        self.allocate()
+        self.server.connection_closed(self.client_addr)
+        self.assertNotIn(self.client_addr, self.server._relays)
+        self.assertEqual(self.server.ports.available, 10)
+
+    def test_idle_connection(self):
+        self.assertTrue(self.server.connection_idle(self.client_addr))
+        self.allocate()
+        self.assertFalse(self.server.connection_idle(self.client_addr))
+        self.deallocate()
+        self.assertTrue(self.server.connection_idle(self.client_addr))
+
+    def test_port_recycling(self):
+        relay_port = self.allocate()
+        self.deallocate()
+        # The idle socket is reused, no new port is bound
+        self.assertIs(self.allocate(), relay_port)
+        self.assertIs(self.server.ports._relays[relay_port.port], self.relay)
+        self.assertEqual(sorted(self.driver.ports), [3478, 50000])
+
+    def test_port_unavailable(self):
+        self.driver.bind(50000)
+        relay_port = self.allocate()
+        self.assertEqual(relay_port.port, 50001)
+        self.assertEqual(self.server.ports.available, 8)
+
+    def test_ports_exhausted(self):
+        for port in range(50000, 50010):
+            self.driver.bind(port)
+        response = self.request(turn.METHOD_ALLOCATE,
+                                (turn_attributes.RequestedTransport, turn.TRANSPORT_UDP))
+        self.assertEqual(response.get_attr(stun.ATTR_ERROR_CODE).code, 508)
+
+    def test_even_port(self):
+        self.driver.bind(50000)
+        relay_port = self.allocate(None, (turn_attributes.EvenPort, False))
+        self.assertEqual(relay_port.port, 50002)
+        self.assertIsNone(self.reservation_token)
+
+    def test_reservation_token(self):
+        relay_port = self.allocate(None, (turn_attributes.EvenPort, True))
+        self.assertEqual(relay_port.port, 50000)
+        token = self.reservation_token
+        self.assertEqual(len(token), 8)
+        self.deallocate()
+        relay_port = self.allocate(None, (turn_attributes.ReservationToken, token))
+        self.assertEqual(relay_port.port, 50001)
+        self.deallocate()
+        # A token is used once
+        response = self.request(turn.METHOD_ALLOCATE,
+                                (turn_attributes.RequestedTransport, turn.TRANSPORT_UDP),
+                                (turn_attributes.ReservationToken, token))
+        self.assertEqual(response.get_attr(stun.ATTR_ERROR_CODE).code, 508)
+
+    def test_reservation_expiry(self):
+        self.allocate(3600, (turn_attributes.EvenPort, True))
+        self.driver.advance(self.server.ports.reservation_lifetime - 1)
+        self.assertEqual(self.server.ports.available, 8)
+        self.driver.advance(1)
+        self.assertEqual(self.server.ports.available, 9)
+        self.request(turn.METHOD_REFRESH, (turn_attributes.Lifetime, 0))
+        response = self.request(turn.METHOD_ALLOCATE,
+                                (turn_attributes.RequestedTransport, turn.TRANSPORT_UDP),
+                                (turn_attributes.ReservationToken, self.reservation_token))
+        self.assertEqual(response.get_attr(stun.ATTR_ERROR_CODE).code, 508)
+
+    def test_even_port_with_token(self):
+        response = self.request(turn.METHOD_ALLOCATE,
+                                (turn_attributes.RequestedTransport, turn.TRANSPORT_UDP),
+                                (turn_attributes.EvenPort, False),
+                                (turn_attributes.ReservationToken, bytes(8)))
+        self.assertEqual(response.get_attr(stun.ATTR_ERROR_CODE).code, 400)
+
+    def test_retransmission(self):
+        request = self.encode_request(turn.METHOD_ALLOCATE,
+                                      (turn_attributes.RequestedTransport, turn.TRANSPORT_UDP))
+        response = self.send(request)
+        self.assertEqual(response.msg_class, stun.CLASS_RESPONSE_SUCCESS)
+        # Answered from the cache, nothing is allocated again
+        self.assertEqual(bytes(self.send(request)), bytes(response))
+        self.assertEqual(self.server.stats()['retransmissions'], 1)
+        self.assertEqual(sorted(self.driver.ports), [3478, 50000])
+
+        # Past the cache, the allocation is recognized by its transaction id
+        self.driver.advance(self.server.response_cache.ttl)
+        retransmitted = self.send(request)
+        self.assertEqual(retransmitted.msg_class, stun.CLASS_RESPONSE_SUCCESS)
+        self.assertEqual(retransmitted.get_attr(turn.ATTR_XOR_RELAYED_ADDRESS).port,
+                         response.get_attr(turn.ATTR_XOR_RELAYED_ADDRESS).port)
+        self.assertEqual(sorted(self.driver.ports), [3478, 50000])
+
+        response = self.request(turn.METHOD_ALLOCATE,
+                                (turn_attributes.RequestedTransport, turn.TRANSPORT_UDP))
+        self.assertEqual(response.get_attr(stun.ATTR_ERROR_CODE).code, 437)
+
+    def test_allocation_quota(self):
+        self.server.user_quotas.limits = {'allocations_per_user': 1}
+        self.allocate()
+        first_client_addr, self.client_addr = self.client_addr, ('192.168.2.1', 54322)
+        response = self.request(turn.METHOD_ALLOCATE,
+                                (turn_attributes.RequestedTransport, turn.TRANSPORT_UDP))
+        self.assertEqual(response.get_attr(stun.ATTR_ERROR_CODE).code, 486)
+        self.client_addr = first_client_addr
+        self.deallocate()
+        self.client_addr = ('192.168.2.1', 54322)
+        self.allocate()
+
+    def test_allocation_quota_across_transports(self):
+        self.server.user_quotas.limits = {'allocations_per_user': 1, 'user_rate': 100}
+        self.allocate()
+        # A server of another transport shares the ports and the quotas
+        tcp_server = TurnUdpServer('127.0.0.1', 3478, 'sturn',
+                                   self.credential_mechanism, {}, (50000, 50009))
+        tcp_server.ports = self.server.ports
+        tcp_server.user_quotas = self.server.user_quotas
+        udp_server, self.server = self.server, tcp_server
+        self.outbox = self.driver.connect(tcp_server)
+        response = self.request(turn.METHOD_ALLOCATE,
+                                (turn_attributes.RequestedTransport, turn.TRANSPORT_UDP))
+        self.assertEqual(response.get_attr(stun.ATTR_ERROR_CODE).code, 486)
+        udp_server.deallocate(self.relay)
+        self.allocate()
+        self.assertIs(self.relay.buckets[0], udp_server.user_quotas.buckets[b'username'])
+
+    def test_rate_limit(self):
+        self.server.user_quotas.limits = {'allocation_rate': 10, 'user_rate': 100}
+        relay_port = self.allocate()
+        self.request(turn.METHOD_CREATE_PERMISSION, self.peer_attr())
+        for _ in range(3):
+            self.relay.send(b'hello', self.peer_addr)
+        self.assertEqual(len(relay_port.written), 2)
+        self.assertEqual(self.server.stats()['throttled'], 1)
+        self.driver.advance(0.5)
+        self.relay.datagram_received(b'hello', self.peer_addr, self.driver.now)
+        self.assertEqual(len(self.outbox.written), 1)
+        self.relay.datagram_received(b'hello', self.peer_addr, self.driver.now)
+        self.assertEqual(len(self.outbox.written), 1)
+        self.assertEqual(self.server.throttled, 2)
+        # The user's bucket is shared and released with the last allocation
+        self.assertEqual(self.relay.buckets[1].tokens, 95)
+        self.deallocate()
+        self.assertEqual(self.server.user_quotas.buckets, {})
+
+    def test_handler_failure_metrics(self):
+        def fail(msg, addr):
+            raise ValueError()
+        self.server._handlers[stun.METHOD_BINDING, stun.CLASS_REQUEST] = fail
+        request = Message.encode(stun.METHOD_BINDING, stun.CLASS_REQUEST)
+        self.assertRaises(ValueError, self.server.datagram_received, request, self.client_addr,
+                          self.driver.now)
+        # A batch carries on with the next datagram
+        self.server.datagrams_received([(request, self.client_addr)] * 2, self.driver.now)
+        metrics = self.server.metrics.as_dict()
+        labels = '{class="request",method="binding"}'
+        self.assertEqual(metrics['sturn_messages_total' + labels], 3)
+        self.assertEqual(metrics['sturn_dropped_messages_total' + labels], 3)
+        self.assertEqual(metrics['sturn_handler_seconds' + labels + '_count'], 3)
+
+    def test_metrics(self):
+        self.allocate()
+        self.request(turn.METHOD_CREATE_PERMISSION, self.peer_attr())
+        self.request(turn.METHOD_ALLOCATE,
+                     (turn_attributes.RequestedTransport, turn.TRANSPORT_UDP))
+        metrics = self.server.metrics.as_dict()
+        labels = '{class="request",method="allocate"}'
+        self.assertEqual(metrics['sturn_messages_total' + labels], 2)
+        self.assertEqual(metrics['sturn_error_responses_total' + labels], 1)
+        self.assertEqual(metrics['sturn_allocations'], 1)
+        self.assertEqual(metrics['sturn_permissions'], 1)
+        self.assertIn('sturn_handler_seconds_bucket{class="request",le="+Inf",'
+                      'method="create_permission"} 1', self.server.metrics.render())
+
+
+class TokenBucketTest(unittest.TestCase):
+    def test_consume(self):
+        bucket = TokenBucket(100, 150, 0)
+        self.assertTrue(bucket.consume(150, 0))
+        self.assertFalse(bucket.consume(1, 0))
+        self.assertTrue(bucket.consume(50, 0.5))
+        self.assertFalse(bucket.consume(1, 0.5))
+        # Refill is capped at the burst size
+        self.assertFalse(bucket.consume(151, 10))
+        self.assertTrue(bucket.consume(150, 10))
+
+
+class SplitPortRangeTest(unittest.TestCase):
+    def test_split(self):
+        self.assertEqual(split_port_range(49152, 65535, 3),
+                         [(49152, 54611), (54612, 60071), (60072, 65535)])
+        self.assertEqual(split_port_range(40000, 40003, 2), [(40000, 40001), (40002, 40003)])
+
+    def test_too_small(self):
+        self.assertRaises(ValueError, split_port_range, 40000, 40002, 2)
+
+
+class TurnClientTest(unittest.TestCase):
+    client_addr = ('192.168.2.1', 54321)
+    server_addr = ('127.0.0.1', 3478)
+    peer_addr = ('192.168.2.2', 40000)
+
+    def setUp(self):
+        self.driver = ManualDriver()
+        credential_mechanism = LongTermCredentialMechanism(
+            b'realm', {'username': {'password': 'password'}})
+        self.server = TurnUdpServer('127.0.0.1', 3478, 'sturn',
+                                    credential_mechanism, {}, (50000, 50009))
+        self.server_outbox = self.driver.connect(self.server)
+        self.client = TurnUdpClient('192.168.2.1', 54321, 'username', 'password')
+        self.client_outbox = self.driver.connect(self.client)
+        self.received = []
+        self.client.data_received = lambda data, addr: self.received.append((bytes(data), addr))
+
+    def exchange(self, transaction):
+        """Deliver the datagrams between client and server until none is left
+        """
+        while self.client_outbox.written or self.server_outbox.written:
+            for data, addr in self.client_outbox.written:
+                self.assertEqual(addr, self.server_addr)
+                self.server.datagram_received(data, self.client_addr, self.driver.now)
+            del self.client_outbox.written[:]
+            for data, addr in self.server_outbox.written:
+                self.client.datagram_received(data, self.server_addr, self.driver.now)
+            del self.server_outbox.written[:]
+        self.assertTrue(transaction.done())
+        return transaction.exception() or transaction.result()
+
+    def test_allocate(self):
+        relayed_addr = self.exchange(self.client.allocate(self.server_addr))
+        self.assertEqual(relayed_addr, ('127.0.0.1', 50000))
+        self.assertEqual(self.client.credential_mechanism.realm, b'realm')
+        self.assertIn(self.client_addr, self.server._relays)
+
+        self.assertIsNotNone(self.exchange(
+            self.client.create_permission(self.server_addr, self.peer_addr[0])))
+        relay_port = self.driver.ports[50000]
+        self.client.send_indication(self.server_addr, self.peer_addr, b'hello')
+        self.exchange(self.client.refresh(self.server_addr, 600))
+        self.assertEqual(relay_port.written, [(b'hello', self.peer_addr)])
+        self.server.ports.datagram_received(50000, b'world', self.peer_addr, self.driver.now)
+        self.exchange(self.client.refresh(self.server_addr, 600))
+        self.assertEqual(self.received, [(b'world', self.peer_addr)])
+
+        self.assertEqual(self.exchange(self.client.refresh(self.server_addr, 0)), 0)
+        self.assertNotIn(self.client_addr, self.server._relays)
+        # Deleting an allocation which is gone already succeeds
+        self.assertEqual(self.exchange(self.client.refresh(self.server_addr, 0)), 0)
+
+    def test_channel_data(self):
+        self.exchange(self.client.allocate(self.server_addr))
+        self.exchange(self.client.channel_bind(self.server_addr, 0x4000, self.peer_addr))
+        self.client.send_channel_data(self.server_addr, 0x4000, b'hello')
+        self.exchange(self.client.refresh(self.server_addr, 600))
+        self.assertEqual(self.driver.ports[50000].written, [(b'hello', self.peer_addr)])
+        self.server.ports.datagram_received(50000, b'world', self.peer_addr, self.driver.now)
+        self.exchange(self.client.refresh(self.server_addr, 600))
+        self.assertEqual(self.received, [(b'world', self.peer_addr)])
+
+    def test_wrong_password(self):
+        self.client.credential_mechanism.password = 'wrong'
+        error = self.exchange(self.client.allocate(self.server_addr))
+        self.assertEqual(error.code, 401)
+
+
+if __name__ == "__main__":
+    unittest.main()
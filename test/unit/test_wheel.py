@@ -0,0 +1,85 @@
+#!/usr/bin/env vpython3
+import random
+import unittest
+from sturn.wheel import TimerWheel
+
+
+class TimerWheelTest(unittest.TestCase):
+    def setUp(self):
+        self.wheel = TimerWheel(resolution=1., now=1000., bits=(4, 3, 3))
+        self.expired = []
+
+    def expire(self, name):
+        self.expired.append((name, self.wheel.now))
+
+    def test_schedule(self):
+        self.wheel.schedule(5, self.expire, 'a')
+        self.wheel.schedule(.5, self.expire, 'b')
+        self.wheel.advance(1004)
+        self.assertEqual(self.expired, [('b', 1001)])
+        self.assertEqual(self.wheel.advance(1010), 1)
+        self.assertEqual(self.expired, [('b', 1001), ('a', 1005)])
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_cascade(self):
+        # Delays spanning all levels and beyond the range of the wheel
+        delays = random.Random(0).sample(range(1, 3000), 300)
+        for delay in delays:
+            self.wheel.schedule(delay, self.expire, delay)
+        self.assertEqual(len(self.wheel), len(delays))
+        now = 1000
+        while now < 4000:
+            now += random.Random(now).randint(1, 40)
+            self.wheel.advance(now)
+        self.assertEqual(self.expired, [(delay, 1000 + delay) for delay in sorted(delays)])
+
+    def test_cancel_reset(self):
+        cancelled = self.wheel.schedule(10, self.expire, 'cancelled')
+        reset = self.wheel.schedule(10, self.expire, 'reset')
+        self.wheel.advance(1005)
+        cancelled.cancel()
+        self.assertFalse(cancelled.active())
+        reset.reset(100)
+        self.assertTrue(reset.active())
+        self.wheel.advance(1104)
+        self.assertEqual(self.expired, [])
+        self.wheel.advance(1105)
+        self.assertEqual(self.expired, [('reset', 1105)])
+        self.assertFalse(reset.active())
+
+    def test_reschedule_in_callback(self):
+        def expire():
+            self.expired.append(self.wheel.now)
+            if len(self.expired) < 3:
+                self.wheel.schedule(20, expire)
+        self.wheel.schedule(20, expire)
+        self.wheel.advance(2000)
+        self.assertEqual(self.expired, [1020, 1040, 1060])
+
+    def test_cancel_in_callback(self):
+        timers = []
+        def expire(name):
+            self.expire(name)
+            for timer in timers:
+                timer.cancel()
+        timers.extend(self.wheel.schedule(10, expire, name) for name in range(5))
+        later = self.wheel.schedule(20, self.expire, 'later')
+        self.assertEqual(self.wheel.advance(1010), 1)
+        self.assertEqual(len(self.expired), 1)
+        self.assertFalse(any(timer.active() for timer in timers))
+        self.wheel.advance(1020)
+        self.assertEqual(self.expired[-1], ('later', 1020))
+        self.assertFalse(later.active())
+
+    def test_failing_callback(self):
+        def fail():
+            raise ValueError()
+        self.wheel.schedule(10, fail)
+        self.wheel.schedule(10, self.expire, 'a')
+        self.assertEqual(self.wheel.advance(1010), 2)
+        self.assertEqual(self.expired, [('a', 1010)])
+        self.assertEqual(len(self.wheel), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
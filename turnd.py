@@ -2,10 +2,11 @@
 import os
 import sys
 import json
+import time
+import signal
+import argparse
 import logging.config
-from twisted.internet import reactor
-from sturn.turn.server import TurnUdpServer
-from sturn.stun.authentication import LongTermCredentialMechanism
+from sturn.turn.ports import split_port_range
 
 
 try:
@@ -15,17 +16,174 @@ except:
     logging.exception("Failed to load 'logging.config' file")
 
 
-with open(sys.argv[1]) as fp:
-    config = json.load(fp)
-software = config['software']
-realm = bytes(config['realm'].encode('utf-8'))
-users = config['users']
-overrides = config.get('overrides') or {}
-interface = config['turnhost']
-port = config['turnport']
-
-credential_mechanism = LongTermCredentialMechanism(realm, users)
-server = TurnUdpServer(reactor, interface, port, software, credential_mechanism, overrides)
-port = server.start()
-logging.info("Started %r", server)
-reactor.run()
+def write_stats(path, stats):
+    """Replace the stats file atomically, so readers never see a partial file
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as fp:
+        json.dump(stats, fp)
+    os.replace(tmp_path, path)
+
+
+def aggregate_stats(stats_file, workers):
+    """Sum the per-worker stats files into stats_file
+    """
+    per_worker = []
+    for worker in range(workers):
+        try:
+            with open('{}.{}'.format(stats_file, worker)) as fp:
+                per_worker.append(json.load(fp))
+        except (OSError, ValueError):
+            per_worker.append({})
+    total = {}
+    for stats in per_worker:
+        for name, value in stats.items():
+            total[name] = total.get(name, 0) + value
+    write_stats(stats_file, {'total': total, 'workers': per_worker})
+
+
+def run(config, relay_ports, reuse_port=False, stats_file=None, stats_interval=5.,
+        batch_size=0, loop='twisted', metrics_port=None, tls_context=None):
+    # The event loop is created after forking, each worker needs its own poller
+    if loop == 'twisted':
+        from twisted.internet import reactor
+        from sturn import udp
+        call_later = reactor.callLater
+    else:
+        from sturn import aio
+        event_loop = aio.new_event_loop(loop == 'uvloop')
+        call_later = event_loop.call_later
+    from sturn.turn.server import TurnUdpServer
+    from sturn.stun.authentication import LongTermCredentialMechanism
+
+    software = config['software']
+    realm = bytes(config['realm'].encode('utf-8'))
+    users = config['users']
+    overrides = config.get('overrides') or {}
+    interface = config['turnhost']
+    port = config['turnport']
+    prebind_ports = config.get('prebind_ports', 0)
+    quotas = config.get('quotas')
+
+    credential_mechanism = LongTermCredentialMechanism(realm, users)
+    server = TurnUdpServer(interface, port, software, credential_mechanism, overrides,
+                           relay_ports, prebind_ports, quotas)
+    if loop == 'twisted':
+        port = udp.listen(reactor, server, reuse_port, batch_size).transport.getHost().port
+    else:
+        port = aio.listen(event_loop, server, reuse_port, batch_size).endpoint.port
+    tcp_server = None
+    if config.get('tcp'):
+        if loop != 'twisted':
+            raise SystemExit("TCP is only served on the twisted loop")
+        from sturn import stream
+        # A protocol instance of its own keeps the TCP 5-tuples apart, the
+        # relay ports and the user quotas are shared with the UDP server
+        tcp_server = TurnUdpServer(interface, port, software, credential_mechanism,
+                                   overrides, relay_ports, 0, quotas)
+        tcp_server.ports = server.ports
+        tcp_server.user_quotas = server.user_quotas
+        stream.listenTCP(reactor, port, tcp_server, interface,
+                         config.get('tcp_max_connections', 10000), reuse_port=reuse_port)
+    tls_server = None
+    if tls_context:
+        if loop != 'twisted':
+            raise SystemExit("TLS is only served on the twisted loop")
+        from sturn import tls
+        tls_config = config['tls']
+        tls_port = tls_config.get('port', tls.TURNS_PORT)
+        tls_server = TurnUdpServer(interface, tls_port, software, credential_mechanism,
+                                   overrides, relay_ports, 0, quotas)
+        tls_server.ports = server.ports
+        tls_server.user_quotas = server.user_quotas
+        tls.listenTLS(reactor, tls_port, tls_server, tls_context, interface,
+                      tls_config.get('max_connections', 10000), reuse_port=reuse_port,
+                      handshake_threads=tls_config.get('handshake_threads', 4))
+    if stats_file:
+        def update_stats():
+            stats = server.metrics.as_dict()
+            if tcp_server:
+                stats.update(('tcp_' + name, value)
+                             for name, value in tcp_server.metrics.as_dict().items())
+            if tls_server:
+                stats.update(('tls_' + name, value)
+                             for name, value in tls_server.metrics.as_dict().items())
+            write_stats(stats_file, stats)
+            call_later(stats_interval, update_stats)
+        update_stats()
+    if metrics_port:
+        from sturn import metrics
+        metrics.serve(server.metrics, metrics_port)
+    logging.info("Started %r (pid %d, relay ports %d-%d)", server, os.getpid(), *relay_ports)
+    if loop == 'twisted':
+        reactor.run()
+    else:
+        aio.run(event_loop)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="TURN server")
+    parser.add_argument('config', help="JSON configuration file")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Number of processes sharing the port through SO_REUSEPORT")
+    parser.add_argument('--batch', type=int, default=0, metavar='N',
+                        help="Read and write up to N datagrams per recvmmsg/sendmmsg call")
+    parser.add_argument('--loop', choices=('twisted', 'asyncio', 'uvloop'), default='twisted',
+                        help="Event loop to run the server on")
+    parser.add_argument('--stats', metavar='FILE',
+                        help="Write JSON metrics to FILE, per worker to FILE.<n>")
+    parser.add_argument('--metrics', type=int, metavar='PORT',
+                        help="Serve Prometheus metrics on localhost:PORT/metrics, "
+                             "worker n on PORT+n")
+    parser.add_argument('--stats-interval', type=float, default=5.,
+                        help="Seconds between stats updates")
+    args = parser.parse_args()
+
+    with open(args.config) as fp:
+        config = json.load(fp)
+    relay_ports = tuple(config.get('relay_ports') or (49152, 65535))
+    tls_context = None
+    if config.get('tls'):
+        from sturn.tls import server_context
+        # Created before forking, the workers share the session ticket keys
+        # and a ticket from one worker resumes on any other
+        tls_config = config['tls']
+        tls_context = server_context(tls_config['certificate'], tls_config.get('private_key'),
+                                     tls_config.get('num_tickets', 2))
+
+    if args.workers <= 1:
+        run(config, relay_ports, stats_file=args.stats, stats_interval=args.stats_interval,
+            batch_size=args.batch, loop=args.loop, metrics_port=args.metrics,
+            tls_context=tls_context)
+        return
+
+    pids = {}
+    for worker, worker_ports in enumerate(split_port_range(*relay_ports, args.workers)):
+        pid = os.fork()
+        if not pid:
+            stats_file = args.stats and '{}.{}'.format(args.stats, worker)
+            metrics_port = args.metrics and args.metrics + worker
+            run(config, worker_ports, True, stats_file, args.stats_interval, args.batch,
+                args.loop, metrics_port, tls_context)
+            os._exit(0)
+        pids[pid] = worker
+
+    def terminate(signum, frame):
+        for pid in pids:
+            os.kill(pid, signal.SIGTERM)
+    signal.signal(signal.SIGTERM, terminate)
+    signal.signal(signal.SIGINT, terminate)
+
+    while pids:
+        pid, status = os.waitpid(-1, os.WNOHANG)
+        if pid:
+            logging.log(logging.WARNING if status else logging.INFO,
+                        "Worker %d (pid %d) exited with status %d", pids.pop(pid), pid, status)
+            continue
+        if args.stats:
+            aggregate_stats(args.stats, args.workers)
+        time.sleep(args.stats_interval)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,308 @@
+#!/usr/bin/env vpython3
+"""Control-plane load generator for turnd
+Simulated clients arrive at a given rate, each runs the full
+Binding, Allocate (401), Allocate, CreatePermission, Refresh and
+deallocating Refresh flow over one of a pool of local sockets.
+Every concurrent client needs its own 5-tuple, so --sockets bounds the
+concurrency while --clients may be much larger.
+Reports latency percentiles per method and error codes. With --ramp the
+arrival rate is increased step by step until the allocate latency
+collapses or the server stops keeping up, and the highest sustained
+allocation rate is reported.
+"""
+import sys
+import time
+import random
+import asyncio
+import argparse
+from collections import defaultdict, Counter
+from sturn import stun, turn
+from sturn.stun.agent import Message, MessageWriter, Address
+from sturn.stun import attributes
+from sturn.turn import attributes as turn_attributes
+from sturn.utils import ha1
+
+
+class TransactionError(Exception):
+    def __init__(self, code):
+        Exception.__init__(self, code)
+        self.code = code
+
+
+class Transactions(asyncio.DatagramProtocol):
+    """Responses of one socket matched to the pending requests by transaction id
+    """
+    def __init__(self):
+        self.pending = {} # transaction id -> Future
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        future = self.pending.pop(bytes(data[8:20]), None)
+        if future and not future.done():
+            future.set_result(data)
+
+    def error_received(self, exc):
+        pass
+
+
+class Session(object):
+    """One simulated client on a socket taken from the pool
+    """
+    def __init__(self, load, transactions):
+        self.load = load
+        self.transactions = transactions
+        self.writer = MessageWriter()
+        self.realm = None
+        self.nonce = None
+
+    async def request(self, name, msg_method, attrs=(), authenticate=True):
+        load = self.load
+        msg = self.writer.begin(msg_method, stun.CLASS_REQUEST)
+        for attr in attrs:
+            msg.add_attr(*attr)
+        if authenticate:
+            msg.add_attr(attributes.Username, load.username)
+            msg.add_attr(attributes.Realm, self.realm)
+            msg.add_attr(attributes.Nonce, self.nonce)
+            msg.add_attr(attributes.MessageIntegrity, load.key)
+        msg.add_attr(attributes.Fingerprint)
+        transaction_id = msg.transaction_id
+        data = msg.finalize()
+
+        future = load.loop.create_future()
+        self.transactions.pending[transaction_id] = future
+        start = time.perf_counter()
+        rto = load.rto
+        try:
+            for _ in range(load.retries + 1):
+                self.transactions.transport.sendto(data, load.server)
+                try:
+                    response = await asyncio.wait_for(asyncio.shield(future), rto)
+                    break
+                except asyncio.TimeoutError:
+                    rto *= 2
+            else:
+                load.record_error(name, 'timeout')
+                raise TransactionError('timeout')
+        finally:
+            self.transactions.pending.pop(transaction_id, None)
+        latency = time.perf_counter() - start
+
+        response = Message.decode(response, lazy=True)
+        if response.msg_class == stun.CLASS_RESPONSE_ERROR:
+            error_code = response.get_attr(stun.ATTR_ERROR_CODE)
+            nonce = response.get_attr(stun.ATTR_NONCE)
+            if nonce:
+                self.nonce = bytes(nonce)
+                self.realm = bytes(response.get_attr(stun.ATTR_REALM))
+            load.record(name, latency)
+            raise TransactionError(error_code.code if error_code else 'error')
+        load.record(name, latency)
+        return response
+
+    async def run(self):
+        load = self.load
+        transport = (turn_attributes.RequestedTransport, turn.TRANSPORT_UDP)
+        await self.request('binding', stun.METHOD_BINDING, authenticate=False)
+        try:
+            await self.request('allocate_401', turn.METHOD_ALLOCATE, [transport],
+                               authenticate=False)
+        except TransactionError as e:
+            if e.code != 401:
+                if e.code != 'timeout':
+                    load.record_error('allocate_401', e.code)
+                return
+        else:
+            load.record_error('allocate_401', 'no challenge')
+            return
+        try:
+            await self.request('allocate', turn.METHOD_ALLOCATE, [transport])
+        except TransactionError as e:
+            if e.code != 438:
+                if e.code != 'timeout':
+                    load.record_error('allocate', e.code)
+                return
+            # Stale nonce, retry with the new one
+            try:
+                await self.request('allocate', turn.METHOD_ALLOCATE, [transport])
+            except TransactionError as e:
+                if e.code != 'timeout':
+                    load.record_error('allocate', e.code)
+                return
+        load.allocations += 1
+        name = 'create_permission'
+        try:
+            peer = (turn_attributes.XorPeerAddress, Address.FAMILY_IPv4, 9, load.peer)
+            await self.request(name, turn.METHOD_CREATE_PERMISSION, [peer])
+            if load.hold:
+                await asyncio.sleep(load.hold)
+            name = 'refresh'
+            await self.request(name, turn.METHOD_REFRESH, [(turn_attributes.Lifetime, 600)])
+        except TransactionError as e:
+            if e.code != 'timeout':
+                load.record_error(name, e.code)
+        finally:
+            try:
+                await self.request('deallocate', turn.METHOD_REFRESH,
+                                   [(turn_attributes.Lifetime, 0)])
+            except TransactionError as e:
+                if e.code != 'timeout':
+                    load.record_error('deallocate', e.code)
+
+
+class Load(object):
+    def __init__(self, loop, args):
+        self.loop = loop
+        self.server = (args.host, args.port)
+        self.username = args.username
+        self.key = ha1(args.username, args.realm.encode('utf-8'), args.password)
+        self.peer = args.peer
+        self.hold = args.hold
+        self.rto = args.rto
+        self.retries = args.retries
+        self.latencies = defaultdict(list) # method -> [seconds]
+        self.errors = Counter() # (method, code) -> count
+        self.allocations = 0
+        self.sockets = asyncio.Queue()
+        self.backlog = 0
+        self.max_backlog = 0
+
+    async def open_sockets(self, count, interface):
+        for _ in range(count):
+            _transport, transactions = await self.loop.create_datagram_endpoint(
+                Transactions, local_addr=(interface, 0))
+            self.sockets.put_nowait(transactions)
+
+    def record(self, name, latency):
+        self.latencies[name].append(latency)
+
+    def record_error(self, name, code):
+        self.errors[name, code] += 1
+
+    def reset(self):
+        self.latencies.clear()
+        self.errors.clear()
+        self.allocations = 0
+
+    async def session(self):
+        self.backlog += 1
+        self.max_backlog = max(self.max_backlog, self.backlog)
+        transactions = await self.sockets.get()
+        self.backlog -= 1
+        try:
+            await Session(self, transactions).run()
+        except TransactionError:
+            pass
+        finally:
+            self.sockets.put_nowait(transactions)
+
+    async def arrivals(self, rate, duration=None, count=None, poisson=True):
+        """Start sessions at rate per second, for duration seconds or count sessions
+        """
+        tasks = []
+        start = self.loop.time()
+        next_arrival = start
+        while ((count is None or len(tasks) < count) and
+               (duration is None or next_arrival - start < duration)):
+            delay = next_arrival - self.loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(self.loop.create_task(self.session()))
+            next_arrival += random.expovariate(rate) if poisson else 1. / rate
+        await asyncio.gather(*tasks)
+        return self.loop.time() - start
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def report(load, elapsed, out=sys.stdout):
+    out.write("{:18s} {:>8s} {:>9s} {:>9s} {:>9s} {:>9s}\n".format(
+        'method', 'count', 'p50 ms', 'p99 ms', 'p999 ms', 'max ms'))
+    for name in ('binding', 'allocate_401', 'allocate', 'create_permission',
+                 'refresh', 'deallocate'):
+        latencies = sorted(load.latencies.get(name, ()))
+        if not latencies:
+            continue
+        out.write("{:18s} {:8d} {:9.2f} {:9.2f} {:9.2f} {:9.2f}\n".format(
+            name, len(latencies), percentile(latencies, .5) * 1e3,
+            percentile(latencies, .99) * 1e3, percentile(latencies, .999) * 1e3,
+            latencies[-1] * 1e3))
+    for (name, code), count in sorted(load.errors.items(), key=str):
+        out.write("error {} {}: {}\n".format(name, code, count))
+    out.write("{} allocations in {:.1f}s ({:.0f}/s), max backlog {}\n".format(
+        load.allocations, elapsed, load.allocations / elapsed, load.max_backlog))
+
+
+async def main(loop, args):
+    load = Load(loop, args)
+    await load.open_sockets(args.sockets, args.interface)
+    if not args.ramp:
+        elapsed = await load.arrivals(args.rate, args.duration, args.clients)
+        report(load, elapsed)
+        return
+
+    start, step, step_time = args.ramp
+    rate = start
+    sustained = 0
+    while True:
+        load.reset()
+        elapsed = await load.arrivals(rate, duration=step_time)
+        latencies = sorted(load.latencies.get('allocate', ())) or [float('inf')]
+        p99 = percentile(latencies, .99)
+        failures = sum(load.errors.values())
+        allocation_rate = load.allocations / elapsed
+        print("offered {:7.0f}/s: {:7.0f} allocations/s, allocate p99 {:8.2f}ms, "
+              "{} errors".format(rate, allocation_rate, p99 * 1e3, failures))
+        # Collapsed: slow allocations, errors, or the server falling behind the offer
+        if (p99 > args.collapse / 1e3 or failures > args.max_errors * load.allocations or
+                allocation_rate < .9 * rate):
+            break
+        sustained = max(sustained, allocation_rate)
+        rate += step
+    print("max sustained allocation rate: {:.0f}/s".format(sustained))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=3478)
+    parser.add_argument('--interface', default='127.0.0.1', help="Local address of the sockets")
+    parser.add_argument('--username', default='passuser')
+    parser.add_argument('--password', default='password')
+    parser.add_argument('--realm', default='trisoft.com.pl')
+    parser.add_argument('--peer', default='127.0.0.1', help="CreatePermission peer address")
+    parser.add_argument('--sockets', type=int, default=256,
+                        help="Local sockets, the maximum number of concurrent clients")
+    parser.add_argument('--rate', type=float, default=100., help="Client arrivals per second")
+    parser.add_argument('--clients', type=int, default=1000, help="Number of clients to run")
+    parser.add_argument('--duration', type=float, help="Stop arrivals after seconds")
+    parser.add_argument('--hold', type=float, default=0.,
+                        help="Seconds an allocation is held before the Refresh")
+    parser.add_argument('--rto', type=float, default=.5, help="Initial retransmission timeout")
+    parser.add_argument('--retries', type=int, default=2)
+    parser.add_argument('--ramp', type=lambda value: [float(v) for v in value.split(':')],
+                        metavar='START:STEP:SECONDS',
+                        help="Increase the arrival rate by STEP every SECONDS until collapse")
+    parser.add_argument('--collapse', type=float, default=100.,
+                        help="Allocate p99 latency (ms) considered a collapse")
+    parser.add_argument('--max-errors', type=float, default=.01,
+                        help="Error ratio considered a collapse")
+    parser.add_argument('--uvloop', action='store_true')
+    args = parser.parse_args()
+    if args.ramp:
+        args.clients = None
+
+    if args.uvloop:
+        from sturn.aio import new_event_loop
+        loop = new_event_loop(True)
+    else:
+        loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(main(loop, args))
+    finally:
+        loop.close()
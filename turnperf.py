@@ -0,0 +1,241 @@
+#!/usr/bin/env vpython3
+"""iperf over TURN, data-plane throughput of turnd
+Opens pairs of allocations, each client streams fixed-size packets to the
+relayed address of its partner, so every packet crosses two relays of the
+server. Packets are sent with Send indications or with ChannelData, paced
+at --rate bits per second per stream or as fast as possible.
+Reports throughput, one-way latency, jitter (RFC 3550), loss and reordering,
+and with --server-pid the server CPU time per relayed gigabit.
+Measure capacity against a server without bandwidth quotas.
+"""
+import os
+import sys
+import time
+import struct
+import argparse
+from twisted.internet import defer
+from twisted.python.failure import Failure
+from sturn import udp
+from sturn.turn.client import TurnUdpClient
+
+
+HEADER = struct.Struct('>Id') # sequence number, send time
+CHANNEL_NUMBER = 0x4000
+
+
+class Stream(object):
+    """Statistics of the packets received from a peer
+    """
+    def __init__(self):
+        self.received = 0
+        self.bytes = 0
+        self.next_seq = 0
+        self.reordered = 0
+        self.latencies = []
+        self.jitter = 0.
+        self._transit = None
+
+    def packet_received(self, seq, sent, now, size):
+        self.received += 1
+        self.bytes += size
+        if seq < self.next_seq:
+            self.reordered += 1
+        else:
+            self.next_seq = seq + 1
+        transit = now - sent
+        self.latencies.append(transit)
+        if self._transit is not None:
+            # :see: http://tools.ietf.org/html/rfc3550#appendix-A.8
+            self.jitter += (abs(transit - self._transit) - self.jitter) / 16
+        self._transit = transit
+
+
+class PerfClient(TurnUdpClient):
+    def __init__(self, interface, username, password, size, channel):
+        TurnUdpClient.__init__(self, interface, 0, username, password)
+        self.driver = None # DatagramDriver sending the packets
+        self.channel = channel
+        self.peer = None # relayed address of the partner
+        self.stream = Stream()
+        self.sent = 0
+        self.send_errors = 0
+        self._padding = bytes(max(0, size - HEADER.size))
+
+    def send_packet(self, server_addr):
+        data = HEADER.pack(self.sent, time.perf_counter()) + self._padding
+        send_errors = self.driver.send_errors
+        if self.channel:
+            self.send_channel_data(server_addr, CHANNEL_NUMBER, data)
+        else:
+            self.send_indication(server_addr, self.peer, data)
+        if self.driver.send_errors != send_errors:
+            # Socket buffer full
+            self.send_errors += 1
+            return False
+        self.sent += 1
+        return True
+
+    def data_received(self, data, peer_addr):
+        seq, sent = HEADER.unpack_from(data)
+        self.stream.packet_received(seq, sent, time.perf_counter(), len(data))
+
+
+def server_cpu(pids):
+    """
+    :returns: user + system CPU seconds of the processes and their children
+    """
+    ticks = os.sysconf('SC_CLK_TCK')
+    seconds = 0.
+    pids = list(pids)
+    seen = set()
+    while pids:
+        pid = pids.pop()
+        if pid in seen:
+            continue
+        seen.add(pid)
+        try:
+            with open('/proc/{}/stat'.format(pid)) as fp:
+                # Fields after the parenthesized command name
+                fields = fp.read().rsplit(')', 1)[1].split()
+            seconds += (int(fields[11]) + int(fields[12])) / ticks
+            with open('/proc/{}/task/{}/children'.format(pid, pid)) as fp:
+                pids.extend(int(child) for child in fp.read().split())
+        except (IOError, IndexError):
+            pass
+    return seconds
+
+
+def pump(reactor, clients, server_addr, packet_rate, duration, burst):
+    """Send packets from the clients for duration seconds
+    :param packet_rate: Packets per second per client, 0 for as fast as possible
+    :returns: Deferred firing with the elapsed time
+    """
+    done = defer.Deferred()
+    start = time.perf_counter()
+
+    def tick():
+        elapsed = time.perf_counter() - start
+        if elapsed >= duration:
+            done.callback(elapsed)
+            return
+        for client in clients:
+            due = int(elapsed * packet_rate) + 1 - client.sent if packet_rate else burst
+            for _ in range(min(due, burst)):
+                if not client.send_packet(server_addr):
+                    break
+        reactor.callLater(.001 if packet_rate else 0, tick)
+
+    tick()
+    return done
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def report(senders, receivers, elapsed, cpu_seconds, out=sys.stdout):
+    sent = sum(client.sent for client in senders)
+    send_errors = sum(client.send_errors for client in senders)
+    streams = [client.stream for client in receivers]
+    received = sum(stream.received for stream in streams)
+    received_bytes = sum(stream.bytes for stream in streams)
+    reordered = sum(stream.reordered for stream in streams)
+    latencies = sorted(latency for stream in streams for latency in stream.latencies)
+    jitters = [stream.jitter for stream in streams if stream.received]
+    bits = received_bytes * 8
+
+    out.write("streams {}, {:.1f}s\n".format(len(senders), elapsed))
+    out.write("sent {} packets ({} send errors), received {}, lost {} ({:.2%}), "
+              "reordered {}\n".format(sent, send_errors, received, sent - received,
+                                      (sent - received) / sent if sent else 0., reordered))
+    out.write("throughput {:.1f} Mbit/s, {:.0f} packets/s\n".format(
+        bits / elapsed / 1e6, received / elapsed))
+    if latencies:
+        out.write("latency p50 {:.3f}ms, p99 {:.3f}ms, max {:.3f}ms, "
+                  "jitter {:.3f}ms\n".format(
+                      percentile(latencies, .5) * 1e3, percentile(latencies, .99) * 1e3,
+                      latencies[-1] * 1e3, sum(jitters) / len(jitters) * 1e3))
+    if cpu_seconds is not None:
+        out.write("server CPU {:.2f}s ({:.0%}), {:.2f}s per relayed Gbit\n".format(
+            cpu_seconds, cpu_seconds / elapsed,
+            cpu_seconds / (bits / 1e9) if bits else float('inf')))
+
+
+@defer.inlineCallbacks
+def run(reactor, args):
+    server_addr = (args.host, args.port)
+    clients = []
+    for _ in range(args.pairs * 2):
+        client = PerfClient(args.interface, args.username, args.password,
+                            args.size, args.channel)
+        client.driver = udp.listen(reactor, client)
+        clients.append(client)
+    try:
+        yield defer.gatherResults([udp.deferred(client.allocate(server_addr))
+                                   for client in clients],
+                                  consumeErrors=True)
+        for a, b in zip(clients[::2], clients[1::2]):
+            a.peer, b.peer = b.relayed_addr, a.relayed_addr
+        if args.channel:
+            yield defer.gatherResults([
+                udp.deferred(client.channel_bind(server_addr, CHANNEL_NUMBER, client.peer))
+                for client in clients], consumeErrors=True)
+        else:
+            yield defer.gatherResults([
+                udp.deferred(client.create_permission(server_addr, client.peer[0]))
+                for client in clients], consumeErrors=True)
+
+        senders = clients[::2] if args.oneway else clients
+        packet_rate = args.rate / (args.size * 8) if args.rate else 0
+        cpu_start = server_cpu(args.server_pid) if args.server_pid else None
+        elapsed = yield pump(reactor, senders, server_addr, packet_rate, args.duration,
+                             args.burst)
+        # Let the packets in flight arrive
+        yield defer.Deferred().addTimeout(.5, reactor).addErrback(lambda failure: None)
+        cpu_seconds = server_cpu(args.server_pid) - cpu_start if args.server_pid else None
+        report(senders, clients, elapsed, cpu_seconds)
+    finally:
+        yield defer.gatherResults([udp.deferred(client.refresh(server_addr, 0))
+                                   for client in clients if client.relayed_addr],
+                                  consumeErrors=True).addErrback(lambda failure: None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=3478)
+    parser.add_argument('--interface', default='127.0.0.1', help="Local address of the clients")
+    parser.add_argument('--username', default='passuser')
+    parser.add_argument('--password', default='password')
+    parser.add_argument('--pairs', type=int, default=1, help="Pairs of allocations")
+    parser.add_argument('--size', type=int, default=1200, help="Packet size in bytes")
+    parser.add_argument('--rate', type=float, default=10e6,
+                        help="Bits per second per stream, 0 for as fast as possible")
+    parser.add_argument('--burst', type=int, default=64,
+                        help="Maximum packets sent per stream and timer tick")
+    parser.add_argument('--duration', type=float, default=10.)
+    parser.add_argument('--channel', action='store_true',
+                        help="Send ChannelData instead of Send indications")
+    parser.add_argument('--oneway', action='store_true',
+                        help="Only the first client of a pair sends")
+    parser.add_argument('--server-pid', type=int, action='append', default=[],
+                        help="Process of the server to measure the CPU time of")
+    args = parser.parse_args()
+    if args.size < HEADER.size:
+        parser.error("--size must be at least {}".format(HEADER.size))
+
+    from twisted.internet import reactor
+    failures = []
+    def stop(result):
+        if isinstance(result, Failure):
+            failures.append(result)
+        reactor.stop()
+    reactor.callWhenRunning(lambda: run(reactor, args).addBoth(stop))
+    reactor.run()
+    for failure in failures:
+        sys.stderr.write("turnperf failed: {}\n".format(failure.getErrorMessage()))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()